@@ -0,0 +1,457 @@
+"""
+Benchmarks of the `source` functions, plot widget callbacks and pipeline stages on synthetic data.
+
+Data is generated by `source.synthetic` (10^3 to 10^6 analyses by default) in a temporary workspace, so the
+benchmarks run offline and never touch data/. For each benchmark and size the best wall time of a number of
+runs and the peak memory allocated by one further (traced) run are recorded; results are written to
+benchmarks/benchmark-<time>.json and can be compared with an earlier run.
+
+Usage:
+    python -m source.benchmark [--sizes N ...] [--only NAME ...] [--repeat N] [--output PATH] [--compare BASELINE]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import cycle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from source import pipeline, synthetic
+from source.calibration import apply_detection_limits, calibrate, clean_srm_data, fit_calibration, screen_standards
+from source.correlation import bootstrap_intervals, correlation_matrix
+from source.drift import drift_differences, fit_drift, regression_results
+from source.duplicates import duplicate_precision
+from source.get_elements import get_elements
+from source.gridding import interpolate, project_grid
+from source.ingest import find_exports, read_export, read_exports
+from source.interactive_plots import interactive_histogram, interactive_linear_regression_plot, interactive_violin
+from source.multivariate import fit_model
+from source.outliers import detect_outliers_Dixons_Q, dixon_test, dixon_test_batch, remove_outliers
+from source.uncertainty import propagate_uncertainty
+
+repository = Path(__file__).resolve().parents[1]
+default_output_directory = repository / "benchmarks"
+default_sizes = [10**3, 10**4, 10**5, 10**6]
+
+# number of dropdown changes timed per widget benchmark
+widget_callbacks = 20
+
+def measure(function, repeat=3, memory=True):
+    """
+    Time a function of no arguments.
+
+    Returns a dict of the best and mean wall time (seconds) of `repeat` runs and, if memory is True, the peak
+    memory (MiB) allocated by this process during one further run traced with tracemalloc (memory allocated
+    by worker processes is not included).
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    result = {"seconds": min(times), "mean_seconds": float(np.mean(times)), "repeat": repeat}
+
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+class Workspace:
+    """
+    Synthetic data of one size, and the files generated from it (written on first use) in a directory laid
+    out like data/ (raw/XRF_data, raw/sample_processing_log.xlsx, interim/...).
+    """
+
+    def __init__(self, rows, directory, seed=0):
+        self.rows = rows
+        self.directory = Path(directory)
+        self.seed = seed
+        self.analyses = synthetic.synthetic_analyses(rows, seed=seed)
+        self.data = synthetic.synthetic_clean_data(rows, seed=seed)
+        self.elements = get_elements(self.data.columns.tolist())
+        self.files_written = False
+
+    def write_files(self):
+        if not self.files_written:
+            raw_directory = self.directory / "raw"
+            interim_directory = self.directory / "interim"
+            interim_directory.mkdir(parents=True, exist_ok=True)
+
+            synthetic.write_exports(self.analyses, raw_directory / "XRF_data")
+            synthetic.write_sample_log(self.analyses, raw_directory / "sample_processing_log.xlsx")
+            synthetic.write_srm_values(interim_directory / "standard_reference_material_certified_values.csv", self.seed)
+            synthetic.write_field_data(self.analyses, interim_directory / "field_data_coarse_clean.xlsx", self.seed)
+            self.files_written = True
+
+        return self.directory
+
+    def stage(self, name):
+        # definition of a pipeline stage with its paths moved into the workspace
+        # paths outside data/ (the GIS layers) are read-only and used in place
+        stage = dict(pipeline.stages[name])
+        data_directory = repository / "data"
+
+        def rebase(path):
+            path = Path(path)
+            return self.directory / path.relative_to(data_directory) if path.is_relative_to(data_directory) else path
+
+        for key in ["inputs", "outputs"]:
+            stage[key] = {argument: rebase(path) for argument, path in stage[key].items()}
+        stage["files"] = [rebase(path) for path in stage.get("files", [])]
+
+        stage["params"] = dict(stage["params"])
+        if name == "xrf_cleaning":
+            stage["params"]["cache_directory"] = self.directory / "xrf_ingest_cache"
+        elif name == "spatial":
+            stage["params"]["cache_directory"] = False
+
+        return stage
+
+    def run_stage(self, name):
+        # run a stage, running the stages it depends on first if their outputs are missing
+        for other in pipeline.dependencies(name):
+            if not all(path.exists() for path in pipeline.output_files(self.stage(other))):
+                self.run_stage(other)
+
+        pipeline.run_stage(self.stage(name))
+
+def dropdowns(widget):
+    # dropdowns of a widget box, in display order
+    if hasattr(widget, "options"):
+        return [widget]
+
+    return [dropdown for child in getattr(widget, "children", []) for dropdown in dropdowns(child)]
+
+def widget_changes(box, changes):
+    # apply a fixed number of dropdown changes (each triggers the widget's response callback), continuing
+    # through the given (dropdown, value) changes on every call so that cached selections are rarely reused
+    buttons = dropdowns(box)
+
+    def change():
+        for _ in range(widget_callbacks):
+            button, value = next(changes)
+            buttons[button].value = value
+
+    return change
+
+def histogram_button_info(workspace):
+    return {"categories": [{"name": "Session",     "column": "date",        "button row": 1},
+                           {"name": "Group",       "column": "group",       "button row": 1},
+                           {"name": "Sample Type", "column": "sample_type", "button row": 2},
+                           {"name": "QA/QC Type",  "column": "qaqc_type",   "button row": 2}],
+            "data": {"name": "Elements", "columns": workspace.elements}}
+
+def filter_changes(workspace):
+    # alternately change the session and the element shown, so that every change triggers a callback
+    sessions = list(workspace.data["date"].unique())
+    elements = workspace.elements
+
+    return cycle(change for i in range(len(sessions) * len(elements))
+                 for change in [(1, sessions[i % len(sessions)]), (0, elements[i % len(elements)])])
+
+def standards_drift_data(workspace):
+    standards = workspace.data[workspace.data["qaqc_type"] == "standard"]
+
+    return drift_differences(standards, workspace.elements, standards["date"].min())
+
+def srm_data(workspace):
+    path = workspace.write_files() / "interim" / "standard_reference_material_certified_values.csv"
+
+    return clean_srm_data(pd.read_csv(path))
+
+def calibration_inputs(workspace):
+    srm = srm_data(workspace)
+    elements = [element for element in workspace.elements if element in set(srm["Analyte"])]
+
+    return srm, elements
+
+def outlier_records(workspace):
+    # outliers of each kind, as stored by save_outliers: 1% of samples, sample sessions and values
+    rng = np.random.default_rng(workspace.seed)
+    data = workspace.data
+    rows = rng.choice(data.shape[0], (3, data.shape[0] // 100))
+    elements = rng.choice(workspace.elements, rows.shape[1])
+
+    return {"sample":                 [{"Sample ID": sample_id} for sample_id in data["sample_id"].to_numpy()[rows[0]]],
+            "sample_session":         [{"Sample ID": sample_id, "Session": date}
+                                       for sample_id, date in data[["sample_id", "date"]].to_numpy()[rows[1]]],
+            "sample_session_element": [{"Sample ID": sample_id, "Session": date, "Element": element}
+                                       for (sample_id, date), element in zip(data[["sample_id", "date"]].to_numpy()[rows[2]], elements)]}
+
+# setup of each benchmark: a function of the workspace returning the function to time (of no arguments)
+
+def setup_get_elements(workspace):
+    return lambda: get_elements(workspace.data.columns.tolist())
+
+def setup_dixon_test(workspace):
+    values = workspace.data[workspace.elements[0]].to_numpy()
+    return lambda: dixon_test(values)
+
+def setup_dixon_test_batch(workspace):
+    # Dixon's Q test of every element within every session
+    return lambda: dixon_test_batch(workspace.data, columns=workspace.elements, groupby=["date"])
+
+def setup_detect_outliers(workspace):
+    drift_data = standards_drift_data(workspace)
+    return lambda: detect_outliers_Dixons_Q(workspace.elements, drift_data)
+
+def setup_remove_outliers(workspace):
+    outliers = outlier_records(workspace)
+    return lambda: remove_outliers(outliers, workspace.data)
+
+def setup_fit_drift(workspace):
+    drift_data = standards_drift_data(workspace)
+    return lambda: fit_drift(drift_data, workspace.elements)
+
+def setup_screen_standards(workspace):
+    return lambda: screen_standards(workspace.data, workspace.elements)
+
+def setup_fit_calibration(workspace):
+    srm, elements = calibration_inputs(workspace)
+    return lambda: fit_calibration(workspace.data, srm, elements)
+
+def setup_calibrate(workspace):
+    calibration = fit_calibration(workspace.data, *calibration_inputs(workspace))
+    return lambda: apply_detection_limits(calibrate(workspace.data, calibration), calibration)
+
+def setup_duplicate_precision(workspace):
+    return lambda: duplicate_precision(workspace.data, workspace.elements, output_directory=False)
+
+def setup_correlation_matrix(workspace):
+    return lambda: correlation_matrix(workspace.data, workspace.elements, transform="clr")
+
+def setup_bootstrap_intervals(workspace):
+    return lambda: bootstrap_intervals(workspace.data, workspace.elements, n_resamples=100)
+
+def setup_propagate_uncertainty(workspace):
+    calibration = fit_calibration(workspace.data, *calibration_inputs(workspace))
+    drift_models = fit_drift(standards_drift_data(workspace), workspace.elements)
+    return lambda: propagate_uncertainty(workspace.data, calibration, drift_models, n_realizations=100)
+
+def setup_interpolate(workspace, method="idw"):
+    # every row as a sample at a random location within the project grid
+    grid = project_grid()
+    left, width, _, top, _, height = grid["transform"]
+    rng = np.random.default_rng(workspace.seed)
+    coordinates = np.column_stack([rng.uniform(left, left + grid["columns"] * width, workspace.rows),
+                                   rng.uniform(top + grid["rows"] * height, top, workspace.rows)])
+    values = workspace.data[workspace.elements].to_numpy(dtype=float)
+    return lambda: interpolate(coordinates, values, grid, method)
+
+def setup_interpolate_kriging(workspace):
+    return setup_interpolate(workspace, method="kriging")
+
+def setup_multivariate_update(workspace):
+    # update a model fitted on the first half of the data with the second half
+    half = len(workspace.data) // 2
+    model = fit_model(workspace.data.iloc[:half], workspace.elements, model_path=False)
+    return lambda: model.partial_fit(workspace.data.iloc[half:])
+
+def setup_multivariate_project(workspace):
+    model = fit_model(workspace.data, workspace.elements, model_path=False)
+    return lambda: model.project(workspace.data)
+
+def setup_read_export(workspace):
+    path = find_exports(workspace.write_files() / "raw" / "XRF_data")[0]
+    return lambda: read_export(path)
+
+def setup_read_exports(workspace):
+    directory = workspace.write_files() / "raw" / "XRF_data"
+    return lambda: read_exports(directory)
+
+def setup_read_exports_cached(workspace):
+    directory = workspace.write_files() / "raw" / "XRF_data"
+    cache_directory = workspace.directory / "benchmark_ingest_cache"
+    read_exports(directory, incremental=True, cache_directory=cache_directory) # fill the cache
+    return lambda: read_exports(directory, incremental=True, cache_directory=cache_directory)
+
+def setup_histogram(workspace, binning=None):
+    box = interactive_histogram(histogram_button_info(workspace), workspace.data, "Concentration (ppm)", "No. of samples",
+                                binning=binning)
+    return widget_changes(box, filter_changes(workspace))
+
+def setup_histogram_binned(workspace):
+    return setup_histogram(workspace, binning="log")
+
+def setup_violin(workspace):
+    box = interactive_violin(histogram_button_info(workspace), workspace.data, "Concentration (ppm)")
+    return widget_changes(box, filter_changes(workspace))
+
+def setup_regression_plot(workspace):
+    drift_data = standards_drift_data(workspace)
+    model_results = regression_results(fit_drift(drift_data, workspace.elements), drift_data)
+    box = interactive_linear_regression_plot({"data": {"name": "Elements", "columns": workspace.elements}}, model_results,
+                                             "Dates", "Concentration (ppm)", "Drift", lazy=True)
+    return widget_changes(box, cycle((0, element) for element in workspace.elements))
+
+def setup_stage(name):
+    def setup(workspace):
+        workspace.write_files()
+        if name == "xrf_cleaning":
+            # time a cold run, without the parsed exports cached by the previous run
+            return lambda: (shutil.rmtree(workspace.directory / "xrf_ingest_cache", ignore_errors=True),
+                            workspace.run_stage(name))
+        return lambda: workspace.run_stage(name)
+
+    return setup
+
+benchmarks = {"get_elements":                       setup_get_elements,
+              "dixon_test":                         setup_dixon_test,
+              "dixon_test_batch":                   setup_dixon_test_batch,
+              "detect_outliers_Dixons_Q":           setup_detect_outliers,
+              "remove_outliers":                    setup_remove_outliers,
+              "fit_drift":                          setup_fit_drift,
+              "screen_standards":                   setup_screen_standards,
+              "fit_calibration":                    setup_fit_calibration,
+              "calibrate+apply_detection_limits":   setup_calibrate,
+              "duplicate_precision":                setup_duplicate_precision,
+              "correlation_matrix":                 setup_correlation_matrix,
+              "bootstrap_intervals":                setup_bootstrap_intervals,
+              "propagate_uncertainty":              setup_propagate_uncertainty,
+              "interpolate (idw)":                  setup_interpolate,
+              "interpolate (kriging)":              setup_interpolate_kriging,
+              "multivariate partial_fit":           setup_multivariate_update,
+              "multivariate project":               setup_multivariate_project,
+              "read_export":                        setup_read_export,
+              "read_exports":                       setup_read_exports,
+              "read_exports (incremental, cached)": setup_read_exports_cached,
+              "interactive_histogram response":     setup_histogram,
+              "interactive_histogram response (binned)":            setup_histogram_binned,
+              "interactive_violin response":                        setup_violin,
+              "interactive_linear_regression_plot response (lazy)": setup_regression_plot}
+benchmarks.update({"stage: " + name: setup_stage(name) for name in pipeline.stages})
+
+# slow benchmarks are run once (plus the traced run)
+single_run = ("read_exports", "stage: ")
+
+def environment():
+    # description of the machine and library versions, stored with the results
+    import scipy
+    import sklearn
+
+    return {"python":    platform.python_version(),
+            "platform":  platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "numpy":     np.__version__,
+            "pandas":    pd.__version__,
+            "scipy":     scipy.__version__,
+            "sklearn":   sklearn.__version__}
+
+def run_benchmarks(sizes=None, only=None, repeat=3, memory=True, seed=0, directory=None, verbose=True):
+    """
+    Run benchmarks at each size.
+
+    Keyword arguments:
+        sizes = Numbers of analyses (rows) of synthetic data (10^3, 10^4, 10^5 and 10^6 by default).
+        only = Names (or parts of names) of the benchmarks to run (all by default).
+        repeat = Number of timed runs of fast benchmarks; reading exports and pipeline stages are run once.
+        memory = Whether to measure peak memory with an additional traced run.
+        seed = Seed of the synthetic data.
+        directory = Directory for the synthetic files (a temporary directory, removed afterwards, by default).
+
+    Returns a dict of the environment, the arguments and a list of results, one per benchmark and size
+    ("benchmark", "rows", "seconds", "mean_seconds", "repeat", "peak_memory_mb", or "error" if it failed).
+    """
+    sizes = sizes or default_sizes
+    names = [name for name in benchmarks if not only or any(part in name for part in only)]
+    results = []
+
+    for rows in sizes:
+        with tempfile.TemporaryDirectory(dir=directory) as workspace_directory:
+            workspace = Workspace(rows, workspace_directory, seed)
+
+            for name in names:
+                result = {"benchmark": name, "rows": rows}
+                try:
+                    function = benchmarks[name](workspace)
+                    result.update(measure(function, 1 if name.startswith(single_run) else repeat, memory))
+                except Exception as error: # record the failure and carry on with the other benchmarks
+                    result["error"] = f"{type(error).__name__}: {error}"
+                results.append(result)
+
+                if verbose:
+                    print(format_result(result), flush=True)
+
+    return {"created":     datetime.now().isoformat(timespec="seconds"),
+            "environment": environment(),
+            "seed":        seed,
+            "sizes":       list(sizes),
+            "results":     results}
+
+def format_result(result):
+    if "error" in result:
+        return f"{result['benchmark']:<52} {result['rows']:>9,}  error: {result['error']}"
+
+    memory = f"{result['peak_memory_mb']:>10.1f} MiB" if "peak_memory_mb" in result else ""
+
+    return f"{result['benchmark']:<52} {result['rows']:>9,} {result['seconds']:>10.4f} s{memory}"
+
+def save_results(results, path=None):
+    if path is None:
+        path = default_output_directory / f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json"
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, "w") as json_file:
+        json.dump(results, json_file, indent=4)
+
+    return path
+
+def load_results(path):
+    with open(path) as json_file:
+        return json.load(json_file)
+
+def compare(baseline, current):
+    """
+    Compare two sets of results (dicts returned by `run_benchmarks` or paths of saved results).
+
+    Returns a DataFrame indexed by benchmark and rows with the time and peak memory of each run and their
+    ratio (current / baseline; above 1 is slower or larger).
+    """
+    tables = []
+    for results in [baseline, current]:
+        results = load_results(results) if isinstance(results, (str, Path)) else results
+        table = pd.DataFrame(results["results"]).set_index(["benchmark", "rows"])
+        tables.append(table.reindex(columns=["seconds", "peak_memory_mb"]))
+
+    comparison = tables[0].join(tables[1], how="inner", lsuffix="_baseline", rsuffix="_current")
+    comparison["seconds_ratio"] = comparison["seconds_current"] / comparison["seconds_baseline"]
+    comparison["memory_ratio"] = comparison["peak_memory_mb_current"] / comparison["peak_memory_mb_baseline"]
+
+    return comparison
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog="python -m source.benchmark", description="Benchmark the analysis on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes, help="numbers of rows of synthetic data")
+    parser.add_argument("--only", nargs="+", help="names (or parts of names) of benchmarks to run: " + ", ".join(benchmarks))
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of fast benchmarks")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure peak memory")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--output", help="path of the results (default: benchmarks/benchmark-<time>.json)")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    arguments = parser.parse_args(arguments)
+
+    results = run_benchmarks(arguments.sizes, arguments.only, arguments.repeat, not arguments.no_memory, arguments.seed)
+    print(f"results written to {save_results(results, arguments.output)}")
+
+    if arguments.compare:
+        with pd.option_context("display.width", 200, "display.max_rows", None):
+            print(compare(arguments.compare, results).round(3))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import numpy as np
+import pandas as pd
+
+from source.get_elements import get_elements
+from source.instrumentation import instrumented
+
+@instrumented
+def clean_srm_data(srm_data):
+    """
+    Clean certified values of standard reference materials (SRMs).
+
+    Sample IDs are made lowercase, analytes reduced to their element symbol ("Ag, Silver (ppm)" -> "Ag"),
+    values below the certified detection limit ("< 0.10") replaced with half the limit and flagged in a
+    "Censored" column, and wt.% converted to ppm.
+    """
+    srm_data = srm_data.drop(columns=["1SD", "95% Confidence Low", "95% Confidence High"], errors="ignore")
+    srm_data = srm_data.copy()
+
+    srm_data["Sample ID"] = srm_data["Sample ID"].str.lower()
+    srm_data["Analyte"] = srm_data["Analyte"].str.split(",", n=1).str[0]
+
+    # clean certified value; replace BDL with half value
+    cert_val = srm_data["Certified Value"].astype(str).str.strip()
+    srm_data["Censored"] = cert_val.str.startswith("<").to_numpy()
+    cert_val = pd.to_numeric(cert_val.str.lstrip("< "), errors="coerce")
+    srm_data["Certified Value"] = np.where(srm_data["Censored"], cert_val / 2, cert_val)
+
+    # clean units; convert wt.% to ppm
+    srm_data["Units"] = srm_data["Units"].str.lstrip("(").str.rstrip(")")
+    wt_percent = (srm_data["Units"] == "wt.%").to_numpy()
+    srm_data.loc[wt_percent, "Certified Value"] = srm_data.loc[wt_percent, "Certified Value"] * 1e4
+    srm_data.loc[wt_percent, "Units"] = "ppm"
+
+    return srm_data
+
+@instrumented
+def screen_standards(xrf_data, elements, outlier_stddev_cutoff=5):
+    """
+    Flag standard measurements that are unsuitable for calibration of an element.
+
+    A standard measurement is flagged if it falls outside the range of the element's concentrations
+    across all non-standards and is more than `outlier_stddev_cutoff` standard deviations from their
+    mean. The statistics of the non-standards are computed once per element and every standard
+    measurement is compared with them at once (NaN values are ignored).
+
+    Returns a list of {"Sample ID", "Session", "Element"} records, ready for `save_outliers`/`remove_outliers`.
+    """
+    standard_rows = (xrf_data["qaqc_type"] == "standard").to_numpy()
+    non_standards = xrf_data.loc[~standard_rows, elements].to_numpy(dtype=float)
+    standards = xrf_data.loc[standard_rows, elements].to_numpy(dtype=float)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        low, high = np.nanmin(non_standards, axis=0), np.nanmax(non_standards, axis=0)
+        mean, std = np.nanmean(non_standards, axis=0), np.nanstd(non_standards, axis=0)
+
+        # (standard measurements x elements)
+        outside_range = (standards < low) | (standards > high)
+        z = (standards - mean) / std
+        flagged = outside_range & (np.abs(z) > outlier_stddev_cutoff)
+
+    rows, columns = np.nonzero(flagged)
+    records = pd.DataFrame({"Sample ID": xrf_data.loc[standard_rows, "sample_id"].to_numpy()[rows],
+                            "Session":   xrf_data.loc[standard_rows, "date"].to_numpy()[rows],
+                            "Element":   np.asarray(elements, dtype=object)[columns]})
+
+    return records.drop_duplicates().to_dict("records")
+
+@instrumented
+def srm_training_data(xrf_data, srm_data, elements):
+    # measured (XRF) and certified (SRM) concentrations of each standard for each element, in long format
+    standards = xrf_data.loc[xrf_data["qaqc_type"] == "standard", ["sample_id"] + list(elements)]
+    standards = standards.reset_index().melt(id_vars=["index", "sample_id"], var_name="element", value_name="measured")
+    standards = standards.dropna(subset=["measured"])
+
+    srm = srm_data[["Sample ID", "Analyte", "Certified Value"]].drop_duplicates(["Sample ID", "Analyte"])
+    training_data = standards.merge(srm, how="inner", left_on=["sample_id", "element"], right_on=["Sample ID", "Analyte"])
+    training_data = training_data.rename(columns={"Certified Value": "certified"})
+
+    return training_data[["index", "sample_id", "element", "certified", "measured"]].sort_values(["element", "index"])
+
+@instrumented
+def fit_calibration(xrf_data, srm_data, elements, detection_limit_sigma=3):
+    """
+    Fit a linear regression of measured on certified concentration for all elements at once.
+
+    Returns a DataFrame indexed by element with the regression ("slope", "intercept", "rvalue",
+    "intercept_stderr", "n"), its inverse ("slope_inv", "intercept_inv"; true concentration from
+    measured concentration) and the "detection_limit" (in true concentration, from the intercept
+    plus `detection_limit_sigma` standard errors), for every element with training data.
+
+    "fitted" is False for elements whose certified or measured values are all equal (e.g., Cd and Se, which
+    have the same certified value in every SRM): their slope is zero or can't be fitted, so their inverse and
+    detection limit are NaN, and `calibrate` sets their values to NaN.
+    """
+    training_data = srm_training_data(xrf_data, srm_data, elements)
+    x = training_data["certified"].to_numpy(dtype=float)
+    y = training_data["measured"].to_numpy(dtype=float)
+
+    # sums per element in one grouped reduction
+    sums = pd.DataFrame({"element": training_data["element"].to_numpy(),
+                         "n": 1, "x": x, "y": y, "xx": x * x, "xy": x * y, "yy": y * y})
+    sums = sums.groupby("element").sum().reindex([element for element in elements if element in set(sums["element"])])
+
+    n = sums["n"].to_numpy(dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean, y_mean = sums["x"] / n, sums["y"] / n
+        ssxm = sums["xx"] / n - x_mean ** 2
+        ssym = sums["yy"] / n - y_mean ** 2
+        ssxym = sums["xy"] / n - x_mean * y_mean
+
+        # equal values can leave a spread of rounding error instead of zero
+        ssxm = ssxm.mask(ssxm <= 1e-12 * sums["xx"] / n, 0)
+        ssym = ssym.mask(ssym <= 1e-12 * sums["yy"] / n, 0)
+
+        slope = ssxym / ssxm
+        intercept = y_mean - slope * x_mean
+        rvalue = (ssxym / np.sqrt(ssxm * ssym)).clip(-1, 1)
+        slope_stderr = np.sqrt((1 - rvalue ** 2) * ssym / ssxm / (n - 2))
+        intercept_stderr = slope_stderr * np.sqrt(ssxm + x_mean ** 2)
+
+    calibration = pd.DataFrame({"slope":            slope,
+                                "intercept":        intercept,
+                                "rvalue":           rvalue,
+                                "intercept_stderr": intercept_stderr,
+                                "n":                n.astype(int)})
+    calibration.index.name = "element"
+
+    # only use calibration curve if meaningful; invert so that measured concentration is the independent variable
+    calibration["fitted"] = np.isfinite(calibration["slope"]) & (calibration["slope"] != 0)
+    slope = calibration["slope"].where(calibration["fitted"])
+    calibration["slope_inv"] = slope ** -1
+    calibration["intercept_inv"] = -calibration["intercept"] / slope
+    calibration["detection_limit"] = calibration["slope_inv"] * \
+                                     (calibration["intercept"] + detection_limit_sigma * calibration["intercept_stderr"]) + \
+                                     calibration["intercept_inv"]
+
+    return calibration
+
+def calibrate_values(values, calibration):
+    # true concentrations from measured ones (... x calibrated elements, in the order of calibration's index)
+    return values * calibration["slope_inv"].to_numpy() + calibration["intercept_inv"].to_numpy()
+
+@instrumented
+def calibrate(xrf_data, calibration):
+    # apply inverted calibration curves to all non-standards, for all calibrated elements at once (elements
+    # without a fitted curve become NaN)
+    xrf_data = xrf_data.copy()
+    elements = list(calibration.index)
+    rows = (xrf_data["qaqc_type"] != "standard").to_numpy()
+
+    xrf_data.loc[rows, elements] = calibrate_values(xrf_data.loc[rows, elements].to_numpy(dtype=float), calibration)
+
+    return xrf_data
+
+@instrumented
+def calibration_results(xrf_data, srm_data, calibration):
+    """
+    Training data and calibrated non-standard concentrations of each element in calibration, as a dict of
+    "x_train" (certified), "y_train" (measured), "rvalue", "x_predict" (measured) and "y_predict" (true) per
+    element, for `interactive_linear_regression_calibration_plot`. xrf_data are the data before `calibrate`.
+    """
+    training_data = dict(tuple(srm_training_data(xrf_data, srm_data, list(calibration.index)).groupby("element")))
+    non_standards = xrf_data[xrf_data["qaqc_type"] != "standard"]
+
+    results = {}
+    for element in calibration.index:
+        element_data = training_data[element]
+        x_predict = non_standards[element].dropna().to_numpy(dtype=float)
+        results[element] = {"x_train":   element_data["certified"].to_numpy(dtype=float),
+                            "y_train":   element_data["measured"].to_numpy(dtype=float),
+                            "rvalue":    calibration.loc[element, "rvalue"],
+                            "x_predict": x_predict,
+                            "y_predict": calibrate_values(x_predict, calibration.loc[[element]])}
+
+    return results
+
+@instrumented
+def apply_detection_limits(data, calibration):
+    """
+    Censor values below the detection limit of each calibrated element.
+
+    Returns the data, with censored values set to the detection limit (the columns stay float), and a
+    boolean DataFrame (rows x calibrated elements) that is True where a value is below the detection limit.
+    Missing values, and values of elements without a detection limit (no fitted curve), are not censored.
+    """
+    data = data.copy()
+    elements = list(calibration.index)
+    limits = calibration["detection_limit"].to_numpy()
+
+    values = data[elements].to_numpy(dtype=float)
+    censored = values < limits
+    data[elements] = np.where(censored, limits, values)
+
+    return data, pd.DataFrame(censored, index=data.index, columns=elements)
+
+@instrumented
+def half_detection_limit(data, censored):
+    # replace censored values (stored as the detection limit) with half the detection limit
+    data = data.copy()
+    elements = list(censored.columns)
+    data[elements] = data[elements].mask(censored, data[elements] / 2)
+
+    return data
+
+@instrumented
+def proportion_censored(censored):
+    # proportion of values below the detection limit for each element
+    return censored.mean(axis=0)
+
+@instrumented
+def censored_labels(data, censored, calibration):
+    # data with censored values written as "<detection limit" (e.g., for xrf_data_calib.csv)
+    data = data.astype({element: object for element in censored.columns})
+    for element in censored.columns:
+        data.loc[censored[element].to_numpy(), element] = f"<{calibration.loc[element, 'detection_limit']}"
+
+    return data
+
+@instrumented
+def evaluate_dataset(elements, calibration, proportion_bdl, analytical_precision, field_heterogeneity):
+    """
+    Rounded calibration, analytical precision and field heterogeneity statistics of each element, for
+    `discard_elements` (a section is empty if the statistics of an element weren't calculated).
+
+    Keyword arguments:
+        elements = Elements to evaluate.
+        calibration = Calibration curves from `fit_calibration`.
+        proportion_bdl = Proportion of values below the detection limit of each calibrated element.
+        analytical_precision, field_heterogeneity = Statistics from `duplicate_precision`.
+    """
+    evaluation = {element: {"calibration": {}, "analytical precision": {}, "field heterogeneity": {}} for element in elements}
+
+    for element in [element for element in calibration.index if element in evaluation]:
+        rvalue = float(calibration.loc[element, "rvalue"])
+        evaluation[element]["calibration"] = {"fitted":                          bool(calibration.loc[element, "fitted"]),
+                                              "Pearson correlation coefficient": round(rvalue, 3),
+                                              "R-squared":                       round(rvalue**2, 3),
+                                              "proportion_bdl":                  round(float(proportion_bdl[element]), 1)}
+
+    for element in [element for element in analytical_precision.keys() if element in evaluation]:
+        evaluation[element]["analytical precision"] = {"standard deviation": round(analytical_precision[element]["standard deviation"], 2),
+                                                       "rsd":                round(analytical_precision[element]["rsd"],                2),
+                                                       "number of pairs":    analytical_precision[element]["number of pairs"]}
+
+    for element in [element for element in field_heterogeneity.keys() if element in evaluation]:
+        evaluation[element]["field heterogeneity"] = {"heterogeneity":   round(field_heterogeneity[element]["heterogeneity"], 2),
+                                                      "number of pairs": field_heterogeneity[element]["number of pairs"]}
+
+    return evaluation
+
+@instrumented
+def discard_elements(evaluation):
+    # elements unsuitable for analysis, with the first criterion each one fails (from `evaluate_dataset`)
+    discard = {}
+    for element, statistics in evaluation.items():
+        calibration, precision = statistics["calibration"], statistics["analytical precision"]
+
+        if calibration == {}:
+            discard[element] = "srm values missing"
+        elif not calibration["fitted"]:
+            discard[element] = "no calibration curve (certified or measured values of srms are all equal)"
+        elif calibration["Pearson correlation coefficient"] <= 0:
+            discard[element] = "zero or negative correlation between reported and measured values of srms"
+        elif calibration["R-squared"] <= 0.3:
+            discard[element] = "proportion of variation in srm measured values explained by reported values is low"
+        elif precision == {}:
+            discard[element] = "insufficient data to calculate analytical precision"
+        elif precision["number of pairs"] < 9:
+            discard[element] = "insufficient usable data to calculate analytical precision"
+        elif precision["rsd"] > 30:
+            discard[element] = "RSD is too high"
+        elif calibration["proportion_bdl"] > 1/3:
+            discard[element] = "proportion of values below the detection limit is too high"
+
+    return discard
+
+@instrumented
+def analysis_ready(xrf_data, discard, evaluation):
+    """
+    Analysis-ready data: samples other than standards and sediments, without the discarded elements and the
+    QA/QC columns, with each element rounded to one order of magnitude below its analytical standard deviation.
+    """
+    data = xrf_data[(xrf_data["qaqc_type"] != "standard") & (xrf_data["sample_type"] != "sediment")]
+    data = data.drop(columns=list(discard.keys()) + ["date", "group", "sample_type", "qaqc_type"])
+
+    for element in get_elements(data.columns):
+        precision = evaluation[element]["analytical precision"]["standard deviation"]
+        precision_oom = np.floor(np.log10(precision)) - 1
+        data[element] = np.round(data[element] / 10**precision_oom) * 10**precision_oom
+
+    return data
@@ -0,0 +1,200 @@
+"""
+Declarative cleaning of categorical fields, and the sample registry the stages join against.
+
+Cleaning rules are a dict of rule type -> columns:
+
+    "lowercase" = Columns whose text values are lowercased (other values, e.g. numbers, are kept).
+    "strip"     = Column -> characters stripped from the start of its values, in turn (e.g. ["ns", "0"]
+                  turns "ns010" into "10"); non-missing values are converted to text.
+    "replace"   = Column -> {value: replacement} (applied after lowercasing and stripping).
+    "ids"       = Column -> prefixes of IDs whose case is kept; other IDs are lowercased (see `normalize_ids`).
+
+The rules of a column are applied in one pass over its distinct values, as vectorized string operations,
+and the results are mapped back to the rows through the column's factorization, so the cost depends on the
+number of distinct values rather than rows.
+"""
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+interim_directory = repository / "data" / "interim"
+default_registry_path = interim_directory / "sample_registry.parquet"
+
+# rules of notebooks/field_data_cleaning.ipynb
+field_rules = {"lowercase": ["Weather", "Type", "Type Sed", "Land use", "Disturbance", "Comments", "lineNS", "lineEW"],
+               "strip":     {"lineNS": ["ns", "0"], "lineEW": ["ew", "0"]}, # line prefixes and leading zeros
+               "replace":   {"Duplicate": {"No": np.nan, "Yes": np.nan}, # no information beyond the sample ID
+                             "Land use":  {"forested": "forest"}}}
+
+# field and standard sample IDs (e.g. "GR1-001", "TE2-W10") keep their case; reference material IDs
+# (e.g. "OREAS 24b") are lowercased to match between the XRF exports and the sample processing log
+sample_id_prefixes = ("GR", "TE")
+
+def normalize_ids(ids, keep_case=sample_id_prefixes):
+    # IDs as text, lowercased unless they start with one of the prefixes in keep_case (missing IDs are kept)
+    ids = pd.Series(ids, dtype=object)
+    text = ids[ids.notna()].astype(str)
+    text = text.where(text.str.startswith(tuple(keep_case)), text.str.lower())
+
+    return text.reindex(ids.index)
+
+def column_rules(rules):
+    # rules by column: {column: [(rule type, argument), ...]} in the order they are applied
+    by_column = {}
+    for column in rules.get("lowercase", []):
+        by_column.setdefault(column, []).append(("lowercase", None))
+    for column, characters in rules.get("strip", {}).items():
+        by_column.setdefault(column, []).append(("strip", characters))
+    for column, replacements in rules.get("replace", {}).items():
+        by_column.setdefault(column, []).append(("replace", replacements))
+    for column, keep_case in rules.get("ids", {}).items():
+        by_column.setdefault(column, []).append(("ids", keep_case))
+
+    return by_column
+
+def apply_to_values(values, rules):
+    # apply a column's rules to its distinct (non-missing) values
+    values = pd.Series(values, dtype=object)
+    for rule, argument in rules:
+        if rule == "lowercase":
+            lowered = values.str.lower()
+            values = lowered.where(lowered.notna(), values) # non-text values are kept
+        elif rule == "strip":
+            text = values[values.notna()].astype(str)
+            for characters in argument:
+                text = text.str.lstrip(characters)
+            values = text.reindex(values.index)
+        elif rule == "replace":
+            values = values.replace(argument)
+        elif rule == "ids":
+            values = normalize_ids(values, argument)
+        else:
+            raise ValueError(f"Unknown cleaning rule: {rule}")
+
+    return values.to_numpy(dtype=object)
+
+@instrumented
+def apply_rules(data, rules):
+    # copy of data with the cleaning rules applied (see the module docstring for the format of rules)
+    data = data.copy()
+    for column, rules_of_column in column_rules(rules).items():
+        codes, uniques = pd.factorize(data[column], use_na_sentinel=True)
+        cleaned = apply_to_values(uniques, rules_of_column)
+        data[column] = np.where(codes >= 0, cleaned[codes], np.nan) if len(cleaned) else data[column]
+
+    return data
+
+@instrumented
+def clean_field_data(data, rules=None):
+    # field data cleaned with the rules of the field data cleaning notebook (or other rules)
+    return apply_rules(data, field_rules if rules is None else rules)
+
+def read_field_data(path):
+    # field data with only empty cells missing: pandas reads "None" (e.g., no disturbance) as missing by default
+    return pd.read_excel(path, keep_default_na=False, na_values=[""])
+
+@instrumented
+def read_processing_log(path):
+    """
+    The sheets of sample_processing_log.xlsx (read from a single open of the workbook), without empty rows:
+    "lab_processing" (processing steps of each sample), "samples" (sample and QA/QC types) and
+    "person_dictionary" (the group of each person).
+    """
+    with pd.ExcelFile(path) as workbook:
+        sheets = pd.read_excel(workbook, sheet_name=["lab_processing", "samples", "person_dictionary"])
+
+    return {"lab_processing":    sheets["lab_processing"].dropna(subset=["sample_id"]),
+            "samples":           sheets["samples"].dropna(subset=["sample_id"]),
+            "person_dictionary": sheets["person_dictionary"].dropna(subset=["person_id"])}
+
+def warn_duplicates(entries, source):
+    # warn about sample IDs with more than one entry, saying which have entries that differ
+    duplicates = entries[entries["sample_id"].duplicated(keep=False)]
+    if duplicates.empty:
+        return
+
+    differ = duplicates.groupby("sample_id", sort=False).nunique(dropna=False).gt(1).any(axis=1)
+    ids = [f"{sample_id} ({'entries differ' if different else 'identical entries'})" for sample_id, different in differ.items()]
+    warnings.warn(f"{source} have more than one entry for sample IDs {', '.join(ids)}; the first entry of each is "
+                  "kept in the sample registry", stacklevel=4)
+
+@instrumented
+def sample_registry(processing_log, field_data=None):
+    """
+    One row per sample, indexed by normalized sample ID (see `normalize_ids`): the sample's "sample_type",
+    "qaqc_type" and "comments" from the processing log and, if field data are given, its field data columns
+    (e.g. "UTM-EW", "UTM-NS", "Group", "Land use"). Samples in only one of the sources are included.
+
+    A sample ID should have one entry in each source. The first entry of a duplicated sample ID is kept, with
+    a warning listing the duplicated IDs and whether their entries differ (e.g., GR1-001 has two field data
+    entries with different coordinates).
+    """
+    samples = processing_log["samples"].rename(columns={"sample_type_1": "sample_type"})
+    registry = samples[["sample_id", "sample_type", "qaqc_type", "comments"]].copy()
+    registry["sample_id"] = normalize_ids(registry["sample_id"])
+    warn_duplicates(registry, "The sample processing log's samples")
+    registry = registry.drop_duplicates("sample_id").set_index("sample_id")
+
+    if field_data is not None:
+        field_data = field_data.drop(columns=["Unnamed: 0", "wkt_geom"], errors="ignore").copy()
+        field_data["sample_id"] = normalize_ids(field_data.pop("SampleID"))
+        field_data = field_data.dropna(subset=["sample_id"])
+        warn_duplicates(field_data, "The field data")
+        field_data = field_data.drop_duplicates("sample_id").set_index("sample_id")
+        registry = registry.join(field_data, how="outer", sort=False)
+
+    return registry
+
+@instrumented
+def analysis_log(processing_log, process="xrf analysis"):
+    """
+    Entries of the sample processing log for a process (one per analysis), with their "date", the "group"
+    of the person who did it, the sample's "sample_type" and "qaqc_type" (from the sample registry) and the
+    combined log and sample comments. Sample IDs are normalized (see `normalize_ids`).
+    """
+    log = processing_log["lab_processing"]
+
+    # drop duplicate analysis log entry
+    log = log[log["analysis_order_index"] != 39].copy()
+
+    log["date"] = pd.to_datetime(log["time_entered"], format="%m-%d-%Y %H:%M:%S.%f").dt.date
+    log["analysis_order_index"] = log["analysis_order_index"].astype("int32")
+    log = log[log["process"] == process]
+
+    # group of the person who did the analysis
+    groups = processing_log["person_dictionary"].set_index("person_id")["group"]
+    log = log[log["person_1"].isin(groups.index)]
+    log["group"] = groups.reindex(log["person_1"]).to_numpy()
+
+    # sample and QA/QC type of the sample
+    log["sample_id"] = normalize_ids(log["sample_id"])
+    log = log.join(sample_registry(processing_log), on="sample_id", how="inner", rsuffix="_sample")
+
+    # combine comments from the log and the sample list
+    log["comments"] = log["comments"].fillna("").astype("str") + log.pop("comments_sample").fillna("").astype("str")
+
+    return log[["analysis_order_index", "sample_id", "date", "group", "sample_type", "qaqc_type", "comments"]]
+
+@instrumented
+def join_registry(data, registry, columns=None, id_column="sample_id", how="left"):
+    # data with registry columns joined on (normalized) sample ID, through the registry's index
+    registry = registry if columns is None else registry[list(columns)]
+    joined = data.assign(registry_id=normalize_ids(data[id_column]).to_numpy()).join(registry, on="registry_id", how=how)
+
+    return joined.drop(columns="registry_id")
+
+def write_registry(registry, path=None):
+    # save the registry as Parquet (sample IDs as the index)
+    path = Path(path or default_registry_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    registry.to_parquet(path)
+
+    return path
+
+def read_registry(path=None):
+    return pd.read_parquet(Path(path or default_registry_path))
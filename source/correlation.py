@@ -0,0 +1,190 @@
+"""
+Correlation matrices of element concentrations with matrix operations: Pearson correlation (on raw, log or
+centred log-ratio data) and proportionality, with p-values and bootstrap confidence intervals.
+
+Missing values are handled pairwise, as in pandas' `corr`: the correlation of two elements uses the samples
+in which both were measured. All pairs are computed at once from products of the (masked) data matrix.
+"""
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from source.get_elements import get_elements
+from source.instrumentation import instrumented
+
+transforms = [None, "log", "clr"]
+methods = ["pearson", "proportionality"]
+
+def nan_mean(values, axis):
+    # mean of the finite values along axis (NaN, without a warning, where there are none)
+    measured = np.isfinite(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(measured, values, 0.0).sum(axis=axis, keepdims=True) / measured.sum(axis=axis, keepdims=True)
+
+def transform_values(values, transform=None):
+    """
+    Transform a samples x elements array: None (raw values), "log" (log10) or "clr" (centred log-ratio:
+    natural log minus the mean log of the sample's measured elements). Non-finite results (e.g., the log
+    of zero) are treated as missing.
+    """
+    if transform not in transforms:
+        raise ValueError(f"Unknown transform: {transform} (expected one of {transforms})")
+
+    values = np.array(values, dtype=float)
+    if transform is None:
+        return values
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values = np.log10(values) if transform == "log" else np.log(values)
+    values[~np.isfinite(values)] = np.nan
+    if transform == "clr":
+        values = values - nan_mean(values, axis=1)
+
+    return values
+
+def pairwise_moments(values, weights=None):
+    """
+    Pairwise-complete moments of the columns of values, for all pairs of columns at once.
+
+    With M the mask of measured values and X the (column-centred) values with missing ones set to zero,
+    the number of samples, sums, sums of squares and cross products of each pair over the samples where
+    both are measured are M'M, X'M, (X^2)'M and X'X. Weights (e.g., bootstrap counts) weight each sample.
+
+    Returns the number of samples, the covariance and the variance of either column, for each pair
+    (population moments, i.e. ddof=0, which cancel out of correlations).
+    """
+    measured = np.isfinite(values)
+    centred = np.where(measured, values - nan_mean(values, axis=0), 0.0) # centring avoids cancellation in the sums
+    weights = np.ones(values.shape[0]) if weights is None else weights
+    weighted_values = centred * weights[:, None]
+
+    if measured.all():
+        # no missing values: every pair uses all samples, and only X'X needs a matrix product
+        counts = np.full((values.shape[1], values.shape[1]), weights.sum())
+        sums = np.broadcast_to(weighted_values.sum(axis=0)[:, None], counts.shape)
+        squares = np.broadcast_to((weighted_values * centred).sum(axis=0)[:, None], counts.shape)
+    else:
+        mask = measured.astype(float)
+        counts = mask.T @ (mask * weights[:, None])
+        sums = weighted_values.T @ mask # sums[i, j]: sum of column i over samples where j is measured
+        squares = (weighted_values * centred).T @ mask
+    products = weighted_values.T @ centred
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        covariance = products / counts - means * means.T
+        variance = squares / counts - means**2
+
+    return counts, covariance, variance, variance.T
+
+def correlation_values(values, method="pearson", weights=None):
+    # correlation coefficients and numbers of samples of all pairs of columns of a transformed array
+    if method not in methods:
+        raise ValueError(f"Unknown method: {method} (expected one of {methods})")
+
+    counts, covariance, variance_i, variance_j = pairwise_moments(values, weights)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if method == "pearson":
+            coefficients = covariance / np.sqrt(variance_i * variance_j)
+        else:
+            # proportionality (rho) = 1 - var(x_i - x_j) / (var(x_i) + var(x_j))
+            coefficients = 2 * covariance / (variance_i + variance_j)
+
+    return np.clip(coefficients, -1, 1), counts
+
+def p_values(coefficients, counts):
+    # two-sided p-values of Pearson correlation coefficients (Student's t with n - 2 degrees of freedom)
+    freedom = counts - 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = coefficients * np.sqrt(freedom / (1 - coefficients**2))
+        p = 2 * stats.t.sf(np.abs(t), freedom)
+
+    return np.where(freedom > 0, p, np.nan)
+
+def mask_triangle(matrix, triangle="lower"):
+    """
+    Keep one triangle of a square DataFrame: "lower" or "upper" (strict, without the diagonal) or None
+    (the full matrix). The rest is set to NaN.
+    """
+    if triangle is None:
+        return matrix
+    if triangle not in ["lower", "upper"]:
+        raise ValueError(f"Unknown triangle: {triangle}")
+
+    keep = np.tri(matrix.shape[0], k=-1, dtype=bool)
+
+    return matrix.where(keep if triangle == "lower" else keep.T)
+
+def to_frame(matrix, elements, triangle):
+    return mask_triangle(pd.DataFrame(matrix, index=elements, columns=elements), triangle)
+
+@instrumented
+def correlation_matrix(data, elements=None, transform=None, method="pearson", triangle="lower"):
+    """
+    Correlation matrix of elements, and the p-value of each coefficient.
+
+    Keyword arguments:
+        data = DataFrame with element concentration columns.
+        elements = Element columns (all elements in data by default).
+        transform = None, "log" or "clr" (centred log-ratio, for compositional data); see `transform_values`.
+        method = "pearson" or "proportionality" (rho, usually with transform="clr"; it has no p-values,
+                 which are NaN).
+        triangle = Triangle of the matrices kept ("lower", "upper" or None for the full matrices).
+
+    Returns the correlation and p-value DataFrames (elements x elements). Pearson coefficients and p-values
+    match pandas' `corr` and scipy's `pearsonr` on the pairwise-complete samples.
+    """
+    elements = get_elements(data.columns) if elements is None else list(elements)
+    values = transform_values(data[elements].to_numpy(dtype=float), transform)
+
+    coefficients, counts = correlation_values(values, method)
+    p = p_values(coefficients, counts) if method == "pearson" else np.full(coefficients.shape, np.nan)
+
+    return to_frame(coefficients, elements, triangle), to_frame(p, elements, triangle)
+
+def bootstrap_chunk(values, method, n_resamples, seed_sequence):
+    # correlation coefficients of n_resamples bootstrap resamples of the rows of values
+    rng = np.random.default_rng(seed_sequence)
+    n_samples = values.shape[0]
+    coefficients = np.empty((n_resamples, values.shape[1], values.shape[1]))
+    for i in range(n_resamples):
+        # a resample is the original samples weighted by the number of times each is drawn
+        weights = np.bincount(rng.integers(0, n_samples, n_samples), minlength=n_samples).astype(float)
+        coefficients[i] = correlation_values(values, method, weights)[0]
+
+    return coefficients
+
+@instrumented
+def bootstrap_intervals(data, elements=None, transform=None, method="pearson", n_resamples=1000, confidence=0.95,
+                        seed=0, processes=None, chunk_size=50, triangle="lower"):
+    """
+    Percentile bootstrap confidence intervals of the correlation coefficients.
+
+    Resamples are drawn in chunks of chunk_size, each with its own random stream spawned from seed, and the
+    chunks are computed in a process pool (processes=1 computes them in this process), so the intervals
+    depend on seed but not on the number of processes. Other keyword arguments are as in `correlation_matrix`.
+
+    Returns the lower and upper bound DataFrames.
+    """
+    elements = get_elements(data.columns) if elements is None else list(elements)
+    values = transform_values(data[elements].to_numpy(dtype=float), transform)
+
+    chunks = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunks))
+    arguments = [[values] * len(chunks), [method] * len(chunks), chunks, seed_sequences]
+    if processes == 1 or len(chunks) <= 1:
+        resampled = list(map(bootstrap_chunk, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            resampled = list(executor.map(bootstrap_chunk, *arguments))
+
+    # resamples in which a pair has too few samples (NaN) are left out; the bounds are NaN if all are
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low, high = np.nanpercentile(np.concatenate(resampled), [100 * alpha, 100 * (1 - alpha)], axis=0)
+
+    return to_frame(low, elements, triangle), to_frame(high, elements, triangle)
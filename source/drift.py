@@ -0,0 +1,146 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+default_cache_directory = repository / "data" / "interim" / "drift_models"
+
+# fitted models, keyed by hash of the standards data they were fitted on
+model_cache = {}
+
+def to_ordinal(dates):
+    # dates (strings, datetime.date or datetime64) to proleptic Gregorian ordinals, in one step
+    days = pd.to_datetime(pd.Series(dates)).to_numpy().astype("datetime64[D]").astype("int64")
+    return days + 719163 # ordinal of 1970-01-01
+
+@instrumented
+def drift_differences(standards_data, elements, initial_date):
+    # difference of each standard measurement from the measurement of that standard on initial_date
+    dates = pd.to_datetime(standards_data["date"])
+    initial = dates == pd.to_datetime(initial_date)
+
+    initial_measurements = standards_data.loc[initial].drop_duplicates("sample_id").set_index("sample_id")[elements]
+
+    standards_drift_data = standards_data.loc[~initial].copy()
+    standards_drift_data[elements] = standards_drift_data[elements].to_numpy(dtype=float) - \
+                                     initial_measurements.reindex(standards_drift_data["sample_id"]).to_numpy(dtype=float)
+    standards_drift_data.reset_index(inplace=True)
+
+    return standards_drift_data
+
+@instrumented
+def fit_drift(data, elements, date_column="date"):
+    """
+    Fit a linear regression of each element on the ordinal date, for all elements at once.
+
+    NaN values are masked per element. Returns a DataFrame indexed by element with the columns
+    "slope", "intercept", "r_squared" and "n" (number of values fitted).
+    """
+    x = to_ordinal(data[date_column]).astype(float)
+    y = data[elements].to_numpy(dtype=float)
+    mask = ~np.isnan(y)
+    y = np.where(mask, y, 0)
+
+    # center dates for numerical stability (ordinals are ~7e5)
+    x_mean = x.mean() if x.size else 0
+    xc = np.where(mask, (x - x_mean)[:, None], 0)
+
+    # normal equations for every element in one pass
+    n = mask.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sx, sy = xc.sum(axis=0), y.sum(axis=0)
+        sxx, sxy, syy = (xc * xc).sum(axis=0), (xc * y).sum(axis=0), (y * y).sum(axis=0)
+
+        slope = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+        intercept_c = (sy - slope * sx) / n
+
+        ss_tot = syy - sy ** 2 / n
+        ss_res = ((y - (slope * xc + intercept_c)) ** 2 * mask).sum(axis=0)
+        r_squared = np.where(ss_tot > 0, 1 - ss_res / ss_tot, np.nan)
+
+    return pd.DataFrame({"slope":     slope,
+                         "intercept": intercept_c - slope * x_mean,
+                         "r_squared": r_squared,
+                         "n":         n},
+                        index=pd.Index(elements, name="element"))
+
+@instrumented
+def data_hash(data, elements, date_column="date"):
+    # hash of the standards data used for fitting
+    values = pd.util.hash_pandas_object(data[[date_column] + list(elements)].astype(str), index=False).to_numpy()
+    digest = hashlib.sha256(values.tobytes())
+    digest.update("\t".join(elements).encode())
+
+    return digest.hexdigest()
+
+@instrumented
+def fit_drift_cached(data, elements, date_column="date", cache_directory=None):
+    # fit_drift, reusing a model fitted on identical standards data (in-process, then on disk)
+    key = data_hash(data, elements, date_column)
+    if key in model_cache:
+        return model_cache[key]
+
+    cache_directory = Path(cache_directory or default_cache_directory)
+    path = cache_directory / (key + ".json")
+    if path.exists():
+        coefficients = pd.read_json(path, orient="index")
+        coefficients.index.name = "element"
+    else:
+        coefficients = fit_drift(data, elements, date_column)
+        cache_directory.mkdir(parents=True, exist_ok=True)
+        coefficients.to_json(path, orient="index", indent=4)
+
+    model_cache[key] = coefficients
+
+    return coefficients
+
+@instrumented
+def predict_drift(coefficients, dates, elements=None):
+    # drift (rows x elements) predicted by the fitted models for each date
+    elements = list(coefficients.index) if elements is None else elements
+    x = to_ordinal(dates).astype(float)[:, None]
+    drift = x * coefficients.loc[elements, "slope"].to_numpy() + coefficients.loc[elements, "intercept"].to_numpy()
+
+    return pd.DataFrame(drift, columns=elements)
+
+def corrected_elements(coefficients, columns, score_threshold=0.5):
+    # elements of columns whose drift model explains enough of the variance to be corrected
+    return [element for element in coefficients.index[coefficients["r_squared"] > score_threshold] if element in columns]
+
+@instrumented
+def apply_drift_correction(data, coefficients, score_threshold=0.5, date_column="date"):
+    # subtract the predicted drift from elements whose drift model explains enough of the variance
+    elements = corrected_elements(coefficients, data.columns, score_threshold)
+
+    data = data.copy()
+    if elements:
+        drift = predict_drift(coefficients, data[date_column], elements)
+        data[elements] = data[elements].to_numpy(dtype=float) - drift.to_numpy()
+
+    return data
+
+@instrumented
+def regression_results(coefficients, data, date_column="date"):
+    # model results per element in the form used by interactive_linear_regression_plot
+    reg = {}
+    x = to_ordinal(data[date_column])
+
+    for element in coefficients.index:
+        valid = data[element].notna().to_numpy()
+        slope, intercept, r_squared = coefficients.loc[element, ["slope", "intercept", "r_squared"]]
+
+        x_predict = np.unique(x[valid])[:, None]
+
+        reg[element] = {}
+        reg[element]["x_train"]   = x[valid][:, None]
+        reg[element]["y_train"]   = data.loc[valid, element]
+        reg[element]["score"]     = r_squared
+        reg[element]["rvalue"]    = np.sign(slope) * np.sqrt(r_squared)
+        reg[element]["x_predict"] = x_predict
+        reg[element]["y_predict"] = slope * x_predict.squeeze(axis=1) + intercept
+
+    return reg
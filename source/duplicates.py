@@ -0,0 +1,179 @@
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from source.instrumentation import instrumented
+from source.outliers import dixon_test_batch
+
+repository = Path(__file__).resolve().parents[1]
+interim_directory = repository / "data" / "interim"
+
+# QA/QC type and sample ID suffix of each kind of duplicate
+duplicate_types = {"lab":   ("lab duplicate",   "L"),
+                   "field": ("field duplicate", "F")}
+
+@instrumented
+def pair_duplicates(data, kind="lab"):
+    """
+    Pair duplicates with their parent samples in a single merge.
+
+    The parent ID of a duplicate is its sample ID without the duplicate suffix (e.g., "GR1-010L" -> "GR1-010");
+    the parent is the first row with that sample ID. Returns a DataFrame with the columns "parent_id",
+    "parent_position" and "duplicate_position" (integer row positions in `data`).
+    """
+    qaqc_type, suffix = duplicate_types[kind]
+    sample_ids = data["sample_id"].astype(str)
+
+    duplicates = pd.DataFrame({"parent_id":          sample_ids.str.replace(re.escape(suffix) + "$", "", regex=True).to_numpy(),
+                               "duplicate_position": np.arange(data.shape[0])})
+    duplicates = duplicates[(data["qaqc_type"] == qaqc_type).to_numpy()]
+
+    parents = pd.DataFrame({"parent_id":       sample_ids.to_numpy(),
+                            "parent_position": np.arange(data.shape[0])}).drop_duplicates("parent_id")
+
+    pairs = duplicates.merge(parents, how="inner", on="parent_id")
+
+    return pairs[["parent_id", "parent_position", "duplicate_position"]]
+
+@instrumented
+def pair_differences(data, elements, pairs, censored=None):
+    # parent minus duplicate concentration for each pair and element; censored values give NaN
+    values = data[elements].to_numpy(dtype=float)
+    if censored is not None:
+        values = np.where(censored.reindex(index=data.index, columns=elements, fill_value=False).to_numpy(), np.nan, values)
+
+    diffs = values[pairs["parent_position"].to_numpy()] - values[pairs["duplicate_position"].to_numpy()]
+
+    return pd.DataFrame(diffs, columns=elements, index=pairs["parent_id"].to_numpy())
+
+@instrumented
+def std_dev_from_pairs(diffs):
+    """
+    Standard deviation from duplicate pair differences (sqrt(sum(d^2) / 2n)) for all elements at once.
+
+    NaN differences are ignored; outlying differences are removed with Dixon's Q test (where there are
+    at least 3 pairs) first. Returns the standard deviation and number of pairs used for each element.
+    """
+    diffs = diffs.copy()
+
+    # remove outlying differences
+    outliers = dixon_test_batch(diffs.reset_index(drop=True), columns=list(diffs.columns), confidence_level=95)
+    values = np.array(diffs, dtype=float)
+    column_positions = diffs.columns.get_indexer(outliers["column"])
+    values[outliers["position"].to_numpy(), column_positions] = np.nan
+
+    n = (~np.isnan(values)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std_dev = np.sqrt(np.nansum(np.square(values), axis=0) / (2 * n))
+
+    return pd.Series(std_dev, index=diffs.columns), pd.Series(n, index=diffs.columns)
+
+@instrumented
+def non_standard_mean(data, elements):
+    # mean concentration of each element across all non-standards
+    return data.loc[data["qaqc_type"] != "standard", elements].astype(float).mean()
+
+@instrumented
+def average_duplicates(data, elements, pairs):
+    # replace each parent's values with the mean of the pair and drop the duplicates
+    data = data.copy()
+    values = np.array(data[elements], dtype=float)
+    parent_positions = pairs["parent_position"].to_numpy()
+    duplicate_positions = pairs["duplicate_position"].to_numpy()
+
+    values[parent_positions] = np.nanmean(np.stack([values[parent_positions], values[duplicate_positions]]), axis=0)
+    data[elements] = values
+
+    return data.drop(index=data.index[duplicate_positions])
+
+@instrumented
+def averaged_censored(censored, pairs, index):
+    # censored flags after `average_duplicates`: averaged parents are no longer censored and duplicates are dropped
+    censored = censored.copy()
+    censored.iloc[pairs["parent_position"].to_numpy()] = False
+
+    return censored.reindex(index=index, fill_value=False)
+
+@instrumented
+def analytical_precision(data, elements, censored=None, mean_data=None):
+    """
+    Analytical precision of each element from lab duplicate pairs.
+
+    Keyword arguments:
+        data = XRF data including lab duplicates and their parents.
+        censored = Boolean DataFrame flagging values below the detection limit (differences of these are ignored).
+        mean_data = Data from which the mean concentration of non-standards is calculated (defaults to `data`).
+
+    Returns a dict of "standard deviation", "number of pairs", "rsd" and "mean" per element, for elements with
+    at least one valid pair.
+    """
+    pairs = pair_duplicates(data, "lab")
+    diffs = pair_differences(data, elements, pairs, censored)
+    std_dev, n = std_dev_from_pairs(diffs)
+    mean = non_standard_mean(data if mean_data is None else mean_data, elements)
+    rsd = 100 * std_dev / mean
+
+    precision = {}
+    for element in elements:
+        if n[element] > 0: # ensure that there are >= 1 valid data values
+            precision[element] = {"standard deviation": float(std_dev[element]),
+                                  "number of pairs":    int(n[element]),
+                                  "rsd":                float(rsd[element]),
+                                  "mean":               float(mean[element])}
+
+    return precision
+
+@instrumented
+def field_heterogeneity(data, elements, analytical_precision, censored=None, mean_data=None):
+    """
+    Field heterogeneity of each element from field duplicate pairs: the standard deviation of the pairs less
+    the analytical standard deviation. Only calculated for elements with an analytical precision.
+    """
+    pairs = pair_duplicates(data, "field")
+    diffs = pair_differences(data, elements, pairs, censored)
+    std_dev, n = std_dev_from_pairs(diffs)
+    mean = non_standard_mean(data if mean_data is None else mean_data, elements)
+
+    heterogeneity = {}
+    for element in elements:
+        if n[element] > 0 and element in analytical_precision.keys():
+            value = float(std_dev[element]) - analytical_precision[element]["standard deviation"]
+            heterogeneity[element] = {"heterogeneity":          value,
+                                      "relative heterogeneity": 100 * value / float(mean[element]),
+                                      "number of pairs":        int(n[element])}
+
+    return heterogeneity
+
+@instrumented
+def duplicate_precision(data, elements, censored=None, output_directory=None):
+    """
+    Average lab duplicate pairs, then calculate analytical precision and field heterogeneity and write them to
+    analytical_precision.json and field_heterogeneity.json in output_directory (data/interim by default; nothing
+    is written if output_directory is False).
+
+    `data` should hold censored values already replaced (e.g., by `half_detection_limit`), with `censored`
+    flagging them so that they are left out of the pair differences.
+
+    Returns the data with lab duplicates averaged into their parents, the analytical precision and the field
+    heterogeneity.
+    """
+    lab_pairs = pair_duplicates(data, "lab")
+    lab_precision_data = data
+    data = average_duplicates(data, elements, lab_pairs)
+
+    precision = analytical_precision(lab_precision_data, elements, censored, mean_data=data)
+    if censored is not None:
+        censored = averaged_censored(censored, lab_pairs, data.index)
+    heterogeneity = field_heterogeneity(data, elements, precision, censored)
+
+    if output_directory is not False:
+        output_directory = Path(output_directory or interim_directory)
+        with open(output_directory / "analytical_precision.json", "w") as outfile:
+            json.dump(precision, outfile, indent=4)
+        with open(output_directory / "field_heterogeneity.json", "w") as outfile:
+            json.dump(heterogeneity, outfile, indent=4)
+
+    return data, precision, heterogeneity
@@ -1,11 +1,61 @@
-from mendeleev.fetch import fetch_table
+from functools import lru_cache
 
-def get_elements(candidate_list): 
+from source.instrumentation import instrumented
+
+# symbols of the elements in the periodic table (bundled so that no database lookup is needed)
+symbols = frozenset([
+    "H",                                                                                                  "He",
+    "Li", "Be",                                                                "B",  "C",  "N",  "O",  "F",  "Ne",
+    "Na", "Mg",                                                                "Al", "Si", "P",  "S",  "Cl", "Ar",
+    "K",  "Ca", "Sc", "Ti", "V",  "Cr", "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Ga", "Ge", "As", "Se", "Br", "Kr",
+    "Rb", "Sr", "Y",  "Zr", "Nb", "Mo", "Tc", "Ru", "Rh", "Pd", "Ag", "Cd", "In", "Sn", "Sb", "Te", "I",  "Xe",
+    "Cs", "Ba",       "Hf", "Ta", "W",  "Re", "Os", "Ir", "Pt", "Au", "Hg", "Tl", "Pb", "Bi", "Po", "At", "Rn",
+    "Fr", "Ra",       "Rf", "Db", "Sg", "Bh", "Hs", "Mt", "Ds", "Rg", "Cn", "Nh", "Fl", "Mc", "Lv", "Ts", "Og",
+    # lanthanides and actinides
+    "La", "Ce", "Pr", "Nd", "Pm", "Sm", "Eu", "Gd", "Tb", "Dy", "Ho", "Er", "Tm", "Yb", "Lu",
+    "Ac", "Th", "Pa", "U",  "Np", "Pu", "Am", "Cm", "Bk", "Cf", "Es", "Fm", "Md", "No", "Lr"
+    ])
+
+@lru_cache(maxsize=None)
+@instrumented
+def get_symbols(use_mendeleev=False):
+    # element symbols, cached for the life of the process; mendeleev is only imported if asked for
+    if use_mendeleev:
+        try:
+            from mendeleev.fetch import fetch_table
+        except ImportError:
+            return symbols
+        return frozenset(fetch_table('elements').symbol.to_list())
+
+    return symbols
+
+def split_analyte(column):
+    # split an analyte column name into its element symbol and suffix, e.g. "Fe +/-" -> ("Fe", "+/-")
+    column = str(column)
+    symbol, _, suffix = column.partition(" ")
+
+    return symbol, suffix.strip()
+
+@instrumented
+def get_elements(candidate_list, uncertainty=False, use_mendeleev=False):
     # elements in periodic table
-    ptable = fetch_table('elements').symbol.to_list()
+    ptable = get_symbols(use_mendeleev)
+
+    elements = set()
+    uncertainty_columns = {}
+    for candidate in candidate_list:
+        symbol, suffix = split_analyte(candidate)
+        if symbol in ptable:
+            if suffix == "":
+                elements.add(symbol)
+            elif suffix == "+/-":
+                uncertainty_columns[symbol] = candidate
 
-    elements = set(ptable) & set(candidate_list)
     elements = list(elements)
     elements.sort()
 
-    return elements # sorted list of elements in candidate_list
\ No newline at end of file
+    if uncertainty:
+        # pair each element with its uncertainty column (None if there isn't one)
+        return [(element, uncertainty_columns.get(element)) for element in elements]
+
+    return elements # sorted list of elements in candidate_list
@@ -0,0 +1,316 @@
+"""
+Interpolation of element concentrations onto the project grid (MSH_GIS/MapData/grid.shp), for maps.
+
+Concentrations at the sample locations (UTM coordinates of the field data, from the sample registry) are
+interpolated to the centres of raster cells covering the grid, by inverse distance weighting (IDW) of the
+nearest samples, found with a KD-tree, or by ordinary kriging with a spherical variogram fitted to each element. All elements are
+interpolated together, tile by tile (so memory is bounded by the tile size rather than the raster size),
+and tiles are interpolated in a process pool.
+
+Rasters are saved as a NumPy archive and as one GeoTIFF per element (float32, WGS 84 / UTM zone 18N), which
+QGIS opens directly.
+"""
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapefile
+from scipy.optimize import curve_fit
+from scipy.spatial import KDTree
+
+from source.cleaning import join_registry
+from source.get_elements import get_elements
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+grid_path = repository / "MSH_GIS" / "MapData" / "grid.shp"
+
+# EPSG code of WGS 84 / UTM zone 18N, the coordinate system of the MSH_GIS layers and field data
+epsg = 32618
+
+methods = ["idw", "kriging"]
+
+@instrumented
+def project_grid(resolution=20, path=None):
+    """
+    Raster covering the cells of the project grid layer.
+
+    Keyword arguments:
+        resolution = Raster cell size in metres (the grid layer's cells are 200 m).
+        path = Grid layer (MSH_GIS/MapData/grid.shp by default), with the bounds of each cell as attributes.
+
+    Returns a dict of the raster's "transform" (GDAL-style: x of the left edge, cell width, 0, y of the top
+    edge, 0, -cell height), "rows" and "columns".
+    """
+    with shapefile.Reader(str(path or grid_path)) as reader:
+        bounds = pd.DataFrame(reader.records(), columns=[field[0] for field in reader.fields[1:]])
+
+    left, right = bounds["left"].min(), bounds["right"].max()
+    bottom = bounds[["top", "bottom"]].min().min()
+    top = bounds[["top", "bottom"]].max().max()
+
+    columns = int(np.ceil((right - left) / resolution))
+    rows = int(np.ceil((top - bottom) / resolution))
+
+    return {"transform": (float(left), float(resolution), 0.0, float(top), 0.0, -float(resolution)),
+            "rows": rows, "columns": columns}
+
+def cell_centres(grid, start=0, stop=None):
+    # coordinates of the centres of cells start:stop of a raster, in row-major order (row 0 at the top)
+    left, width, _, top, _, height = grid["transform"]
+    cells = np.arange(start, grid["rows"] * grid["columns"] if stop is None else stop)
+    rows, columns = np.divmod(cells, grid["columns"])
+
+    return np.column_stack([left + (columns + 0.5) * width, top + (rows + 0.5) * height])
+
+@instrumented
+def sample_values(data, registry, elements=None, id_column="sample_id", x="UTM-EW", y="UTM-NS"):
+    """
+    Coordinates and element concentrations of samples, located through the sample registry (see
+    `source.cleaning.sample_registry`).
+
+    Samples without coordinates are dropped, and samples at the same location are averaged (kriging can't
+    use coincident points). Returns the coordinates (n x 2) and values (n x elements) arrays.
+    """
+    elements = get_elements(data.columns) if elements is None else list(elements)
+    located = join_registry(data[[id_column] + elements], registry, [x, y], id_column, how="inner").dropna(subset=[x, y])
+    located = located.groupby([x, y], sort=False)[elements].mean().reset_index()
+
+    return located[[x, y]].to_numpy(dtype=float), located[elements].to_numpy(dtype=float)
+
+def spherical(lag, nugget, sill, range_):
+    # spherical variogram model (sill is the partial sill, reached at distance range_)
+    ratio = np.minimum(lag / range_, 1)
+    return nugget + sill * (1.5 * ratio - 0.5 * ratio**3)
+
+@instrumented
+def fit_variograms(coordinates, values, n_lags=12, max_pairs_samples=1000, seed=0):
+    """
+    Spherical variogram (nugget, partial sill, range) of each element, fitted by least squares to the
+    empirical semivariogram up to half the largest sample distance.
+
+    The empirical semivariogram uses at most max_pairs_samples samples (drawn at random with seed) so that
+    the number of pairs stays bounded. Returns an elements x 3 array.
+    """
+    if len(coordinates) > max_pairs_samples:
+        chosen = np.random.default_rng(seed).choice(len(coordinates), max_pairs_samples, replace=False)
+        coordinates, values = coordinates[chosen], values[chosen]
+
+    first, second = np.triu_indices(len(coordinates), k=1)
+    distances = np.hypot(*(coordinates[first] - coordinates[second]).T)
+    edges = np.linspace(0, distances.max() / 2, n_lags + 1)
+    bins = np.digitize(distances, edges) - 1
+    in_range = bins < n_lags
+    first, second, bins = first[in_range], second[in_range], bins[in_range]
+    lags = (edges[:-1] + edges[1:]) / 2
+
+    parameters = np.full((values.shape[1], 3), np.nan)
+    for i in range(values.shape[1]):
+        # mean semivariance per distance bin (pairs with a missing value are left out)
+        half_squares = 0.5 * (values[first, i] - values[second, i])**2
+        measured = np.isfinite(half_squares)
+        counts = np.bincount(bins[measured], minlength=n_lags)
+        used = counts > 0
+        if used.sum() < 3:
+            continue
+        semivariance = np.bincount(bins[measured], half_squares[measured], n_lags)[used] / counts[used]
+
+        variance = np.nanvar(values[:, i])
+        guess = [0.1 * variance, variance, lags[-1] / 2]
+        try:
+            parameters[i] = curve_fit(spherical, lags[used], semivariance, p0=guess, sigma=1 / np.sqrt(counts[used]),
+                                      bounds=([0, 0, edges[1]], [np.inf, np.inf, edges[-1] * 2]))[0]
+        except RuntimeError: # no convergence: pure nugget at the sample variance
+            parameters[i] = [variance, 0, edges[1]]
+
+    return parameters
+
+def idw(coordinates, values, targets, neighbours=12, power=2):
+    """
+    Inverse distance weighted values at targets, from the nearest samples (for all elements at once).
+
+    Samples missing an element get zero weight for it. Targets on a sample take its value.
+    """
+    k = min(neighbours, len(coordinates))
+    distances, nearest = KDTree(coordinates).query(targets, k=k)
+    distances, nearest = distances.reshape(len(targets), k), nearest.reshape(len(targets), k)
+
+    neighbour_values = values[nearest] # targets x k x elements
+    with np.errstate(divide="ignore"):
+        weights = 1 / distances**power
+    exact = np.isinf(weights)
+    weights = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), weights)
+
+    measured = np.isfinite(neighbour_values)
+    weights = weights[:, :, None] * measured
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.einsum("tke,tke->te", weights, np.where(measured, neighbour_values, 0)) / weights.sum(axis=1)
+
+def ordinary_kriging(coordinates, values, targets, variograms, neighbours=12):
+    """
+    Ordinary kriging estimates at targets from the nearest samples. Each element has its own variogram; the
+    neighbours of each target are searched once for all elements measured in the same samples, and the
+    kriging systems of all targets are solved in one batch per element.
+    """
+    estimates = np.full((len(targets), values.shape[1]), np.nan)
+    measured = np.isfinite(values)
+    fitted = ~np.isnan(variograms).any(axis=1)
+    for pattern in np.unique(measured[:, fitted], axis=1).T:
+        group = np.flatnonzero(fitted & (measured == pattern[:, None]).all(axis=0))
+        if pattern.sum() < 2:
+            continue
+
+        points = coordinates[pattern]
+        k = min(neighbours, len(points))
+        distances, nearest = KDTree(points).query(targets, k=k)
+        distances, nearest = distances.reshape(len(targets), k), nearest.reshape(len(targets), k)
+        neighbour_points = points[nearest]
+        separations = np.linalg.norm(neighbour_points[:, :, None] - neighbour_points[:, None, :], axis=-1)
+
+        for i in group:
+            # (k + 1) x (k + 1) system per target: semivariances between neighbours (zero at zero lag, the
+            # nugget only applying between distinct points), bordered by the constraint that weights sum to 1
+            matrices = np.ones((len(targets), k + 1, k + 1))
+            matrices[:, :k, :k] = np.where(separations > 0, spherical(separations, *variograms[i]), 0)
+            matrices[:, k, k] = 0
+            right_hand_sides = np.ones((len(targets), k + 1))
+            right_hand_sides[:, :k] = np.where(distances > 0, spherical(distances, *variograms[i]), 0)
+
+            weights = np.linalg.solve(matrices, right_hand_sides[:, :, None])[:, :k, 0]
+            estimates[:, i] = np.einsum("tk,tk->t", weights, values[pattern, i][nearest])
+
+    return estimates
+
+def interpolate_tile(coordinates, values, grid, start, stop, method, neighbours, power, variograms):
+    # interpolated values (cells x elements) of cells start:stop of the raster
+    targets = cell_centres(grid, start, stop)
+    if method == "idw":
+        return idw(coordinates, values, targets, neighbours, power)
+
+    return ordinary_kriging(coordinates, values, targets, variograms, neighbours)
+
+@instrumented
+def interpolate(coordinates, values, grid, method="idw", neighbours=12, power=2, tile_cells=2**14, processes=None):
+    """
+    Interpolate sample values onto a raster.
+
+    Keyword arguments:
+        coordinates, values = Sample coordinates (n x 2) and values (n x elements), see `sample_values`.
+        grid = Raster definition, see `project_grid`.
+        method = "idw" or "kriging" (ordinary kriging with a spherical variogram per element).
+        neighbours = Number of nearest samples used for each cell.
+        power = Power of the inverse distance weights (IDW).
+        tile_cells = Number of cells interpolated together (bounds memory use).
+        processes = Number of processes interpolating tiles (1 interpolates them in this process).
+
+    Returns an elements x rows x columns float32 array.
+    """
+    if method not in methods:
+        raise ValueError(f"Unknown method: {method} (expected one of {methods})")
+
+    variograms = fit_variograms(coordinates, values) if method == "kriging" else None
+
+    n_cells = grid["rows"] * grid["columns"]
+    starts = list(range(0, n_cells, tile_cells))
+    stops = starts[1:] + [n_cells]
+    repeated = [[argument] * len(starts) for argument in [coordinates, values, grid]]
+    settings = [[argument] * len(starts) for argument in [method, neighbours, power, variograms]]
+
+    if processes == 1 or len(starts) <= 1:
+        tiles = list(map(interpolate_tile, *repeated, starts, stops, *settings))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            tiles = list(executor.map(interpolate_tile, *repeated, starts, stops, *settings))
+
+    rasters = np.concatenate(tiles).astype(np.float32)
+
+    return rasters.T.reshape(values.shape[1], grid["rows"], grid["columns"])
+
+def write_geotiff(raster, grid, path):
+    """
+    Write a 2D float32 raster to a GeoTIFF (uncompressed, a single strip, NaN as no data), georeferenced
+    by the grid's transform in WGS 84 / UTM zone 18N.
+    """
+    raster = np.ascontiguousarray(raster, dtype="<f4")
+    left, width, _, top, _, height = grid["transform"]
+    rows, columns = raster.shape
+
+    # TIFF tags: (tag, type, values); types 2 = ASCII, 3 = SHORT, 4 = LONG, 12 = DOUBLE
+    header_size = 8
+    geo_keys = [1, 1, 0, 3,         # GeoKeyDirectory version, revision, number of keys
+                1024, 0, 1, 1,      # GTModelType: projected
+                1025, 0, 1, 1,      # GTRasterType: pixel is area
+                3072, 0, 1, epsg]   # ProjectedCSType
+    tags = [(256, 4, [columns]), (257, 4, [rows]), (258, 3, [32]), (259, 3, [1]), (262, 3, [1]),
+            (273, 4, [header_size]), (277, 3, [1]), (278, 4, [rows]), (279, 4, [raster.nbytes]), (284, 3, [1]),
+            (339, 3, [3]), # sample format: IEEE floating point
+            (33550, 12, [width, -height, 0.0]), (33922, 12, [0.0, 0.0, 0.0, left, top, 0.0]),
+            (34735, 3, geo_keys), (42113, 2, b"nan\0")] # GDAL no data value
+
+    formats = {2: "s", 3: "H", 4: "I", 12: "d"}
+    ifd_offset = header_size + raster.nbytes
+    ifd_offset += ifd_offset % 2 # word alignment
+    data_offset = ifd_offset + 2 + 12 * len(tags) + 4
+
+    entries, extra = b"", b""
+    for tag, kind, tag_values in tags:
+        count = len(tag_values)
+        packed = struct.pack(f"<{count}s" if kind == 2 else f"<{count}{formats[kind]}", *([tag_values] if kind == 2 else tag_values))
+        if len(packed) <= 4:
+            value = packed.ljust(4, b"\0")
+        else:
+            value = struct.pack("<I", data_offset + len(extra))
+            extra += packed + b"\0" * (len(packed) % 2)
+        entries += struct.pack("<HHI", tag, kind, count) + value
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as tiff_file:
+        tiff_file.write(b"II*\0" + struct.pack("<I", ifd_offset))
+        tiff_file.write(raster.tobytes())
+        tiff_file.write(b"\0" * (ifd_offset - header_size - raster.nbytes))
+        tiff_file.write(struct.pack("<H", len(tags)) + entries + struct.pack("<I", 0) + extra)
+
+    return path
+
+@instrumented
+def write_rasters(rasters, elements, grid, output_path, geotiff_directory=None):
+    """
+    Save rasters (elements x rows x columns) to a NumPy archive (with the element names, transform and EPSG
+    code) and, if geotiff_directory is given, to <geotiff_directory>/<element>.tif.
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(output_path, rasters=rasters, elements=np.array(elements), transform=np.array(grid["transform"]),
+                        epsg=epsg)
+
+    if geotiff_directory is not None:
+        for element, raster in zip(elements, rasters):
+            write_geotiff(raster, grid, Path(geotiff_directory) / (element + ".tif"))
+
+    return output_path
+
+def read_rasters(path):
+    # rasters and element names, and the grid definition, saved by write_rasters
+    with np.load(path) as archive:
+        rasters = archive["rasters"]
+        grid = {"transform": tuple(archive["transform"].tolist()), "rows": rasters.shape[1], "columns": rasters.shape[2]}
+        return rasters, archive["elements"].tolist(), grid
+
+@instrumented
+def element_maps(data, registry, elements=None, method="idw", resolution=20, grid_path=None, neighbours=12, power=2,
+                 tile_cells=2**14, processes=None):
+    """
+    Maps of all elements (or the given ones) of analysis-ready data on the project grid, in one batch.
+
+    Returns the rasters (elements x rows x columns), the element names and the grid definition. See
+    `project_grid` and `interpolate` for the keyword arguments.
+    """
+    elements = get_elements(data.columns) if elements is None else list(elements)
+    coordinates, values = sample_values(data, registry, elements)
+    grid = project_grid(resolution, grid_path)
+    rasters = interpolate(coordinates, values, grid, method, neighbours, power, tile_cells, processes)
+
+    return rasters, elements, grid
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from source.get_elements import get_elements, get_symbols, split_analyte
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+
+# location of the XRF exports (one per session) and of the parsed-file cache used in incremental mode
+default_directory = repository / "data" / "raw" / "XRF_data"
+default_cache_directory = repository / "data" / "interim" / "xrf_ingest_cache"
+export_pattern = "ExportData-*.csv"
+
+@instrumented
+def find_exports(directory=None):
+    # sorted list of XRF export files in directory
+    directory = Path(directory or default_directory)
+
+    return sorted(directory.glob(export_pattern))
+
+def session_date(path):
+    # session date from file name, e.g. ExportData-10-06-2021.csv -> 2021-10-06
+    date = Path(path).stem.split("-", 1)[1]
+
+    return pd.to_datetime(date, format="%m-%d-%Y")
+
+@instrumented
+def read_export(path):
+    """
+    Read a single XRF export (UTF-16, tab separated) into a DataFrame.
+
+    Element and uncertainty ("+/-") columns are parsed as float32; a "date" column holding the session
+    date (taken from the file name) is added.
+    """
+    data = pd.read_csv(path, encoding="utf-16", sep="\t", skiprows=[1]) # skip empty row below header
+
+    analyte_columns = [column for column in data.columns if split_analyte(column)[0] in get_symbols()]
+    data[analyte_columns] = data[analyte_columns].apply(pd.to_numeric, errors="coerce").astype("float32")
+    data["date"] = session_date(path)
+
+    return data
+
+@instrumented
+def file_hash(path, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+@instrumented
+def parse_exports(paths, processes=None):
+    # decode and parse export files, in a process pool if there is more than one file
+    paths = list(paths)
+    if processes == 1 or len(paths) <= 1:
+        return [read_export(path) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(read_export, paths))
+
+@instrumented
+def read_exports(directory=None, incremental=False, cache_directory=None, processes=None):
+    """
+    Read all XRF exports in directory into a single DataFrame (one row per analysis).
+
+    Keyword arguments:
+        directory = Directory containing the ExportData-*.csv files.
+        incremental = If True, only parse files that are new or have changed since the last call;
+                      previously parsed files are loaded from the cache.
+        cache_directory = Location of the cache and its manifest (path, mtime, size and hash of each file).
+        processes = Number of worker processes used to parse files (1 to parse in this process).
+    """
+    paths = find_exports(directory)
+
+    if not incremental:
+        frames = parse_exports(paths, processes)
+
+    else:
+        cache_directory = Path(cache_directory or default_cache_directory)
+        cache_directory.mkdir(parents=True, exist_ok=True)
+        manifest_path = cache_directory / "manifest.json"
+
+        if manifest_path.exists():
+            with open(manifest_path) as json_file:
+                manifest = json.load(json_file)
+        else:
+            manifest = {}
+
+        # decide which files need parsing: unchanged mtime/size, or unchanged content, can be reused
+        updated_manifest = {}
+        to_parse = []
+        for path in paths:
+            key = str(path.resolve())
+            stat = path.stat()
+            entry = manifest.get(key)
+
+            if entry is not None and (cache_directory / entry["cache"]).exists():
+                if entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                    updated_manifest[key] = entry
+                    continue
+
+                digest = file_hash(path)
+                if digest == entry["hash"]:
+                    updated_manifest[key] = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+                    continue
+            else:
+                digest = file_hash(path)
+
+            updated_manifest[key] = {"mtime": stat.st_mtime_ns,
+                                     "size":  stat.st_size,
+                                     "hash":  digest,
+                                     "cache": digest + ".pkl"}
+            to_parse.append(path)
+
+        # parse new/changed files and cache them
+        for path, data in zip(to_parse, parse_exports(to_parse, processes)):
+            data.to_pickle(cache_directory / updated_manifest[str(path.resolve())]["cache"])
+
+        frames = [pd.read_pickle(cache_directory / updated_manifest[str(path.resolve())]["cache"]) for path in paths]
+
+        # write manifest atomically so a concurrent reader never sees a partial file
+        temporary_path = manifest_path.with_suffix(".tmp")
+        with open(temporary_path, "w") as json_file:
+            json.dump(updated_manifest, json_file, indent=4)
+        os.replace(temporary_path, manifest_path)
+
+    if not frames:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True) # combine sessions in a single copy
+
+@instrumented
+def uncertainty_pairs(data):
+    """
+    Split the analyte columns of data into element values and their uncertainties.
+
+    Returns the list of elements, and two float32 arrays (rows x elements) holding the values and the
+    uncertainties ("+/-" columns; NaN where an element has no uncertainty column).
+    """
+    pairs = get_elements(data.columns, uncertainty=True)
+    elements = [element for element, _ in pairs]
+
+    values = data[elements].to_numpy(dtype="float32")
+    errors = np.full(values.shape, np.nan, dtype="float32")
+    for i, (element, uncertainty_column) in enumerate(pairs):
+        if uncertainty_column is not None:
+            errors[:, i] = data[uncertainty_column].to_numpy(dtype="float32")
+
+    return elements, values, errors
@@ -0,0 +1,221 @@
+"""
+Opt-in instrumentation of the `source` functions: call counts, wall time, rows processed and memory.
+
+Functions are marked with the `instrumented` decorator. While instrumentation is off (the default) the
+decorator only adds a flag check to each call. It is switched on
+
+    - for a block of code, with the `instrument` context manager:
+
+          with instrument(memory=True, profile="qaqc.prof") as stats:
+              ...
+          print(report(stats))
+
+    - for a whole run, with the SOURCE_INSTRUMENTATION environment variable, a comma-separated list of
+      options: "timing" (or "1"), "memory" (allocated memory, with tracemalloc) and "profile" (cProfile).
+      A report is printed to stderr at exit, or written to the JSON file named by SOURCE_INSTRUMENTATION_REPORT;
+      cProfile and tracemalloc dumps are written next to it (or to the working directory).
+
+Times and memory are inclusive: a call's figures include those of the instrumented calls it makes.
+"""
+import atexit
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# whether calls are recorded, and options of the current instrumentation
+enabled = False
+options = {"memory": False}
+
+# statistics per function name: calls, seconds, rows, allocated bytes (net) and peak bytes
+stats = {}
+
+# tracemalloc peaks of the calls in progress, for nested calls (see `call`)
+memory_stack = []
+
+def count_rows(args, kwargs):
+    # rows of the first DataFrame, Series or array among the arguments (None if there is none)
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+            return len(value) if value.ndim else 1
+
+    return None
+
+def call(name, function, args, kwargs):
+    # call function, recording its wall time, rows and (if memory is traced) allocated and peak memory
+    trace_memory = options["memory"] and tracemalloc.is_tracing()
+    if trace_memory:
+        # tracemalloc has a single peak, which is reset for this call; the peak of the enclosing call so far
+        # is kept on the stack and combined with this call's when it returns
+        current, peak = tracemalloc.get_traced_memory()
+        if memory_stack:
+            memory_stack[-1][1] = max(memory_stack[-1][1], peak)
+        memory_stack.append([current, 0])
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        record = stats.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": 0, "allocated": 0, "peak": 0})
+        record["calls"] += 1
+        record["seconds"] += seconds
+        record["rows"] += count_rows(args, kwargs) or 0
+
+        if trace_memory:
+            after, peak = tracemalloc.get_traced_memory()
+            before, children_peak = memory_stack.pop()
+            peak = max(peak, children_peak)
+            record["allocated"] += after - before
+            record["peak"] = max(record["peak"], peak - before)
+            if memory_stack:
+                memory_stack[-1][1] = max(memory_stack[-1][1], peak)
+
+def instrumented(function=None, name=None):
+    """
+    Decorator recording calls of a function while instrumentation is on.
+
+    Keyword arguments:
+        name = Name under which calls are recorded (defaults to module.function, e.g.
+               "source.outliers.remove_outliers"; nested functions drop "<locals>").
+    """
+    def decorate(function):
+        key = name or f"{function.__module__}.{function.__qualname__.replace('<locals>.', '')}"
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            return call(key, function, args, kwargs)
+
+        return wrapper
+
+    return decorate if function is None else decorate(function)
+
+def merge(statistics, other):
+    # add the statistics of other to statistics
+    for name, record in other.items():
+        if name not in statistics:
+            statistics[name] = dict(record)
+            continue
+        for key in ["calls", "seconds", "rows", "allocated"]:
+            statistics[name][key] += record[key]
+        statistics[name]["peak"] = max(statistics[name]["peak"], record["peak"])
+
+def reset():
+    stats.clear()
+
+def report(statistics=None):
+    """
+    Statistics per instrumented function as a DataFrame sorted by total time: "calls", "seconds",
+    "seconds_per_call", "rows", and "allocated_mb" and "peak_mb" when memory was traced.
+    """
+    statistics = stats if statistics is None else statistics
+    table = pd.DataFrame.from_dict(statistics, orient="index",
+                                   columns=["calls", "seconds", "rows", "allocated", "peak"])
+    table.index.name = "function"
+    table["seconds_per_call"] = table["seconds"] / table["calls"]
+    table["allocated_mb"] = table.pop("allocated") / 2**20
+    table["peak_mb"] = table.pop("peak") / 2**20
+
+    return table[["calls", "seconds", "seconds_per_call", "rows", "allocated_mb", "peak_mb"]].sort_values("seconds", ascending=False)
+
+def write_report(path, statistics=None):
+    # write the statistics to a JSON file
+    path = Path(path)
+    with open(path, "w") as json_file:
+        json.dump(report(statistics).to_dict(orient="index"), json_file, indent=4)
+
+    return path
+
+@contextmanager
+def instrument(memory=False, profile=None, memory_dump=None, report_path=None):
+    """
+    Record calls of instrumented functions within a block.
+
+    Keyword arguments:
+        memory = Trace allocated memory with tracemalloc (slows down allocation-heavy code).
+        profile = Path of a cProfile dump of the block (readable with pstats or snakeviz).
+        memory_dump = Path of a tracemalloc snapshot taken at the end of the block (implies memory).
+        report_path = Path of a JSON report written at the end of the block.
+
+    Yields the statistics recorded in the block, per function name (see `report`).
+    """
+    global enabled
+    previous = enabled, dict(options), {name: dict(record) for name, record in stats.items()}
+    memory = memory or memory_dump is not None
+
+    for path in [profile, memory_dump, report_path]:
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile else None
+
+    stats.clear()
+    options["memory"] = memory
+    enabled = True
+    if profiler is not None:
+        profiler.enable()
+
+    block_stats = {}
+    try:
+        yield block_stats
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if memory_dump is not None:
+            tracemalloc.take_snapshot().dump(str(memory_dump))
+        if started_tracing:
+            tracemalloc.stop()
+
+        block_stats.update(stats)
+        if report_path is not None:
+            write_report(report_path, block_stats)
+
+        # restore the state of an enclosing block, which also counts the calls made in this one
+        enabled = previous[0]
+        options.update(previous[1])
+        stats.clear()
+        stats.update(previous[2])
+        if enabled:
+            merge(stats, block_stats)
+
+def enable_from_environment():
+    # switch on instrumentation for the whole run if SOURCE_INSTRUMENTATION is set
+    setting = os.environ.get("SOURCE_INSTRUMENTATION", "").strip().lower()
+    if setting in ["", "0", "false", "no", "off"]:
+        return
+
+    settings = {option.strip() for option in setting.split(",")}
+    report_path = os.environ.get("SOURCE_INSTRUMENTATION_REPORT")
+    dump_directory = Path(report_path).parent if report_path else Path.cwd()
+    run_name = f"source-{os.getpid()}"
+
+    block = instrument(memory="memory" in settings,
+                       profile=dump_directory / (run_name + ".prof") if "profile" in settings else None,
+                       memory_dump=dump_directory / (run_name + ".tracemalloc") if "memory" in settings else None,
+                       report_path=report_path)
+    run_stats = block.__enter__()
+
+    def finish():
+        block.__exit__(None, None, None)
+        if report_path is None:
+            with pd.option_context("display.width", 200, "display.max_rows", None):
+                print(report(run_stats).round(4), file=sys.stderr)
+
+    atexit.register(finish)
+
+enable_from_environment()
@@ -1,20 +1,95 @@
 import pandas as pd
+import numpy as np
+from functools import lru_cache
 from ipywidgets import widgets
 import plotly.graph_objects as go
 from datetime import datetime
-
-def interactive_histogram(button_info, data, x_axis_label, y_axis_label): 
+from source.instrumentation import instrumented
+
+class CategoryFilter: 
+    """
+    Precomputed row index for filtering data on category columns (e.g., session, group, QA/QC type). 
+
+    A boolean mask is built once for each value of each category column; a filter combination is the 
+    bitwise AND of one mask per filtered column. Filtered rows and filtered data columns are memoized 
+    per combination in bounded LRU caches.
+    """
+
+    def __init__(self, data, columns, maxsize=128): 
+        self.data = data
+        self.columns = columns
+        self.options = {} # unique values of each category column (in order of appearance)
+        self.masks = {}   # boolean mask of rows for each value of each category column
+
+        for column in columns: 
+            codes, uniques = pd.factorize(data[column])
+            self.options[column] = data[column].unique().tolist()
+            self.masks[column] = {value: codes == i for i, value in enumerate(uniques)}
+
+        self.rows = lru_cache(maxsize=maxsize)(self.get_rows)
+        self.values = lru_cache(maxsize=maxsize)(self.get_values)
+
+    def is_valid(self, column, value): 
+        # ensure that value is in the category column or "All" (i.e., don't filter) is selected
+        return value == "All" or value in self.options[column]
+
+    @instrumented
+    def get_rows(self, selection): 
+        # selection = tuple of button values, one per category column; returns indexes of selected rows
+        mask = np.ones(self.data.shape[0], dtype=bool)
+        for column, value in zip(self.columns, selection): 
+            if value != "All": 
+                mask &= self.masks[column].get(value, False)
+
+        return np.flatnonzero(mask)
+
+    @instrumented
+    def get_values(self, selection, data_column): 
+        return self.data[data_column].to_numpy()[self.rows(selection)]
+
+@instrumented
+def bin_edges(values, bins=30, scale="linear"): 
+    # fixed bin edges for a data column; log-spaced bins only cover the positive values
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if scale == "log": 
+        values = values[values > 0]
+
+    if values.size == 0: 
+        return np.linspace(0, 1, bins + 1) if scale == "linear" else np.geomspace(1, 10, bins + 1)
+
+    low, high = values.min(), values.max()
+    if scale == "log": 
+        if low == high: 
+            low, high = low / 2, high * 2
+        return np.geomspace(low, high, bins + 1)
+    else: 
+        if low == high: 
+            low, high = low - 0.5, high + 0.5
+        return np.linspace(low, high, bins + 1)
+
+@instrumented
+def interactive_histogram(button_info, data, x_axis_label, y_axis_label, binning=None, bins=30): 
+    """
+    Keyword arguments:
+        binning = None to send raw data to the browser (binned by plotly), or "linear"/"log" to bin the data 
+                  here with fixed linear/log-spaced bins per data column and send only the bin counts.
+        bins = Number of bins per data column when binning is "linear" or "log".
+    """
 
     # initialize dictionary to store buttons
     button_dict = {"categories": [], 
                 "data": None 
                 }
 
+    # index rows by category values once
+    category_filter = CategoryFilter(data, [button["column"] for button in button_info["categories"]])
+
     # create buttons filter on categories and store in dict         
     for button in button_info["categories"]: 
         widget = widgets.Dropdown(
             description=button["name"],
-            options=["All"] + data[button["column"]].unique().tolist()
+            options=["All"] + category_filter.options[button["column"]]
         )
         button_dict["categories"].append(widget)
 
@@ -28,11 +103,31 @@ def interactive_histogram(button_info, data, x_axis_label, y_axis_label):
     # create figure
     g = go.FigureWidget()
 
-    # create histogram traces for each data column
-    for col in button_info["data"]["columns"]: 
-        g.add_trace(
-            go.Histogram(x=data[col], opacity=0.75, name=col, marker_color="#7C002E") 
-        )
+    if binning is None: 
+        # create histogram traces for each data column
+        for col in button_info["data"]["columns"]: 
+            g.add_trace(
+                go.Histogram(x=data[col], opacity=0.75, name=col, marker_color="#7C002E") 
+            )
+    else: 
+        # fixed bins per data column; bin counts are memoized per filter combination
+        edges = {col: bin_edges(data[col], bins, binning) for col in button_info["data"]["columns"]}
+        centers = {col: np.sqrt(edge[:-1] * edge[1:]) if binning == "log" else (edge[:-1] + edge[1:]) / 2 
+                   for col, edge in edges.items()}
+
+        def get_counts(selection, col): 
+            return np.histogram(category_filter.values(selection, col), bins=edges[col])[0]
+        counts = lru_cache(maxsize=128)(get_counts)
+
+        # create bar traces of bin counts for each data column
+        all_selection = tuple("All" for button in button_info["categories"])
+        for col in button_info["data"]["columns"]: 
+            g.add_trace(
+                go.Bar(x=centers[col], y=counts(all_selection, col), opacity=0.75, name=col, marker_color="#7C002E") 
+            )
+        g.layout.bargap = 0
+        if binning == "log": 
+            g.layout.xaxis.type = "log"
 
     def validate(): # function to ensure that value delivered by button is in dataframe    
         validation_bool = []
@@ -40,10 +135,7 @@ def interactive_histogram(button_info, data, x_axis_label, y_axis_label):
         # cycle through each category filter button
         for info, button in zip(button_info["categories"], button_dict["categories"]): 
             # ensure that button option is in dataframe or "All" (i.e., don't filter) is selected
-            if button.value in data[info["column"]].unique() or button.value == "All": 
-                validation_bool.append(True) 
-            else: 
-                validation_bool.append(False) 
+            validation_bool.append(category_filter.is_valid(info["column"], button.value))
 
         # ensure that data column filter button option is in dataframe or "All" (i.e., don't filter) is selected
         if button_dict["data"].value in button_info["data"]["columns"]: 
@@ -57,42 +149,33 @@ def interactive_histogram(button_info, data, x_axis_label, y_axis_label):
         else:
             return False
 
+    # index of the trace currently shown (None until the first update, when all traces are visible)
+    state = {"visible": None}
+
+    @instrumented
     def response(change): # function to dictate data filtering update upon change
         if validate(): # if all button values are in dataframe
 
-            # get button names
-            button_names = [button.description for button in button_dict["categories"]]
-            # create dictionary to store list of booleans for filtering
-            filters = dict.fromkeys(button_names)
-
-            # cycle through filter category buttons and list of booleans to dict
-            for info, button in zip(button_info["categories"], button_dict["categories"]): 
-                
-                if button.value == "All": # don't filter
-                    filters[button.description] = pd.Series([True] * data.shape[0])
-                else: # filter based on button value
-                    filters[button.description] = data[info["column"]] == button.value
-
-            # get list of boolean values for each row filtering on category buttons; apply to dataframe
-            filters_df = pd.DataFrame({key: filters[key].to_list() for key in filters.keys()})
-            filter_list = filters_df.all(axis='columns').to_list()
-            temp_df = data[filter_list]
-            
-            # apply filter to each data column
-            x =  [None] * len(g.data)
-            for i, col in enumerate(button_info["data"]["columns"]):
-                x[i] = temp_df[col]
+            # filter combination selected by the category buttons
+            selection = tuple(button.value for button in button_dict["categories"])
 
-            # set visibility for each column/trace based on data filter button
-            visibilities = [False] * len(g.data) # initialize visibilities for traces (data columns)
-            visible_index = button_info["data"]["columns"].index(button_dict["data"].value) # get index for data button value
-            visibilities[visible_index] = True # set the visibility of that column/trace to visible
+            # get index for data button value
+            visible_index = button_info["data"]["columns"].index(button_dict["data"].value) 
 
-            # set data for histogram based on filtering from category buttons and data button
+            # set data for histogram based on filtering from category buttons; only the visible trace is updated
             with g.batch_update(): # required to update data
-                for i, visibility in enumerate(visibilities): 
-                    g.data[i].x = x[i]
-                    g.data[i].visible = visibility
+                if binning is None: 
+                    g.data[visible_index].x = category_filter.values(selection, button_dict["data"].value)
+                else: 
+                    g.data[visible_index].y = counts(selection, button_dict["data"].value)
+
+                if state["visible"] is None: 
+                    for i in range(len(g.data)): 
+                        g.data[i].visible = i == visible_index
+                elif state["visible"] != visible_index: 
+                    g.data[state["visible"]].visible = False
+                    g.data[visible_index].visible = True
+            state["visible"] = visible_index
 
     # label histogram
     g.layout.xaxis.title = x_axis_label
@@ -114,6 +197,7 @@ def interactive_histogram(button_info, data, x_axis_label, y_axis_label):
                         widgets.HBox(button_containers["2"]), 
                         g])
 
+@instrumented
 def interactive_violin(button_info, data, y_axis_label): 
 
     # initialize dictionary to store buttons
@@ -121,11 +205,14 @@ def interactive_violin(button_info, data, y_axis_label):
                 "data": None 
                 }
 
+    # index rows by category values once
+    category_filter = CategoryFilter(data, [button["column"] for button in button_info["categories"]])
+
     # create buttons filter on categories and store in dict         
     for button in button_info["categories"]: 
         widget = widgets.Dropdown(
             description=button["name"],
-            options=["All"] + data[button["column"]].unique().tolist()
+            options=["All"] + category_filter.options[button["column"]]
         )
         button_dict["categories"].append(widget)
 
@@ -153,10 +240,7 @@ def interactive_violin(button_info, data, y_axis_label):
         # cycle through each category filter button
         for info, button in zip(button_info["categories"], button_dict["categories"]): 
             # ensure that button option is in dataframe or "All" (i.e., don't filter) is selected
-            if button.value in data[info["column"]].unique() or button.value == "All": 
-                validation_bool.append(True) 
-            else: 
-                validation_bool.append(False) 
+            validation_bool.append(category_filter.is_valid(info["column"], button.value))
 
         # ensure that data column filter button option is in dataframe
         if button_dict["data"].value in button_info["data"]["columns"]: 
@@ -170,42 +254,30 @@ def interactive_violin(button_info, data, y_axis_label):
         else:
             return False
 
+    # index of the trace currently shown (None until the first update, when all traces are visible)
+    state = {"visible": None}
+
+    @instrumented
     def response(change): # function to dictate data filtering update upon change
         if validate(): # if all button values are in dataframe
 
-            # get button names
-            button_names = [button.description for button in button_dict["categories"]]
-            # create dictionary to store list of booleans for filtering
-            filters = dict.fromkeys(button_names)
-
-            # cycle through filter category buttons and list of booleans to dict
-            for info, button in zip(button_info["categories"], button_dict["categories"]): 
-                
-                if button.value == "All": # don't filter
-                    filters[button.description] = pd.Series([True] * data.shape[0])
-                else: # filter based on button value
-                    filters[button.description] = data[info["column"]] == button.value
-
-            # get list of boolean values for each row filtering on category buttons; apply to dataframe
-            filters_df = pd.DataFrame({key: filters[key].to_list() for key in filters.keys()})
-            filter_list = filters_df.all(axis='columns').to_list()
-            temp_df = data[filter_list]
-            
-            # apply filter to each data column
-            x =  [None] * len(g.data)
-            for i, col in enumerate(button_info["data"]["columns"]):
-                x[i] = temp_df[col]
+            # filter combination selected by the category buttons
+            selection = tuple(button.value for button in button_dict["categories"])
 
-            # set visibility for each column/trace based on data filter button
-            visibilities = [False] * len(g.data) # initialize visibilities for traces (data columns)
-            visible_index = button_info["data"]["columns"].index(button_dict["data"].value) # get index for data button value
-            visibilities[visible_index] = True # set the visibility of that column/trace to visible
+            # get index for data button value
+            visible_index = button_info["data"]["columns"].index(button_dict["data"].value) 
 
-            # set data for violin plot based on filtering from category buttons and data button
+            # set data for violin plot based on filtering from category buttons; only the visible trace is updated
             with g.batch_update(): # required to update data
-                for i, visibility in enumerate(visibilities): 
-                    g.data[i].y = x[i]
-                    g.data[i].visible = visibility
+                g.data[visible_index].y = category_filter.values(selection, button_dict["data"].value)
+
+                if state["visible"] is None: 
+                    for i in range(len(g.data)): 
+                        g.data[i].visible = i == visible_index
+                elif state["visible"] != visible_index: 
+                    g.data[state["visible"]].visible = False
+                    g.data[visible_index].visible = True
+            state["visible"] = visible_index
 
     # label violin plot
     g.layout.yaxis.title = y_axis_label
@@ -226,7 +298,19 @@ def interactive_violin(button_info, data, y_axis_label):
                         widgets.HBox(button_containers["2"]), 
                         g])
 
-def interactive_linear_regression_plot(button_info, model_results, x_axis_label, y_axis_label, title): 
+def ordinal_to_datetime(ordinals): 
+    # convert proleptic Gregorian ordinals (datetime.toordinal) to datetime64 in one step
+    ordinals = np.atleast_1d(np.asarray(ordinals).squeeze()).astype("int64")
+    return (ordinals - datetime(1970, 1, 1).toordinal()).astype("datetime64[D]")
+
+@instrumented
+def interactive_linear_regression_plot(button_info, model_results, x_axis_label, y_axis_label, title, lazy=False, max_traces=8): 
+    """
+    Keyword arguments:
+        lazy = If True, only build traces for the selected data column and swap them into a single pair 
+               of traces; otherwise build a pair of traces for every data column up front.
+        max_traces = Number of built trace pairs kept in memory when lazy is True.
+    """
 
     # initialize dictionary to store buttons
     button_dict = {"data": None }
@@ -241,24 +325,28 @@ def interactive_linear_regression_plot(button_info, model_results, x_axis_label,
     # create figure
     g = go.FigureWidget(layout_title_text=title)
 
-    # create histogram traces for each data column
-    for col in button_info["data"]["columns"]: 
+    def get_traces(col): # data and line of best fit for a data column
         r_squared = round(model_results[col]["rvalue"]**2, 3)
-        g.add_trace(
-            go.Scatter(x=[datetime.fromordinal(date) for date in model_results[col]["x_train"].squeeze()],
-                       y=model_results[col]["y_train"].squeeze(), 
-                       name="data",
-                       mode="markers"
-            )       
-        )        
-        g.add_trace(
-            go.Scatter(x=[datetime.fromordinal(date) for date in model_results[col]["x_predict"].squeeze()], 
-                       y=model_results[col]["y_predict"].squeeze(), 
-                       name=f"line of best fit (R squared = {r_squared})",
-                       mode="lines"
-            )       
-        )
-
+        return (dict(x=ordinal_to_datetime(model_results[col]["x_train"]),
+                     y=np.atleast_1d(np.asarray(model_results[col]["y_train"]).squeeze()), 
+                     name="data",
+                     mode="markers"), 
+                dict(x=ordinal_to_datetime(model_results[col]["x_predict"]), 
+                     y=np.atleast_1d(np.asarray(model_results[col]["y_predict"]).squeeze()), 
+                     name=f"line of best fit (R squared = {r_squared})",
+                     mode="lines"))
+
+    if lazy: 
+        # build traces on selection only; keep the most recently used ones
+        traces = lru_cache(maxsize=max_traces)(get_traces)
+        col = button_dict["data"].value
+        for trace in traces(col): 
+            g.add_trace(go.Scatter(**trace))
+    else: 
+        # create traces for each data column
+        for col in button_info["data"]["columns"]: 
+            for trace in get_traces(col): 
+                g.add_trace(go.Scatter(**trace))
 
     def validate(): # function to ensure that value delivered by button is in dataframe    
         validation_bool = []
@@ -275,9 +363,18 @@ def interactive_linear_regression_plot(button_info, model_results, x_axis_label,
         else:
             return False
 
+    @instrumented
     def response(change): # function to dictate data filtering update upon change
         if validate(): # if all button values are in dataframe
 
+            if lazy: 
+                # swap data of selected column into the pair of traces
+                with g.batch_update(): 
+                    for i, trace in enumerate(traces(button_dict["data"].value)): 
+                        g.data[i].update(trace)
+                    g.layout.xaxis.tickvals = g.data[1].x
+                return
+
             # set visibility for each column/trace based on data filter button
             visibilities = [False] * len(g.data) # initialize visibilities for traces (data columns)
             visible_index = button_info["data"]["columns"].index(button_dict["data"].value) * 2 # get index for data button value
@@ -293,7 +390,7 @@ def interactive_linear_regression_plot(button_info, model_results, x_axis_label,
     g.layout.xaxis.title = x_axis_label
     g.layout.yaxis.title = y_axis_label
 
-    g.layout.xaxis.tickvals = [datetime.fromordinal(date) for date in model_results[col]["x_predict"].squeeze()]
+    g.layout.xaxis.tickvals = ordinal_to_datetime(model_results[col]["x_predict"])
 
     # set each button to update according to button filtering
     button_dict["data"].observe(response, names="value")
@@ -301,7 +398,14 @@ def interactive_linear_regression_plot(button_info, model_results, x_axis_label,
     # display histogram   
     return widgets.VBox([widgets.HBox([button_dict["data"]]), g])
 
-def interactive_linear_regression_calibration_plot(button_info, model_results, x_axis_label, y_axis_label, title): 
+@instrumented
+def interactive_linear_regression_calibration_plot(button_info, model_results, x_axis_label, y_axis_label, title, lazy=False, max_traces=8): 
+    """
+    Keyword arguments:
+        lazy = If True, only build traces for the selected data column and swap them into a single pair 
+               of traces; otherwise build a pair of traces for every data column up front.
+        max_traces = Number of built trace pairs kept in memory when lazy is True.
+    """
 
     # initialize dictionary to store buttons
     button_dict = {"data": None }
@@ -316,24 +420,27 @@ def interactive_linear_regression_calibration_plot(button_info, model_results, x
     # create figure
     g = go.FigureWidget(layout_title_text=title)
 
-    # create histogram traces for each data column
-    for col in button_info["data"]["columns"]: 
+    def get_traces(col): # data and line of best fit for a data column
         r_squared = round(model_results[col]["rvalue"]**2, 3)
-        g.add_trace(
-            go.Scatter(x=model_results[col]["x_train"],
-                       y=model_results[col]["y_train"], 
-                       name="data",
-                       mode="markers"
-            )       
-        )        
-        g.add_trace(
-            go.Scatter(x=model_results[col]["y_predict"], 
-                       y=model_results[col]["x_predict"], 
-                       name=f"line of best fit (R squared = {r_squared})",
-                       mode="lines"
-            )       
-        )
-
+        return (dict(x=model_results[col]["x_train"],
+                     y=model_results[col]["y_train"], 
+                     name="data",
+                     mode="markers"), 
+                dict(x=model_results[col]["y_predict"], 
+                     y=model_results[col]["x_predict"], 
+                     name=f"line of best fit (R squared = {r_squared})",
+                     mode="lines"))
+
+    if lazy: 
+        # build traces on selection only; keep the most recently used ones
+        traces = lru_cache(maxsize=max_traces)(get_traces)
+        for trace in traces(button_dict["data"].value): 
+            g.add_trace(go.Scatter(**trace))
+    else: 
+        # create traces for each data column
+        for col in button_info["data"]["columns"]: 
+            for trace in get_traces(col): 
+                g.add_trace(go.Scatter(**trace))
 
     def validate(): # function to ensure that value delivered by button is in dataframe    
         validation_bool = []
@@ -350,9 +457,17 @@ def interactive_linear_regression_calibration_plot(button_info, model_results, x
         else:
             return False
 
+    @instrumented
     def response(change): # function to dictate data filtering update upon change
         if validate(): # if all button values are in dataframe
 
+            if lazy: 
+                # swap data of selected column into the pair of traces
+                with g.batch_update(): 
+                    for i, trace in enumerate(traces(button_dict["data"].value)): 
+                        g.data[i].update(trace)
+                return
+
             # set visibility for each column/trace based on data filter button
             visibilities = [False] * len(g.data) # initialize visibilities for traces (data columns)
             visible_index = button_info["data"]["columns"].index(button_dict["data"].value) * 2 # get index for data button value
@@ -372,4 +487,4 @@ def interactive_linear_regression_calibration_plot(button_info, model_results, x
     button_dict["data"].observe(response, names="value")
 
     # display histogram   
-    return widgets.VBox([widgets.HBox([button_dict["data"]]), g])
\ No newline at end of file
+    return widgets.VBox([widgets.HBox([button_dict["data"]]), g])
@@ -0,0 +1,251 @@
+"""
+Principal component analysis (and optional clustering) of the analysis-ready data that can be updated
+with new samples and reused to project them.
+
+The model keeps running sufficient statistics of the transformed data (count, mean and scatter matrix),
+merged exactly for each batch, so a partial fit with a new session gives the same components as a full
+fit on all the data seen so far. PCA of the standardized data is the eigendecomposition of their correlation
+matrix, which is derived from those statistics.
+
+Principal components are normalized to [-1, 1] by the extremes of the scores of all the samples seen. The scores
+of earlier samples change whenever the components do, so the model also keeps the transformed samples: each update
+recomputes the extremes under the new components and refits the clustering (MiniBatchKMeans) on the normalized
+scores of all the samples. A `partial_fit` thus gives the same normalization and clusters as a full `fit`, which
+reproduces the notebook's normalization exactly.
+"""
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy.stats import normaltest
+from sklearn.cluster import MiniBatchKMeans
+
+from source.get_elements import get_elements
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+default_model_path = repository / "data" / "interim" / "multivariate_model.joblib"
+
+@instrumented
+def select_log_transform(data, elements):
+    """
+    Elements whose distribution is closer to normal after a log10 transform.
+
+    D'Agostino and Pearson's normality test is run on every element column, raw and log-transformed, in two
+    vectorized calls; an element is log-transformed if the p-value of the raw data is lower. Returns a
+    boolean Series indexed by element.
+    """
+    values = data[elements].to_numpy(dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p_raw = normaltest(values, axis=0)[1]
+        p_log = normaltest(np.log10(values), axis=0)[1]
+
+    return pd.Series(p_raw < p_log, index=elements)
+
+def log_transform(values, log_columns):
+    # log10 of the columns flagged in log_columns, in one pass
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(log_columns, np.log10(values), values)
+
+def normalize(values, low, high):
+    # min-max normalization of each column to [-1, 1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 2 * (values - low) / (high - low) - 1
+
+class MultivariateModel:
+    """
+    Log transform selection, standardization, PCA and (optionally) k-means clustering of element data.
+
+    Keyword arguments:
+        elements = Element columns used by the model.
+        log_elements = Elements to log-transform; chosen with `select_log_transform` on the first batch if None.
+        n_clusters = Number of k-means clusters of the normalized principal components (no clustering if None).
+        random_state = Seed of the clustering.
+
+    Rows with a missing or non-finite (e.g., log of zero) value are left out of fitting and get NaN scores.
+    """
+
+    def __init__(self, elements, log_elements=None, n_clusters=None, random_state=0):
+        self.elements = list(elements)
+        self.log_elements = None if log_elements is None else pd.Series(self.elements, index=self.elements).isin(log_elements)
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+        self.reset()
+
+    def reset(self):
+        # forget everything fitted so far (the log transform selection is kept); running statistics of the transformed data
+        self.n_samples = 0
+        self.mean = np.zeros(len(self.elements))
+        self.scatter = np.zeros((len(self.elements), len(self.elements)))
+
+        # transformed samples seen, and the extremes of their principal component scores (for normalization to [-1, 1])
+        self.values = np.zeros((0, len(self.elements)))
+        self.score_min = None
+        self.score_max = None
+
+        self.clusterer = None
+
+    @property
+    def pc_names(self):
+        return ["PC" + str(i) for i in range(1, len(self.elements) + 1)]
+
+    def transformed(self, data):
+        # log-transformed element values, and the mask of complete rows
+        values = log_transform(data[self.elements].to_numpy(dtype=float), self.log_elements.to_numpy())
+
+        return values, np.isfinite(values).all(axis=1)
+
+    @instrumented
+    def partial_fit(self, data):
+        """
+        Update the model with a batch of samples (e.g., a new session).
+
+        The mean and scatter matrix of the batch are merged with the running ones (Chan et al.'s pairwise
+        update) and the components are recomputed from the updated correlation matrix. The score extremes and
+        clusters are then recomputed from the scores of all the samples seen under the new components.
+        """
+        if self.log_elements is None:
+            self.log_elements = select_log_transform(data, self.elements)
+
+        values, complete = self.transformed(data)
+        values = values[complete]
+        n_batch = values.shape[0]
+        if n_batch == 0:
+            return self
+
+        batch_mean = values.mean(axis=0)
+        deviations = values - batch_mean
+        batch_scatter = deviations.T @ deviations
+
+        n_total = self.n_samples + n_batch
+        delta = batch_mean - self.mean
+        self.scatter = self.scatter + batch_scatter + np.outer(delta, delta) * self.n_samples * n_batch / n_total
+        self.mean = self.mean + delta * n_batch / n_total
+        self.n_samples = n_total
+
+        self.values = np.concatenate([self.values, values])
+
+        self.fit_components()
+
+        # scores of earlier samples change with the components: recompute the extremes and refit the clusters
+        scores = self.scores(self.values)
+        self.score_min, self.score_max = scores.min(axis=0), scores.max(axis=0)
+
+        if self.n_clusters is not None and self.n_samples >= self.n_clusters:
+            self.clusterer = MiniBatchKMeans(n_clusters=self.n_clusters, n_init=3, random_state=self.random_state)
+            self.clusterer.fit(normalize(scores, self.score_min, self.score_max))
+
+        return self
+
+    @instrumented
+    def fit(self, data):
+        # fit the model from scratch on data
+        self.reset()
+
+        return self.partial_fit(data)
+
+    def fit_components(self):
+        # principal components of the standardized data: eigenvectors of the correlation matrix
+        self.std = np.sqrt(np.diag(self.scatter) / self.n_samples) # population standard deviation (ddof=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlation = self.scatter / self.n_samples / np.outer(self.std, self.std)
+        correlation = np.nan_to_num(correlation)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+        order = np.argsort(eigenvalues)[::-1]
+        eigenvalues, components = eigenvalues[order], eigenvectors[:, order].T
+
+        # sign convention of scikit-learn: the largest loading of each component is positive
+        signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])
+        self.components = components * signs[:, None]
+        self.explained_variance = np.clip(eigenvalues, 0, None) * self.n_samples / max(self.n_samples - 1, 1)
+        self.explained_variance_ratio = np.clip(eigenvalues, 0, None) / np.clip(eigenvalues, 0, None).sum()
+
+    def scores(self, values):
+        # principal component scores of transformed values
+        with np.errstate(invalid="ignore", divide="ignore"):
+            standardized = np.nan_to_num((values - self.mean) / self.std)
+
+        return standardized @ self.components.T
+
+    @instrumented
+    def project(self, data, normalized=True):
+        """
+        Project samples onto the principal components, without refitting.
+
+        Returns a copy of data with the element columns replaced by PC1, PC2, ... (in place of the first
+        element column onwards, as in data_pca_norm.csv), normalized to [-1, 1] by the extremes of the
+        fitted scores if normalized is True, and a "cluster" column if the model clusters.
+        """
+        values, complete = self.transformed(data)
+        scores = np.full(values.shape, np.nan)
+        scores[complete] = self.scores(values[complete])
+        normalized_scores = normalize(scores, self.score_min, self.score_max)
+
+        # PC1, PC2, ... in order, whatever the order of the element columns in data
+        position = data.columns.get_indexer(self.elements).min()
+        others = data.drop(columns=self.elements)
+        components = pd.DataFrame(normalized_scores if normalized else scores, index=data.index, columns=self.pc_names)
+        projected = pd.concat([others.iloc[:, :position], components, others.iloc[:, position:]], axis=1)
+
+        # cluster of each sample (-1 where it has no scores)
+        if self.clusterer is not None:
+            clusters = np.full(len(data), -1)
+            if complete.any():
+                clusters[complete] = self.clusterer.predict(normalized_scores[complete])
+            projected["cluster"] = clusters
+
+        return projected
+
+    def loadings(self, normalized=False):
+        # loadings (elements x PCs), optionally min-max normalized to [-1, 1] per PC
+        loadings = pd.DataFrame(self.components.T, index=pd.Index(self.elements, name="element"), columns=self.pc_names)
+        if normalized:
+            loadings = 2 * (loadings - loadings.min()) / (loadings.max() - loadings.min()) - 1
+
+        return loadings
+
+    def save(self, path=None):
+        path = Path(path or default_model_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        joblib.dump(self, path)
+
+        return path
+
+def load_model(path=None):
+    return joblib.load(Path(path or default_model_path))
+
+@instrumented
+def fit_model(data, elements=None, n_clusters=None, model_path=None):
+    """
+    Fit a model on data (elements default to all element columns) and save it to model_path
+    (data/interim/multivariate_model.joblib by default; not saved if model_path is False).
+    """
+    elements = get_elements(data.columns) if elements is None else elements
+    model = MultivariateModel(elements, n_clusters=n_clusters).fit(data)
+    if model_path is not False:
+        model.save(model_path)
+
+    return model
+
+@instrumented
+def update_model(data, model_path=None):
+    # update a saved model with new samples and save it again
+    model = load_model(model_path)
+    model.partial_fit(data)
+    model.save(model_path)
+
+    return model
+
+@instrumented
+def project_samples(input_path, output_path, model_path=None):
+    """
+    Normalized principal components of the samples in input_path (a CSV laid out like data_analysis_ready.csv)
+    under a saved model, written to output_path like data_pca_norm.csv. The model is not refitted.
+    """
+    data = pd.read_csv(input_path)
+    data_pca = load_model(model_path).project(data)
+    data_pca.to_csv(output_path)
+
+    return data_pca
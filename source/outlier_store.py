@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+from source.instrumentation import instrumented
+
+# location of the outlier store; override with the OUTLIER_STORE environment variable or `set_outlier_store`
+default_path = Path(__file__).resolve().parents[1] / "data" / "interim" / "outliers.sqlite"
+
+# record keys for each outlier scope
+scopes = {"sample":                 ["Sample ID"],
+          "sample_session":         ["Sample ID", "Session"],
+          "sample_session_element": ["Sample ID", "Session", "Element"]
+          }
+
+class OutlierStore:
+    """
+    Append-only outlier store backed by SQLite.
+
+    Each outlier is one row keyed on (scope, sample, session, element); a unique index on the key makes
+    repeated saves of the same outlier a no-op. Writers take SQLite's file lock for the duration of a
+    write (`BEGIN IMMEDIATE`), so concurrent notebook/worker runs queue up instead of losing writes.
+    Reads are cached in-process and only re-queried when the database has changed.
+
+    The store itself isn't tracked by git; `outliers.json` in the same directory is its tracked copy. Records
+    in the JSON are merged into the store when it is opened (e.g., outliers pulled from others, or all of
+    them in a fresh clone), and `save_outliers` exports the store back to the JSON after each save.
+    """
+
+    def __init__(self, path=None, timeout=60):
+        self.path = Path(path or os.environ.get("OUTLIER_STORE", default_path))
+        self.timeout = timeout
+        self.connection = None
+        self.pid = None
+        self.cache = None
+        self.cache_version = None
+
+    def connect(self):
+        # SQLite connections must not be shared with forked worker processes; reconnect in the child
+        if self.connection is not None and self.pid != os.getpid():
+            self.connection = None
+            self.cache = None
+
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self.pid = os.getpid()
+
+            with self.transaction() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS outliers ("
+                               "scope TEXT NOT NULL, sample TEXT NOT NULL, "
+                               "session TEXT NOT NULL DEFAULT '', element TEXT NOT NULL DEFAULT '')")
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS outliers_key "
+                               "ON outliers (scope, sample, session, element)")
+
+                # merge the tracked JSON copy (records already in the store are ignored by the unique index)
+                if self.json_path.exists():
+                    with open(self.json_path) as json_file:
+                        tracked = json.load(json_file)
+                    self.insert(cursor, [record for records in tracked.values() for record in records])
+
+        return self.connection
+
+    @property
+    def json_path(self):
+        # tracked JSON copy of the store
+        return self.path.with_name("outliers.json")
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def insert(self, cursor, outliers_list):
+        sessions = session_keys([outlier.get("Session", "") for outlier in outliers_list])
+        rows = []
+        for outlier, session in zip(outliers_list, sessions):
+            scope = get_scope(outlier)
+            rows.append((scope,
+                         str(outlier["Sample ID"]),
+                         session,
+                         str(outlier.get("Element", ""))))
+
+        cursor.executemany("INSERT OR IGNORE INTO outliers VALUES (?, ?, ?, ?)", rows)
+
+    @instrumented
+    def add(self, outliers_list):
+        self.connect()
+        with self.transaction() as cursor:
+            self.insert(cursor, outliers_list)
+        self.cache = None # own writes don't change `data_version` for this connection
+
+    def version(self):
+        # changes whenever another connection commits to the database
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    @instrumented
+    def get(self):
+        self.connect()
+        version = self.version()
+
+        if self.cache is None or self.cache_version != version:
+            outliers = {scope: [] for scope in scopes.keys()}
+            rows = self.connection.execute("SELECT scope, sample, session, element FROM outliers ORDER BY rowid")
+            for scope, sample, session, element in rows:
+                values = [sample, session, element][:len(scopes[scope])]
+                outliers[scope].append(dict(zip(scopes[scope], values)))
+
+            self.cache = outliers
+            self.cache_version = version
+
+        # return a copy so callers can't modify the cache
+        return {scope: [dict(record) for record in records] for scope, records in self.cache.items()}
+
+    @instrumented
+    def export_json(self, path=None):
+        # write all outliers to path (the tracked JSON copy by default), in the layout of outliers.json
+        outliers = self.get() # before opening path, which may be the JSON the store merges when it connects
+        with open(path or self.json_path, "w") as json_file:
+            json.dump(outliers, json_file, indent=4)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            self.cache = None
+
+class Transaction:
+    # holds SQLite's write lock (BEGIN IMMEDIATE) until commit/rollback
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("BEGIN IMMEDIATE")
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.cursor.execute("COMMIT")
+        else:
+            self.cursor.execute("ROLLBACK")
+        self.cursor.close()
+
+def session_keys(sessions):
+    """
+    Sessions in the form they are stored and matched in: ISO dates ("2021-10-06").
+
+    Dates may be strings, datetime.date, datetime or Timestamp values (e.g., the "date" column as read by
+    `read_exports` or `read_table`); values that aren't dates are kept as text ("" for no session).
+    """
+    # convert each distinct session once, and map back to the values through their codes
+    codes, uniques = pd.factorize(pd.Series(sessions), use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object)
+    dates = pd.to_datetime(uniques.where(uniques != ""), errors="coerce", format="mixed")
+    keys = dates.dt.strftime("%Y-%m-%d").where(dates.notna(), uniques.astype(str)).to_numpy(dtype=object)
+
+    return keys[codes]
+
+def get_scope(outlier):
+    keys = [key for key in scopes["sample_session_element"] if key in outlier]
+    for scope, scope_keys in scopes.items():
+        if keys == scope_keys:
+            return scope
+    raise ValueError(f"Outlier record {outlier} does not match any outlier scope")
+
+# one store per location, shared within the process
+stores = {}
+
+def get_outlier_store(path=None):
+    path = Path(path or os.environ.get("OUTLIER_STORE", default_path)).resolve()
+    if path not in stores:
+        stores[path] = OutlierStore(path)
+    return stores[path]
+
+def set_outlier_store(path):
+    # make `path` the default location for `save_outliers`/`get_outliers`
+    os.environ["OUTLIER_STORE"] = str(path)
+    return get_outlier_store(path)
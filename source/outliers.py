@@ -1,172 +1,253 @@
-import json 
-from outlier_detector.detectors import OutlierDetector # Dixon's Q Test for small-sample outlier detection
-from datetime import datetime
 import numpy as np 
-
-def save_outliers(outliers_list): 
-    path = '../data/interim/outliers.json'
-    with open(path) as json_file:
-        outliers = json.load(json_file)
-    
-    if list(outliers_list[0].keys()) == ['Sample ID', 'Session', 'Element']: 
-        outliers["sample_session_element"] += outliers_list
-    elif list(outliers_list[0].keys()) == ['Sample ID', 'Session']: 
-        outliers["sample_session"] += outliers_list
-    elif list(outliers_list[0].keys()) == ['Sample ID']: 
-        outliers["sample"] += outliers_list
-
-    for key in outliers.keys(): 
-        outliers[key] = list({frozenset(item.items()) : item for item in outliers[key]}.values())
-
-    with open(path, 'w') as json_file:
-        json.dump(outliers, json_file, indent=4)
+import pandas as pd
+from source.instrumentation import instrumented
+from source.outlier_store import get_outlier_store, session_keys
+
+@instrumented
+def save_outliers(outliers_list, path=None): 
+    # append to the outlier store; duplicates are ignored by the store's unique index
+    store = get_outlier_store(path)
+    if outliers_list: 
+        store.add(outliers_list)
+
+    # keep the tracked outliers.json next to the store in step with it
+    store.export_json()
     
-    return outliers
+    return store.get()
 
-def get_outliers(): 
-    path = '../data/interim/outliers.json'
-    with open(path) as json_file:
-        outliers = json.load(json_file)
-    
-    return outliers
+@instrumented
+def get_outliers(path=None): 
+    # cached in-process; only re-read when the store has changed
+    return get_outlier_store(path).get()
 
+@instrumented
 def detect_outliers_Dixons_Q(elements, data): 
-    outlier_records = []
-
-    for element in elements: 
-        outlier_indexes = dixon_test(data[element])[2]
-
-        if outlier_indexes: 
-            outliers = data.iloc[outlier_indexes]
-            for row in outliers.iterrows(): 
-                outlier_record = {}   
-                outlier_record["Sample ID"] = row[1]["sample_id"]
-                outlier_record["Session"] = row[1]["date"]
-                outlier_record["Element"] = element
-
-                outlier_records.append(outlier_record)
-
-    return outlier_records
-
-def remove_outliers(outliers, data): 
-    for outlier in outliers["sample"]: 
-        data.drop(
-                data[
-                    data["sample_id"] == outlier["Sample ID"]
-                    ].index, \
-                inplace=True)
-
-    for outlier in outliers["sample_session"]: 
-        data.drop(
-                data[
-                    (data["sample_id"] == outlier["Sample ID"]) & \
-                    (data["date"]      == outlier["Session"])
-                    ].index, \
-                inplace=True)
-
-    for outlier in outliers["sample_session_element"]: 
-        data.loc[
-                (data["sample_id"] == outlier["Sample ID"]) & \
-                (data["date"]      == outlier["Session"]), \
-                outlier["Element"]
-                ] = np.NaN
+    # test all elements in one pass; map outlier rows back to their sample and session
+    records = dixon_test_batch(data, columns=elements)
+    positions = records["position"].to_numpy()
+
+    outlier_records = pd.DataFrame({
+                        "Sample ID": data["sample_id"].to_numpy()[positions], 
+                        "Session":   data["date"].to_numpy()[positions], 
+                        "Element":   records["column"].to_numpy()
+                        })
+
+    return outlier_records.to_dict("records")
+
+@instrumented
+def remove_outliers(outliers, data, inplace=False): 
+    # work on a copy unless the caller asks for the frame to be modified in place
+    if not inplace: 
+        data = data.copy()
+
+    # index rows by (sample, session) once; each outlier scope is then a single set lookup. Sessions are
+    # compared as ISO dates, whether the dates of data or outliers are strings or datetimes
+    keys = pd.MultiIndex.from_arrays([data["sample_id"], session_keys(data["date"])])
+    drop = np.zeros(data.shape[0], dtype=bool)
+
+    if outliers["sample"]: 
+        samples = {outlier["Sample ID"] for outlier in outliers["sample"]}
+        drop |= data["sample_id"].isin(samples).to_numpy()
+
+    if outliers["sample_session"]: 
+        sessions = session_keys([outlier["Session"] for outlier in outliers["sample_session"]])
+        sample_sessions = {(outlier["Sample ID"], session) for outlier, session in zip(outliers["sample_session"], sessions)}
+        drop |= keys.isin(sample_sessions)
+
+    # group (sample, session) pairs by element so each element column is masked once
+    element_sample_sessions = {}
+    sessions = session_keys([outlier["Session"] for outlier in outliers["sample_session_element"]])
+    for outlier, session in zip(outliers["sample_session_element"], sessions): 
+        element_sample_sessions.setdefault(outlier["Element"], set()).add((outlier["Sample ID"], session))
+
+    # elements that aren't columns of data are added as all-NaN columns, as by assigning to a new column with .loc
+    for element, sample_sessions in element_sample_sessions.items(): 
+        if element not in data.columns: 
+            data[element] = np.nan
+        data.loc[keys.isin(sample_sessions), element] = np.nan
+
+    data.drop(data.index[drop], inplace=True)
     
     return data
 
+# critical Q values for sample sizes N = 3, 4, 5, ... at each tabulated confidence level
+q90 = [0.941, 0.765, 0.642, 0.56, 0.507, 0.468, 0.437, 
+       0.412, 0.392, 0.376, 0.361, 0.349, 0.338, 0.329, 
+       0.32, 0.313, 0.306, 0.3, 0.295, 0.29, 0.285, 0.281, 
+       0.277, 0.273, 0.269, 0.266, 0.263, 0.26
+       ]
+
+q95 = [0.97, 0.829, 0.71, 0.625, 0.568, 0.526, 0.493, 0.466, 
+       0.444, 0.426, 0.41, 0.396, 0.384, 0.374, 0.365, 0.356, 
+       0.349, 0.342, 0.337, 0.331, 0.326, 0.321, 0.317, 0.312, 
+       0.308, 0.305, 0.301, 0.29
+       ]
+
+q99 = [0.994, 0.926, 0.821, 0.74, 0.68, 0.634, 0.598, 0.568, 
+       0.542, 0.522, 0.503, 0.488, 0.475, 0.463, 0.452, 0.442, 
+       0.433, 0.425, 0.418, 0.411, 0.404, 0.399, 0.393, 0.388, 
+       0.384, 0.38, 0.376, 0.372
+       ]
+
+q_tables = {90: q90, 95: q95, 99: q99}
+
+@instrumented
+def dixon_test_batch(data, columns=None, groupby=None, left=True, right=True, confidence_level=95): 
+    """
+    Keyword arguments:
+        data = A DataFrame or 2-D array of data points (rows are measurements, columns are e.g. elements).
+        columns = Columns of `data` to test (DataFrame only); defaults to all numeric columns not in `groupby`.
+        groupby = Column name(s) of `data` (e.g., ["sample_id", "date"]) or an array of group labels, one per row; 
+                  the test is run separately within each group. If None, each column is tested as a whole.
+        left = Q-test of minimum value in each column/group if True.
+        right = Q-test of maximum value in each column/group if True.
+        confidence_level = Confidence level (90, 95 or 99) of the tabulated critical Q values.
+
+    NaN values are masked out, so each column/group is tested on its valid values only. Columns/groups with
+    fewer than 3 (or more than the tabulated number of) valid values are not tested.
+
+    Returns a tidy DataFrame with one row per outlier and the columns 
+        [*groupby, "column", "index", "position", "value", "side", "q", "q_critical"], 
+    where "index" is the row label and "position" the integer row position in `data`. 
+    """
+    assert(left or right), 'At least one of the variables, `left` or `right`, must be True.'
+    assert(confidence_level in q_tables.keys()), 'Confidence level has critical values tabulated'
+
+    # resolve values, row labels and group labels
+    group_names = []
+    if isinstance(data, pd.DataFrame): 
+        if isinstance(groupby, str): 
+            groupby = [groupby]
+        if groupby is not None and not isinstance(groupby, (np.ndarray, pd.Series)): 
+            group_names = list(groupby)
+            group_labels = data[group_names]
+        else: 
+            group_labels = groupby
+        if columns is None: 
+            columns = [column for column in data.select_dtypes("number").columns if column not in group_names]
+        values = data[columns].to_numpy(dtype=float)
+        row_labels = data.index.to_numpy()
+    else: 
+        values = np.asarray(data, dtype=float)
+        if values.ndim == 1: 
+            values = values[:, None]
+        columns = list(range(values.shape[1]))
+        row_labels = np.arange(values.shape[0])
+        group_labels = groupby
+
+    n_rows, n_cols = values.shape
+
+    # integer code for the group of each row
+    if group_labels is None: 
+        codes = np.zeros(n_rows, dtype=np.int64)
+        uniques = None
+    elif isinstance(group_labels, pd.DataFrame): 
+        codes, uniques = pd.MultiIndex.from_frame(group_labels).factorize()
+        if not group_names: 
+            group_names = list(group_labels.columns)
+    else: 
+        codes, uniques = pd.factorize(np.asarray(group_labels))
+        group_names = ["group"]
+
+    # rank values within each column (NaN last), then offset by group so one argsort orders all columns by group, then value
+    rank_order = np.argsort(values, axis=0, kind="stable")
+    ranks = np.empty_like(rank_order)
+    np.put_along_axis(ranks, rank_order, np.arange(n_rows)[:, None], axis=0)
+    order = np.argsort(codes[:, None] * n_rows + ranks, axis=0, kind="stable")
+    sdata = np.take_along_axis(values, order, axis=0)
+
+    # group boundaries are identical for every column after sorting
+    n_groups = codes.max() + 1 if n_rows else 0
+    group_sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+    n_valid = np.add.reduceat(~np.isnan(sdata), starts, axis=0) if n_rows else np.zeros((0, n_cols), dtype=int)
+
+    # critical Q value for each column/group (NaN where not tabulated)
+    q_dict = np.full(len(q_tables[confidence_level]) + 4, np.nan)
+    q_dict[3:-1] = q_tables[confidence_level]
+    q_crit = q_dict[np.minimum(n_valid, len(q_dict) - 1)]
+
+    # positions (in sorted order) of the two smallest and two largest valid values
+    first = np.broadcast_to(starts[:, None], n_valid.shape)
+    last = np.clip(first + n_valid - 1, 0, max(n_rows - 1, 0))
+    second = np.clip(first + 1, 0, max(n_rows - 1, 0))
+    second_last = np.clip(last - 1, 0, max(n_rows - 1, 0))
+
+    col_index = np.arange(n_cols)[None, :]
+    s_first, s_second = sdata[first, col_index], sdata[second, col_index]
+    s_last, s_second_last = sdata[last, col_index], sdata[second_last, col_index]
+
+    with np.errstate(invalid="ignore", divide="ignore"): 
+        spread = s_last - s_first
+        Q_min = np.where(spread != 0, (s_second - s_first) / spread, 0)
+        Q_max = np.where(spread != 0, (s_last - s_second_last) / spread, 0)
+
+        Q_mindiff = Q_min - q_crit if left else np.zeros_like(q_crit)
+        Q_maxdiff = Q_max - q_crit if right else np.zeros_like(q_crit)
+
+        # when both extremes exceed the critical value, only the more extreme one is an outlier (both if tied)
+        flag_min = (Q_mindiff > 0) & (Q_mindiff >= Q_maxdiff)
+        flag_max = (Q_maxdiff > 0) & (Q_maxdiff >= Q_mindiff)
+
+    # assemble tidy outlier records, ordered by column, then group, then side
+    records = []
+    for side, flags, Q, sorted_positions in [("min", flag_min, Q_min, first), ("max", flag_max, Q_max, last)]: 
+        group_index, column_index = np.nonzero(flags)
+        positions = order[sorted_positions[group_index, column_index], column_index]
+        record = pd.DataFrame({
+                    "column_index": column_index,
+                    "group_index":  group_index,
+                    "side_index":   0 if side == "min" else 1,
+                    "column":       np.asarray(columns, dtype=object)[column_index],
+                    "index":        row_labels[positions],
+                    "position":     positions,
+                    "value":        values[positions, column_index],
+                    "side":         side,
+                    "q":            Q[group_index, column_index],
+                    "q_critical":   q_crit[group_index, column_index]
+                    })
+        records.append(record)
+
+    records = pd.concat(records, ignore_index=True)
+    records = records.sort_values(["column_index", "group_index", "side_index"], kind="stable")
+
+    # add group labels as leading columns
+    if uniques is not None: 
+        if isinstance(uniques, pd.MultiIndex): 
+            group_values = uniques.to_frame(index=False, name=group_names).iloc[records["group_index"].to_numpy()]
+        else: 
+            group_values = pd.DataFrame({group_names[0]: np.asarray(uniques, dtype=object)[records["group_index"].to_numpy()]})
+        records = pd.concat([group_values.reset_index(drop=True), records.reset_index(drop=True)], axis=1)
+
+    records = records.drop(columns=["column_index", "group_index", "side_index"]).reset_index(drop=True)
+
+    return records
+
+@instrumented
 def dixon_test(data, left=True, right=True, confidence_level=95):
     """
     Keyword arguments:
         data = A ordered or unordered list of data points (int or float).
         left = Q-test of minimum value in the ordered list if True.
         right = Q-test of maximum value in the ordered list if True.
-        q_dict = 
+        confidence_level = Confidence level (90, 95 or 99) of the tabulated critical Q values.
             
-    Returns a list of 2 values for the outliers, or None.
+    Thin wrapper around `dixon_test_batch` for a single column; NaN values are ignored by the test.
+
+    Returns the data with outliers removed, the outliers, and the indexes of the outliers in `data`.
     E.g.,
-       for [1,1,1] -> [None, None]
-       for [5,1,1] -> [None, 5]
-       for [5,1,5] -> [1, None]
+       for [1,1,1] -> ([1,1,1], [], [])
+       for [5,1,1] -> ([1,1], [5], [0])
     """
     assert(left or right), 'At least one of the variables, `left` or `right`, must be True.'
     assert(len(data) >= 3), 'At least 3 data points are required'
-    assert(confidence_level in [90, 95, 99]), 'Confidence level has critical values tabulated'
+    assert(confidence_level in q_tables.keys()), 'Confidence level has critical values tabulated'
 
-    """
-    Create dictionary of Q-values for a given confidence level, where the dict. keys are sample sizes N and 
-    the associated values are the corresponding critical Q values. E.g.,{3: 0.97, 4: 0.829, 5: 0.71, 6: 0.625, ...}
-    """
-    
-    q90 = [0.941, 0.765, 0.642, 0.56, 0.507, 0.468, 0.437, 
-           0.412, 0.392, 0.376, 0.361, 0.349, 0.338, 0.329, 
-           0.32, 0.313, 0.306, 0.3, 0.295, 0.29, 0.285, 0.281, 
-           0.277, 0.273, 0.269, 0.266, 0.263, 0.26
-           ]
-
-    q95 = [0.97, 0.829, 0.71, 0.625, 0.568, 0.526, 0.493, 0.466, 
-           0.444, 0.426, 0.41, 0.396, 0.384, 0.374, 0.365, 0.356, 
-           0.349, 0.342, 0.337, 0.331, 0.326, 0.321, 0.317, 0.312, 
-           0.308, 0.305, 0.301, 0.29
-           ]
-
-    q99 = [0.994, 0.926, 0.821, 0.74, 0.68, 0.634, 0.598, 0.568, 
-           0.542, 0.522, 0.503, 0.488, 0.475, 0.463, 0.452, 0.442, 
-           0.433, 0.425, 0.418, 0.411, 0.404, 0.399, 0.393, 0.388, 
-           0.384, 0.38, 0.376, 0.372
-           ]
-
-    Q90 = {n:q for n,q in zip(range(3,len(q90)+3), q90)}
-    Q95 = {n:q for n,q in zip(range(3,len(q95)+3), q95)}
-    Q99 = {n:q for n,q in zip(range(3,len(q99)+3), q99)}
-
-    if confidence_level==90: 
-        q_dict = Q90
-    elif confidence_level==95:
-        q_dict = Q95
-    elif confidence_level==99:
-        qdict = Q99
-    
-    n_of_nan = sum([1 for value in data if np.isnan(value)])
-    data = [np.inf if np.isnan(value) else value for value in data]
-    sdata = sorted(data)
-    sort_index = [index for index, value in sorted(enumerate(data), key=lambda x: x[1])]
-    if n_of_nan != 0:
-        sort_index = sort_index[:-n_of_nan]
-
-    Q_mindiff, Q_maxdiff = (0,0), (0,0)
-    
-    if left:
-        Q_min = (sdata[1] - sdata[0]) 
-        try:
-            Q_min /= (sdata[-1] - sdata[0])
-        except ZeroDivisionError:
-            pass
-        Q_mindiff = (Q_min - q_dict[len(data)], sort_index[0])
-        
-    if right:
-        Q_max = abs((sdata[-2] - sdata[-1]))
-        try:
-            Q_max /= abs((sdata[0] - sdata[-1]))
-        except ZeroDivisionError:
-            pass
-        Q_maxdiff = (Q_max - q_dict[len(data)], sort_index[-1])
-
-    if not Q_mindiff[0] > 0 and not Q_maxdiff[0] > 0:
-        outlier_indexes = [None, None]
-    
-    elif Q_mindiff[0] == Q_maxdiff[0]: 
-        outlier_indexes = [Q_mindiff[1], Q_maxdiff[1]]
-        
-    elif Q_mindiff[0] > Q_maxdiff[0]:
-        outlier_indexes = [Q_mindiff[1], None]
-    
-    else:
-        outlier_indexes = [None, Q_maxdiff[1]]
+    values = np.asarray(data, dtype=float)
+    records = dixon_test_batch(values, left=left, right=right, confidence_level=confidence_level)
 
-    outlier_indexes = list(filter(None, outlier_indexes))
-    
-    outliers = []
-    for index in outlier_indexes:
-        outlier = data.pop(index)
-        outliers.append(outlier)
+    outlier_indexes = records["position"].tolist()
+    outliers = values[outlier_indexes].tolist()
+    data = np.delete(values, outlier_indexes).tolist()
     
-    return data, outliers, outlier_indexes
\ No newline at end of file
+    return data, outliers, outlier_indexes
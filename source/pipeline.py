@@ -0,0 +1,351 @@
+"""
+Run the analysis end to end, skipping stages whose inputs and parameters haven't changed.
+
+Each stage (see `source.stages`) declares its input files, output files and parameters. A stage's key is
+a hash of the contents of its inputs, its parameters and its source code; the key and a hash of each output
+are recorded in data/interim/pipeline_state.json after the stage runs. A stage is skipped if its key is
+unchanged and its outputs are still as it left them. Stages depend on the stages that write their
+inputs, and stages whose dependencies are complete run in parallel.
+
+Usage:
+    python -m source.pipeline [stage ...] [--force] [--jobs N] [--dry-run]
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from source import instrumentation
+from source import stages as stage_functions
+from source.ingest import export_pattern, file_hash
+from source.instrumentation import instrumented
+from source.spatial import layer_files
+
+repository = Path(__file__).resolve().parents[1]
+raw_directory = repository / "data" / "raw"
+map_directory = repository / "MSH_GIS" / "MapData"
+interim_directory = repository / "data" / "interim"
+default_state_path = interim_directory / "pipeline_state.json"
+
+# inputs and outputs are keyword arguments of the stage function holding paths; "files" lists outputs
+# written to a directory argument rather than passed as paths
+stages = {
+    "xrf_cleaning": {"function": stage_functions.xrf_cleaning,
+                     "inputs":   {"xrf_directory":          raw_directory / "XRF_data",
+                                  "sample_processing_path": raw_directory / "sample_processing_log.xlsx"},
+                     "outputs":  {"output_path":  interim_directory / "xrf_data_clean.csv",
+                                  "parquet_path": interim_directory / "xrf_data_clean.parquet"},
+                     "params":   {}},
+
+    "field_cleaning": {"function": stage_functions.field_cleaning,
+                       "inputs":   {"input_path":  interim_directory / "field_data_coarse_clean.xlsx"},
+                       "outputs":  {"output_path": interim_directory / "field_data_fine_clean.xlsx"},
+                       "params":   {}},
+
+    "registry": {"function": stage_functions.registry,
+                 "inputs":   {"sample_processing_path": raw_directory / "sample_processing_log.xlsx",
+                              "field_path":             interim_directory / "field_data_fine_clean.xlsx"},
+                 "outputs":  {"output_path": interim_directory / "sample_registry.parquet"},
+                 "params":   {}},
+
+    "spatial": {"function": stage_functions.spatial,
+                "inputs":   {"field_path":   interim_directory / "field_data_fine_clean.xlsx",
+                             "geology_path": map_directory / "geology.shp",
+                             "rivers_path":  map_directory / "Rivers.shp",
+                             "lakes_path":   map_directory / "Lakes.shp",
+                             "trails_path":  map_directory / "Trails.shp"},
+                "outputs":  {"output_path":  interim_directory / "sample_geology.csv"},
+                "params":   {}},
+
+    "qaqc": {"function": stage_functions.qaqc,
+             "inputs":   {"xrf_path":    interim_directory / "xrf_data_clean.csv"},
+             "outputs":  {"output_path":   interim_directory / "drift_correction.json",
+                          "outliers_path": interim_directory / "drift_outliers.csv"},
+             "params":   {"initial_date": "2021-10-06", "score_threshold": 0.5}},
+
+    "calibration": {"function": stage_functions.calibration,
+                    "inputs":   {"xrf_path": interim_directory / "xrf_data_clean.csv",
+                                 "srm_path": interim_directory / "standard_reference_material_certified_values.csv"},
+                    "outputs":  {"calib_path":          interim_directory / "xrf_data_calib.csv",
+                                 "analysis_ready_path": interim_directory / "data_analysis_ready.csv",
+                                 "output_directory":    interim_directory},
+                    "files":    [interim_directory / "analytical_precision.json",
+                                 interim_directory / "field_heterogeneity.json"],
+                    "params":   {"outlier_stddev_cutoff": 5}},
+
+    "uncertainty": {"function": stage_functions.uncertainty,
+                    "inputs":   {"xrf_path": interim_directory / "xrf_data_clean.csv",
+                                 "srm_path": interim_directory / "standard_reference_material_certified_values.csv"},
+                    "outputs":  {"output_path": interim_directory / "xrf_data_uncertainty.csv"},
+                    "params":   {"n_realizations": 1000, "percentiles": [2.5, 50, 97.5], "seed": 0,
+                                 "outlier_stddev_cutoff": 5}},
+
+    "multivariate": {"function": stage_functions.multivariate,
+                     "inputs":   {"analysis_ready_path": interim_directory / "data_analysis_ready.csv"},
+                     "outputs":  {"output_path": interim_directory / "data_pca_norm.csv",
+                                  "model_path":  interim_directory / "multivariate_model.joblib"},
+                     "params":   {"n_clusters": None}},
+
+    "gridding": {"function": stage_functions.gridding,
+                 "inputs":   {"analysis_ready_path": interim_directory / "data_analysis_ready.csv",
+                              "registry_path":       interim_directory / "sample_registry.parquet",
+                              "grid_path":           map_directory / "grid.shp"},
+                 "outputs":  {"output_path":       interim_directory / "element_maps.npz",
+                              "geotiff_directory": interim_directory / "element_maps"},
+                 "params":   {"method": "idw", "resolution": 20}},
+}
+
+def relative(path):
+    # repository-relative path (as a string) for the state file
+    path = Path(path).resolve()
+    try:
+        return path.relative_to(repository).as_posix()
+    except ValueError:
+        return path.as_posix()
+
+def input_files(path):
+    # files an input path stands for; a directory stands for the XRF exports in it, and a shapefile for all
+    # of its files (.shp, .dbf, ...)
+    path = Path(path)
+    if path.is_dir():
+        return sorted(path.glob(export_pattern))
+    if path.suffix == ".shp":
+        return layer_files(path)
+
+    return [path]
+
+def output_files(stage):
+    # files written by a stage
+    files = [Path(path) for path in stage["outputs"].values() if Path(path).suffix != ""]
+
+    return files + [Path(path) for path in stage.get("files", [])]
+
+def dependencies(name, stage_definitions=None):
+    # stages that write one of the inputs of stage `name`
+    stage_definitions = stage_definitions or stages
+    inputs = {relative(path) for path in stage_definitions[name]["inputs"].values()}
+
+    return [other for other, stage in stage_definitions.items()
+            if other != name and inputs & {relative(path) for path in output_files(stage)}]
+
+def code_objects(code):
+    # a code object and those nested in it (comprehensions, lambdas, inner functions)
+    yield code
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            yield from code_objects(constant)
+
+def referenced(value):
+    # functions, classes and modules that a function refers to by global name, or the methods of a class
+    if inspect.isclass(value):
+        return [member.fget if isinstance(member, property) else getattr(member, "__func__", member)
+                for member in vars(value).values() if isinstance(member, (property, staticmethod, classmethod)) or
+                inspect.isfunction(member)]
+
+    references = []
+    for code in code_objects(value.__code__):
+        for name in code.co_names:
+            reference = value.__globals__.get(name)
+            if inspect.ismodule(reference):
+                references += [member for member in vars(reference).values()
+                               if callable(member) and inspect.getmodule(member) is reference]
+            elif callable(reference):
+                references.append(reference)
+
+    return references
+
+def code_sources(function):
+    """
+    Source of a stage function and of the `source` modules of every function and class it uses, directly or
+    through other `source` functions (e.g., `duplicate_precision` calls `dixon_test_batch`, so a change to
+    source.outliers changes the key of the calibration stage).
+    """
+    function = inspect.unwrap(function) # instrumented functions are wrapped
+    modules, seen = set(), set()
+    pending = referenced(function)
+    while pending:
+        value = inspect.unwrap(pending.pop())
+        module = inspect.getmodule(value)
+        if value in seen or module is None or not module.__name__.startswith("source."):
+            continue
+        seen.add(value)
+        modules.add(module)
+        if inspect.isfunction(value) or inspect.isclass(value):
+            pending += referenced(value)
+
+    return [inspect.getsource(function)] + [inspect.getsource(module) for module in sorted(modules, key=lambda m: m.__name__)]
+
+@instrumented
+def stage_key(stage):
+    """
+    Hash of everything that determines a stage's outputs: the contents of its input files (for a directory,
+    the name and contents of each export), its parameters and the source code of its function and of the
+    modules it uses, directly or indirectly.
+    """
+    digest = hashlib.sha256()
+    for source_code in code_sources(stage["function"]):
+        digest.update(source_code.encode())
+    digest.update(json.dumps(stage["params"], sort_keys=True, default=str).encode())
+
+    for argument, path in sorted(stage["inputs"].items()):
+        digest.update(argument.encode())
+        for file in input_files(path):
+            digest.update(file.name.encode())
+            digest.update(file_hash(file).encode() if file.exists() else b"missing")
+
+    return digest.hexdigest()
+
+@instrumented
+def output_hashes(stage):
+    return {relative(path): file_hash(path) for path in output_files(stage) if path.exists()}
+
+def is_current(name, stage, key, state):
+    # True if the stage last ran with this key and its outputs are unchanged since
+    entry = state.get(name)
+    if entry is None or entry["key"] != key:
+        return False
+
+    hashes = output_hashes(stage)
+
+    return len(hashes) == len(output_files(stage)) and hashes == entry["outputs"]
+
+def read_state(path=None):
+    path = Path(path or default_state_path)
+    if not path.exists():
+        return {}
+
+    with open(path) as json_file:
+        return json.load(json_file)
+
+def write_state(state, path=None):
+    # write state atomically so an interrupted run never leaves a partial file
+    path = Path(path or default_state_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "w") as json_file:
+        json.dump(state, json_file, indent=4)
+    os.replace(temporary_path, path)
+
+def run_stage(stage):
+    """
+    Run a stage function with its input, output and parameter arguments.
+
+    Returns the instrumentation statistics of the stage's calls (empty if instrumentation is off), so that
+    stages run in worker processes can be accounted for in the main process.
+    """
+    for path in output_files(stage):
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    if not instrumentation.enabled:
+        stage["function"](**stage["inputs"], **stage["outputs"], **stage["params"])
+        return {}
+
+    with instrumentation.instrument(memory=instrumentation.options["memory"]) as stage_stats:
+        stage["function"](**stage["inputs"], **stage["outputs"], **stage["params"])
+
+    return stage_stats
+
+def select(names=None, stage_definitions=None):
+    # requested stages plus all stages upstream of them, in definition order
+    stage_definitions = stage_definitions or stages
+    selected = set()
+    to_visit = list(names or stage_definitions.keys())
+    while to_visit:
+        name = to_visit.pop()
+        if name not in stage_definitions:
+            raise ValueError(f"Unknown stage: {name}")
+        if name not in selected:
+            selected.add(name)
+            to_visit.extend(dependencies(name, stage_definitions))
+
+    return [name for name in stage_definitions if name in selected]
+
+def run(names=None, force=False, jobs=None, dry_run=False, state_path=None, stage_definitions=None):
+    """
+    Run the pipeline.
+
+    Keyword arguments:
+        names = Stages to bring up to date (all by default); the stages they depend on are included.
+        force = Rerun stages even if their inputs and parameters haven't changed.
+        jobs = Number of stages run in parallel (1 runs stages in this process).
+        dry_run = Only report which stages would run; stages downstream of a stage that would run are
+                  reported as running too.
+        state_path = Location of the pipeline state (data/interim/pipeline_state.json by default).
+
+    Returns a dict of "ran" or "skipped" for each selected stage.
+    """
+    stage_definitions = stage_definitions or stages
+    names = select(names, stage_definitions)
+    state = read_state(state_path)
+    upstream = {name: [other for other in dependencies(name, stage_definitions) if other in names] for name in names}
+
+    status = {}
+    keys = {}
+    running = {}
+
+    def ready():
+        return [name for name in names if name not in status and name not in running.values()
+                and all(other in status for other in upstream[name])]
+
+    def finish(name):
+        status[name] = "ran"
+        state[name] = {"key": keys[name], "outputs": output_hashes(stage_definitions[name])}
+        write_state(state, state_path)
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs != 1 and not dry_run else None
+    try:
+        while len(status) < len(names):
+            for name in ready():
+                stage = stage_definitions[name]
+
+                # inputs are hashed only once upstream stages are complete
+                if dry_run and any(status[other] == "ran" for other in upstream[name]):
+                    status[name] = "ran"
+                    continue
+                keys[name] = stage_key(stage)
+                if not force and is_current(name, stage, keys[name], state):
+                    status[name] = "skipped"
+                elif dry_run:
+                    status[name] = "ran"
+                elif executor is None:
+                    run_stage(stage)
+                    finish(name)
+                else:
+                    running[executor.submit(run_stage, stage)] = name
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    stage_stats = future.result() # re-raises errors from the stage
+                    if instrumentation.enabled:
+                        instrumentation.merge(instrumentation.stats, stage_stats)
+                    finish(name)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return status
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog="python -m source.pipeline", description="Run the analysis pipeline.")
+    parser.add_argument("stages", nargs="*", help="stages to bring up to date (default: all of " + ", ".join(stages) + ")")
+    parser.add_argument("--force", action="store_true", help="rerun stages even if their inputs haven't changed")
+    parser.add_argument("--jobs", type=int, default=None, help="number of stages run in parallel")
+    parser.add_argument("--dry-run", action="store_true", help="only report which stages would run")
+    arguments = parser.parse_args(arguments)
+
+    unknown = [name for name in arguments.stages if name not in stages]
+    if unknown:
+        parser.error("unknown stage(s): " + ", ".join(unknown))
+
+    status = run(arguments.stages or None, force=arguments.force, jobs=arguments.jobs, dry_run=arguments.dry_run)
+    for name, result in status.items():
+        print(f"{name}: {'would run' if arguments.dry_run and result == 'ran' else result}")
+
+if __name__ == "__main__":
+    main()
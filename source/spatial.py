@@ -0,0 +1,175 @@
+"""
+Link samples to the GIS layers in MSH_GIS: the geology unit each sample lies on and its distance to the
+nearest river, lake and trail.
+
+Shapefiles are read with pyshp into shapely geometries once per process (per version of the files), and
+indexed with an STRtree so that all samples are joined in bulk queries. All layers and the sample
+coordinates (UTM-EW, UTM-NS in the field data) are in WGS 84 / UTM zone 18N, so distances are in metres.
+"""
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapefile
+import shapely
+from shapely.geometry import shape
+
+from source.ingest import file_hash
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+gis_directory = repository / "MSH_GIS"
+map_directory = gis_directory / "MapData"
+default_cache_directory = repository / "data" / "interim" / "spatial_joins"
+
+# layers joined to the samples: geology polygons, and features whose distance to each sample is measured
+geology_path = map_directory / "geology.shp"
+feature_paths = {"rivers": map_directory / "Rivers.shp",
+                 "lakes":  map_directory / "Lakes.shp",
+                 "trails": map_directory / "Trails.shp"}
+
+# joined tables, keyed by hash of the layers and samples they were computed from
+join_cache = {}
+
+def layer_files(path):
+    # files making up a shapefile (.shp, .shx, .dbf, .prj, ...)
+    path = Path(path)
+    return sorted(path.parent.glob(path.stem + ".*"))
+
+def layer_hash(path):
+    # hash of the contents of all files of a shapefile
+    digest = hashlib.sha256()
+    for file in layer_files(path):
+        digest.update(file.suffix.encode())
+        digest.update(file_hash(file).encode())
+
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+@instrumented
+def read_layer_cached(path, content_hash):
+    # read_layer for a version of a layer's files (content_hash only keys the cache)
+    with shapefile.Reader(str(path)) as reader:
+        geometries = [shape(record.shape.__geo_interface__) if record.shape.shapeType != shapefile.NULL else None
+                      for record in reader.iterShapeRecords()]
+        attributes = pd.DataFrame(reader.records(), columns=[field[0] for field in reader.fields[1:]])
+
+    # some geology polygons are invalid (self-intersecting rings), which breaks point-in-polygon tests
+    geometries = shapely.make_valid(np.array(geometries, dtype=object))
+
+    return geometries, attributes
+
+def read_layer(path):
+    """
+    Geometries (array of shapely geometries, repaired if invalid) and attributes (DataFrame) of a shapefile.
+
+    Layers are read once per process and version of their files.
+    """
+    path = Path(path).resolve()
+    return read_layer_cached(str(path), layer_hash(path))
+
+@lru_cache(maxsize=None)
+def spatial_index(path, content_hash):
+    # STRtree of a layer's geometries, built once per version of the layer
+    return shapely.STRtree(read_layer_cached(path, content_hash)[0])
+
+def layer_index(path):
+    path = Path(path).resolve()
+    content_hash = layer_hash(path)
+
+    return read_layer_cached(str(path), content_hash), spatial_index(str(path), content_hash)
+
+@instrumented
+def join_polygons(points, path, attributes=None):
+    """
+    Attributes of the polygon of a layer containing each point (NaN for points outside all polygons).
+
+    A point on the boundary of two polygons takes the attributes of the first. Returns a DataFrame with one
+    row per point, in order.
+    """
+    (_, layer_attributes), index = layer_index(path)
+    layer_attributes = layer_attributes if attributes is None else layer_attributes[attributes]
+
+    point_positions, polygon_positions = index.query(points, predicate="intersects")
+    order = np.lexsort((polygon_positions, point_positions)) # first polygon of each point
+    point_positions, first = np.unique(point_positions[order], return_index=True)
+
+    joined = layer_attributes.iloc[polygon_positions[order][first]].set_axis(point_positions)
+
+    return joined.reindex(np.arange(len(points))).reset_index(drop=True)
+
+@instrumented
+def nearest_distances(points, path):
+    # distance from each point to the nearest feature of a layer (0 inside a polygon; NaN for empty points)
+    _, index = layer_index(path)
+    distances = np.full(len(points), np.nan)
+
+    valid = ~shapely.is_empty(points)
+    positions, nearest = index.query_nearest(points[valid], return_distance=True, all_matches=False)
+    distances[np.flatnonzero(valid)[positions[0]]] = nearest
+
+    return distances
+
+def sample_points(samples, x="UTM-EW", y="UTM-NS"):
+    # shapely points of sample coordinates (empty points where a coordinate is missing)
+    coordinates = samples[[x, y]].to_numpy(dtype=float)
+    points = np.full(len(coordinates), shapely.Point(), dtype=object)
+    located = np.isfinite(coordinates).all(axis=1)
+    points[located] = shapely.points(coordinates[located])
+
+    return points
+
+def join_hash(samples, id_column, x, y, geology, features):
+    # hash of the sample coordinates and the layer files used for a join
+    digest = hashlib.sha256(pd.util.hash_pandas_object(samples[[id_column, x, y]].astype(str), index=False).to_numpy().tobytes())
+    for name, path in [("geology", geology)] + sorted(features.items()):
+        digest.update(name.encode())
+        digest.update(layer_hash(path).encode())
+
+    return digest.hexdigest()
+
+@instrumented
+def spatial_join(samples, id_column="SampleID", x="UTM-EW", y="UTM-NS", geology=None, features=None, cache_directory=None):
+    """
+    Geology and distances to features for each sample.
+
+    Keyword arguments:
+        samples = DataFrame of sample IDs and UTM coordinates (e.g., field_data_fine_clean.xlsx).
+        id_column, x, y = Columns of the sample ID and easting and northing.
+        geology = Geology polygon layer (MapData/geology.shp by default).
+        features = Layers whose nearest feature distance is measured, by name (rivers, lakes and trails of
+                   MapData by default).
+        cache_directory = Directory of joined tables (data/interim/spatial_joins by default; False disables
+                          the disk cache). Tables are keyed by hash of the layer files and sample coordinates.
+
+    Returns a DataFrame with the columns "sample_id", the geology attributes (as in underlying_geology.csv)
+    and "distance_to_<name>" (in metres) for each feature layer.
+    """
+    geology = Path(geology or geology_path)
+    features = feature_paths if features is None else features
+
+    key = join_hash(samples, id_column, x, y, geology, features)
+    if key in join_cache:
+        return join_cache[key].copy()
+
+    path = None
+    if cache_directory is not False:
+        path = Path(cache_directory or default_cache_directory) / (key + ".parquet")
+        if path.exists():
+            join_cache[key] = pd.read_parquet(path)
+            return join_cache[key].copy()
+
+    points = sample_points(samples, x, y)
+    joined = join_polygons(points, geology)
+    joined.insert(0, "sample_id", samples[id_column].astype(str).to_numpy())
+    for name, feature_path in features.items():
+        joined["distance_to_" + name] = nearest_distances(points, feature_path)
+
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        joined.to_parquet(path, index=False)
+    join_cache[key] = joined
+
+    return joined.copy()
@@ -0,0 +1,231 @@
+"""
+Stages of the analysis, as functions of their input and output paths.
+
+Each stage reproduces one notebook (xrf_data_cleaning, field_data_cleaning, QAQC, calibration and
+multivariate), or a GIS step done by hand in QGIS (spatial, gridding), or extends them (registry,
+uncertainty), so that the workflow can be run end to end by `source.pipeline`.
+
+The stages are the source of truth for the outputs tracked in data/interim. Rules such as the calibration
+discard criteria and rounding live in the `source` modules, and the notebooks call the same functions step by
+step to inspect and plot intermediate results; they don't implement their own versions.
+"""
+import pandas as pd
+
+from source.calibration import (analysis_ready, apply_detection_limits, calibrate, censored_labels, clean_srm_data,
+                                discard_elements, evaluate_dataset, fit_calibration, half_detection_limit,
+                                proportion_censored, screen_standards)
+from source.cleaning import (analysis_log, clean_field_data, normalize_ids, read_field_data, read_processing_log,
+                             read_registry, sample_registry, write_registry)
+from source.drift import drift_differences, fit_drift
+from source.duplicates import averaged_censored, duplicate_precision, pair_duplicates
+from source.get_elements import get_elements
+from source.gridding import element_maps, write_rasters
+from source.ingest import read_exports
+from source.instrumentation import instrumented
+from source.multivariate import fit_model
+from source.outliers import detect_outliers_Dixons_Q, remove_outliers
+from source.spatial import spatial_join
+from source.storage import export_table, write_table
+from source.uncertainty import propagate_uncertainty
+
+@instrumented
+def xrf_cleaning(xrf_directory, sample_processing_path, output_path, parquet_path=None, cache_directory=None):
+    ## combine xrf data from different days (sessions) into one dataframe
+    xrf_data = read_exports(xrf_directory, incremental=True, cache_directory=cache_directory)
+
+    ## clean xrf data
+    xrf_data = xrf_data.drop(columns=["Analyst", "Field Label 1"]) # drop unnecessary columns
+    xrf_data = xrf_data.rename(columns={"Field 1": "sample_id"}) # rename sample ID column
+    xrf_data.loc[xrf_data["sample_id"]=="UNKNOWN", "sample_id"] = "TE2-009" # replace unknown sample ID
+    xrf_data["date"] = pd.to_datetime(xrf_data["date"]).dt.date
+    xrf_data = xrf_data.dropna(subset=["sample_id"]) # remove empty rows
+
+    ## sample processing log: xrf analyses with their group, sample type and QAQC type
+    xrf_log = analysis_log(read_processing_log(sample_processing_path))
+
+    ## ensure that case of sample IDs will match (the log's sample IDs are already normalized)
+    xrf_data["sample_id"] = normalize_ids(xrf_data["sample_id"])
+
+    ## combine xrf and sample processing data
+    xrf_data = pd.merge(xrf_data, xrf_log, how="inner", on=["sample_id", "date"])
+
+    ## reset index column
+    xrf_data = xrf_data.sort_values(by="analysis_order_index").reset_index(drop=True)
+    xrf_data = xrf_data.drop(columns=["analysis_order_index"])
+
+    ## drop any empty columns (e.g., no data for an element)
+    xrf_data = xrf_data.dropna(axis=1, how="all")
+
+    ## change order of columns
+    headers_to_move = ["date", "group", "sample_type", "qaqc_type"]
+    columns = [column for column in xrf_data.columns if column not in headers_to_move]
+    xrf_data = xrf_data[columns[:1] + headers_to_move + columns[1:]]
+
+    # for field duplicate pairs in which duplicate and parent samples were not given distinct sample IDs,
+    # assign one the duplicate ID and the other the parent ID
+    relabel = [("GR1-010",  "2021-10-31", "field duplicate", "GR1-010F"),
+               ("GR1-020F", "2021-10-14", "sample",          "GR1-020"),
+               ("TE2-010",  "2021-10-14", "field duplicate", "TE2-010F")]
+    for sample_id, date, qaqc_type, new_sample_id in relabel:
+        condition = (xrf_data["sample_id"] == sample_id) & (xrf_data["date"] == pd.to_datetime(date).date())
+        xrf_data.loc[condition, "qaqc_type"] = qaqc_type
+        xrf_data.loc[condition, "sample_id"] = new_sample_id
+
+    # for field duplicate with no parent, reassign sample ID as that of parent sample ID
+    condition = xrf_data["sample_id"] == "TE2-W10F"
+    xrf_data.loc[condition, "qaqc_type"] = "sample"
+    xrf_data.loc[condition, "sample_id"] = "TE2-W10"
+
+    # export data
+    xrf_data.to_csv(output_path)
+    if parquet_path is not None:
+        write_table(xrf_data, parquet_path)
+
+    return xrf_data
+
+@instrumented
+def field_cleaning(input_path, output_path):
+    data = read_field_data(input_path)
+
+    ## lowercase, strip line prefixes and replace variations (see source.cleaning.field_rules)
+    data = clean_field_data(data)
+
+    export_table(data, output_path, sheet_name="field_data")
+
+    return data
+
+@instrumented
+def registry(sample_processing_path, field_path, output_path):
+    # registry of samples from the sample processing log and field data, indexed by sample ID
+    samples = sample_registry(read_processing_log(sample_processing_path), read_field_data(field_path))
+    write_registry(samples, output_path)
+
+    return samples
+
+@instrumented
+def spatial(field_path, geology_path, rivers_path, lakes_path, trails_path, output_path, cache_directory=None):
+    # geology under each sample and distances to the nearest river, lake and trail (replaces the QGIS export
+    # underlying_geology.csv)
+    field_data = read_field_data(field_path)
+    features = {"rivers": rivers_path, "lakes": lakes_path, "trails": trails_path}
+    sample_geology = spatial_join(field_data, geology=geology_path, features=features, cache_directory=cache_directory)
+    sample_geology.to_csv(output_path, index=False)
+
+    return sample_geology
+
+@instrumented
+def qaqc(xrf_path, output_path, outliers_path, initial_date="2021-10-06", score_threshold=0.5):
+    xrf_data = pd.read_csv(xrf_path)
+    standards_data = xrf_data[xrf_data["qaqc_type"]=="standard"]
+    elements = get_elements(xrf_data.columns.tolist())
+
+    # difference of each standard measurement from its initial measurement
+    standards_drift_data = drift_differences(standards_data, elements, initial_date)
+
+    ## Outlier detection and removal; only the outliers detected in this run are removed, so the models depend
+    ## on the stage's inputs alone. They are written to outliers_path, to be added to the outlier store with
+    ## `save_outliers` if wanted (as the QAQC notebook does)
+    outliers = detect_outliers_Dixons_Q(elements, standards_drift_data)
+    pd.DataFrame(outliers, columns=["Sample ID", "Session", "Element"]).to_csv(outliers_path, index=False)
+    standards_drift_data = remove_outliers({"sample": [], "sample_session": [], "sample_session_element": outliers},
+                                           standards_drift_data)
+
+    ## Analysis
+    drift_models = fit_drift(standards_drift_data, elements)
+    drift_models["drift_correction"] = drift_models["r_squared"] > score_threshold
+    drift_models.to_json(output_path, orient="index", indent=4)
+
+    return drift_models
+
+def calibration_curves(xrf_data, srm_data, outlier_stddev_cutoff=5):
+    ## Remove standard data for a given element that is unsuitable for calibration
+    standard_outliers = screen_standards(xrf_data, get_elements(xrf_data.columns.to_list()), outlier_stddev_cutoff)
+    xrf_data = remove_outliers({"sample": [], "sample_session": [], "sample_session_element": standard_outliers}, xrf_data)
+
+    ## Calibrate elements with certified values for one or more standard reference materials
+    elements = get_elements(list(set(srm_data["Analyte"].unique()) & set(xrf_data.columns.to_list())))
+    calibration = fit_calibration(xrf_data, srm_data, elements)
+
+    return xrf_data, calibration
+
+@instrumented
+def calibration(xrf_path, srm_path, calib_path, analysis_ready_path, output_directory, outlier_stddev_cutoff=5):
+    xrf_data = pd.read_csv(xrf_path, index_col=0) # load xrf data
+    xrf_data = xrf_data.drop([column for column in xrf_data.columns if column.endswith("+/-")], axis=1)
+    srm_data = clean_srm_data(pd.read_csv(srm_path))
+
+    ## Remove unsuitable standard data and fit calibration curves
+    xrf_data, calibration = calibration_curves(xrf_data, srm_data, outlier_stddev_cutoff)
+    xrf_data = calibrate(xrf_data, calibration)
+
+    ## Apply detection limits
+    xrf_data, censored = apply_detection_limits(xrf_data, calibration)
+
+    ## Evaluate precision; lab duplicates are averaged into their parents
+    elements_dup = get_elements(xrf_data.columns.to_list())
+    lab_pairs = pair_duplicates(xrf_data, "lab")
+    xrf_data, analytical_precision, field_heterogeneity = \
+        duplicate_precision(half_detection_limit(xrf_data, censored), elements_dup, censored, output_directory)
+    censored = averaged_censored(censored, lab_pairs, xrf_data.index)
+
+    xrf_data = xrf_data.reset_index(drop=True)
+    censored = censored.reset_index(drop=True)
+
+    # export calibrated data; values below the detection limit are written as "<limit"
+    censored_labels(xrf_data, censored, calibration).to_csv(calib_path)
+
+    ## Evaluate dataset and clean analysis-ready dataset
+    evaluation = evaluate_dataset(get_elements(xrf_data.columns), calibration, proportion_censored(censored),
+                                  analytical_precision, field_heterogeneity)
+    discard = discard_elements(evaluation)
+    data_analysis_ready = analysis_ready(xrf_data, discard, evaluation)
+    data_analysis_ready.to_csv(analysis_ready_path)
+
+    return data_analysis_ready, discard
+
+@instrumented
+def uncertainty(xrf_path, srm_path, output_path, n_realizations=1000, percentiles=(2.5, 50, 97.5), seed=0,
+                outlier_stddev_cutoff=5, processes=None):
+    # uncertainty bands of the calibrated concentrations, propagated by Monte Carlo from the "+/-" columns dropped
+    # by the calibration stage. The calibration stage doesn't correct drift, so neither does this one: the bands
+    # are of the values in xrf_data_calib.csv
+    xrf_data = pd.read_csv(xrf_path, index_col=0)
+    srm_data = clean_srm_data(pd.read_csv(srm_path))
+    xrf_data, calibration = calibration_curves(xrf_data, srm_data, outlier_stddev_cutoff)
+
+    bands, below_detection_limit = propagate_uncertainty(xrf_data, calibration, n_realizations=n_realizations,
+                                                         percentiles=percentiles, seed=seed, processes=processes)
+
+    # bands and proportion of realizations below the detection limit ("<element> bdl") of each analysis (empty
+    # for standards, which aren't calibrated)
+    xrf_uncertainty = pd.concat([xrf_data[["sample_id", "date", "qaqc_type"]], bands,
+                                 below_detection_limit.add_suffix(" bdl")], axis=1)
+    xrf_uncertainty.to_csv(output_path)
+
+    return xrf_uncertainty
+
+@instrumented
+def multivariate(analysis_ready_path, output_path, model_path=None, n_clusters=None):
+    data = pd.read_csv(analysis_ready_path) # load compositional data prepared for analysis
+
+    # log-transform selection, scaling and PCA (see source.multivariate); the model is saved so new samples
+    # can be projected without refitting
+    model = fit_model(data, n_clusters=n_clusters, model_path=model_path)
+
+    # principal components normalized to [-1, 1]
+    data_pca = model.project(data)
+    data_pca.to_csv(output_path)
+
+    return data_pca
+
+@instrumented
+def gridding(analysis_ready_path, registry_path, grid_path, output_path, geotiff_directory, method="idw", resolution=20,
+             processes=None):
+    # maps of all elements on the project grid (NumPy archive and a GeoTIFF per element)
+    data = pd.read_csv(analysis_ready_path)
+    samples = read_registry(registry_path)
+    rasters, elements, grid = element_maps(data, samples, method=method, resolution=resolution, grid_path=grid_path,
+                                           processes=processes)
+    write_rasters(rasters, elements, grid, output_path, geotiff_directory)
+
+    return rasters
@@ -0,0 +1,137 @@
+import json
+import re
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from source.get_elements import get_symbols, split_analyte
+from source.instrumentation import instrumented
+
+repository = Path(__file__).resolve().parents[1]
+interim_directory = repository / "data" / "interim"
+
+# columns stored as categoricals / dates unless told otherwise
+categorical_columns = ["sample_id", "group", "sample_type", "qaqc_type"]
+date_columns = ["date"]
+
+def interim_path(name):
+    # path of a named interim table, e.g. "xrf_data_clean" -> data/interim/xrf_data_clean.parquet
+    path = Path(name)
+    if path.suffix == "" and path.parent == Path("."):
+        path = interim_directory / (name + ".parquet")
+
+    return path
+
+def analyte_columns(columns):
+    # element and element uncertainty ("+/-") columns
+    return [column for column in columns if split_analyte(column)[0] in get_symbols()]
+
+@instrumented
+def write_table(data, name, categorical=None, dates=None):
+    """
+    Write data to a typed columnar (Parquet) file.
+
+    Keyword arguments:
+        data = DataFrame to write.
+        name = Name of an interim table (written to data/interim/<name>.parquet) or a path.
+        categorical = Columns to store as categoricals (defaults to sample_id, group, sample_type and qaqc_type).
+        dates = Columns to store as dates (defaults to date).
+
+    The column types are stored in the file along with the list of analyte columns, so `read_table`
+    doesn't need to re-infer them.
+    """
+    path = interim_path(name)
+    data = data.copy()
+
+    # drop index columns left over from CSV round trips
+    data = data.drop(columns=[column for column in data.columns if str(column).startswith("Unnamed: ")])
+
+    for column in (categorical_columns if categorical is None else categorical):
+        if column in data.columns:
+            data[column] = data[column].astype("category")
+
+    for column in (date_columns if dates is None else dates):
+        if column in data.columns:
+            data[column] = pd.to_datetime(data[column])
+
+    analytes = analyte_columns(data.columns)
+
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"analytes"] = json.dumps(analytes).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, path)
+
+    return path
+
+@instrumented
+def read_schema(name):
+    # column names and stored analyte columns of a table, without reading any data
+    schema = pq.read_schema(interim_path(name))
+    metadata = schema.metadata or {}
+    analytes = json.loads(metadata[b"analytes"]) if b"analytes" in metadata else analyte_columns(schema.names)
+
+    return schema.names, analytes
+
+@instrumented
+def read_table(name, elements=None, uncertainty=False, columns=None):
+    """
+    Read a table written by `write_table`, loading only the columns asked for.
+
+    Keyword arguments:
+        name = Name of an interim table or a path.
+        elements = Element columns to load (all analyte columns if None); non-analyte columns
+                   (sample_id, date, ...) are always loaded.
+        uncertainty = Also load the "+/-" uncertainty column of each element in `elements`.
+        columns = Exact list of columns to load (overrides `elements`).
+    """
+    path = interim_path(name)
+
+    if columns is None and elements is not None:
+        names, analytes = read_schema(path)
+        wanted = set(elements)
+        if uncertainty:
+            wanted |= {element + " +/-" for element in elements}
+        columns = [column for column in names if column not in analytes or column in wanted]
+
+    return pd.read_parquet(path, columns=columns)
+
+# time written into Excel exports in place of the time of writing
+excel_timestamp = (1980, 1, 1, 0, 0, 0)
+
+def reproducible_excel(path):
+    """
+    Replace the times openpyxl stamps into a workbook (the created and modified properties, and the time of
+    each file in the archive) with `excel_timestamp`, so that exporting the same table gives the same file.
+    """
+    with zipfile.ZipFile(path) as archive:
+        entries = [(info, archive.read(info)) for info in archive.infolist()]
+
+    with zipfile.ZipFile(path, "w") as archive:
+        for info, content in entries:
+            if info.filename == "docProps/core.xml":
+                timestamp = b"%04d-%02d-%02dT%02d:%02d:%02dZ" % excel_timestamp
+                content = re.sub(rb"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ", timestamp, content)
+            archive.writestr(zipfile.ZipInfo(info.filename, date_time=excel_timestamp), content,
+                             compress_type=info.compress_type)
+
+@instrumented
+def export_table(data, path, **kwargs):
+    # explicit CSV/Excel export of a table; Excel files are written reproducibly (see `reproducible_excel`)
+    path = Path(path)
+    if path.suffix == ".csv":
+        data.to_csv(path, **kwargs)
+    elif path.suffix == ".xlsx":
+        data.to_excel(path, **kwargs)
+        reproducible_excel(path)
+    elif path.suffix == ".xls":
+        data.to_excel(path, **kwargs)
+    else:
+        raise ValueError(f"Unsupported export format: {path.suffix}")
+
+    return path
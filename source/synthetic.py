@@ -0,0 +1,243 @@
+"""
+Synthetic datasets in the schema of the raw and interim data, for benchmarking at production scale.
+
+Everything is generated from a seed, so the same arguments always give the same data, and nothing is
+downloaded. Sessions follow the layout of the real ones: each starts with a measurement of every standard,
+followed by soil and sediment samples with lab duplicates ("L") and field duplicates ("F").
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# analyte columns of the instrument's exports, in export order (each followed by its "+/-" column)
+analytes = ["Au", "As", "Sb", "Ag", "Al", "Ba", "Bi", "Ca", "Cd", "Cl", "Co", "Cr", "Cu", "Fe", "Hg", "K",
+            "Mg", "Mn", "Mo", "Ni", "P", "Pb", "Rb", "S", "Se", "Si", "Sn", "Sr", "Ti", "U", "V", "W", "Zn",
+            "Zr", "LE", "Br", "Hf", "Nb", "Pd", "Pt", "Rh", "Ta", "Th", "Y", "La", "Ce", "Pr", "Nd", "Sm"]
+
+# analytes the instrument never reports (left empty, as in the real exports)
+empty_analytes = ["Al", "Mg", "Si", "W", "LE", "Br", "Hf", "Ta", "Th"]
+
+standard_ids = ["oreas24b", "oreas22d", "oreas24c", "oreas901", "oreas501b", "oreas45e", "oreas25a", "oreas902",
+                "sio2blank", "oreas503b", "oreas904", "oreas502b", "oreas504b", "oreas45d", "oreas903"]
+
+# analyst initials (exports), names (sample processing log) and groups
+analysts = [("MK", "M King",     "group 2"),
+            ("RC", "R Collar",   "group 1"),
+            ("DD", "D DAmato",   "group 1"),
+            ("EE", "E Eves",     "group 2"),
+            ("MB", "M Bilodeau", "group 1")]
+
+def element_profiles(seed=0):
+    """
+    Fixed properties of each reported analyte: median concentration of the samples (ppm), spread (log10),
+    calibration slope and intercept of the instrument, drift per day, and the concentration of each standard.
+    """
+    rng = np.random.default_rng([seed, 0])
+    reported = [analyte for analyte in analytes if analyte not in empty_analytes]
+    n = len(reported)
+
+    profiles = pd.DataFrame({"median":    10 ** rng.uniform(0, 4.5, n),
+                             "spread":    rng.uniform(0.1, 0.4, n),
+                             "slope":     rng.uniform(0.8, 1.2, n),
+                             "intercept": rng.normal(0, 2, n),
+                             "drift":     rng.normal(0, 0.002, n)},
+                            index=pd.Index(reported, name="element"))
+
+    standards = 10 ** (np.log10(profiles["median"].to_numpy()) + rng.normal(0, 0.5, (len(standard_ids), n)))
+    standards[standard_ids.index("sio2blank")] = 0
+
+    return profiles, pd.DataFrame(standards, index=standard_ids, columns=reported)
+
+def synthetic_analyses(n_rows, sessions=None, seed=0, start_date="2021-10-06"):
+    """
+    Generate XRF analyses, one row per analysis, with the sample metadata of each.
+
+    Keyword arguments:
+        n_rows = Number of analyses.
+        sessions = Number of analysis sessions (days); defaults to one per 10,000 analyses (at least 3).
+        seed = Seed of the random number generator.
+        start_date = Date of the first session; sessions are one day apart.
+
+    Returns a DataFrame with the columns "sample_id", "date", "analyst", "group", "sample_type", "qaqc_type",
+    "analysis_order_index" and each analyte and its "+/-" column (values rounded to 0.1 ppm, as exported).
+    """
+    sessions = sessions or max(3, -(-n_rows // 10000))
+    rng = np.random.default_rng([seed, n_rows, sessions])
+    profiles, standard_values = element_profiles(seed)
+    reported = list(profiles.index)
+
+    # sessions of (nearly) equal size; standards first, then samples
+    session_sizes = np.diff(np.linspace(0, n_rows, sessions + 1).astype(int))
+    rows = []
+    next_sample = {"GR1": 1, "TE2": 1}
+    for session, size in enumerate(session_sizes):
+        date = pd.Timestamp(start_date) + pd.Timedelta(days=session)
+        analyst_index = session % len(analysts)
+        for position in range(size):
+            if position < len(standard_ids):
+                rows.append((standard_ids[position], date, analyst_index, "standard", "standard", ""))
+                continue
+
+            # every 8th analysis is a lab duplicate and every 20th a field duplicate of the previous sample
+            previous = rows[-1]
+            if position % 8 == 0 and previous[4] == "sample":
+                rows.append((previous[0] + "L", date, analyst_index, previous[3], "lab duplicate", previous[0]))
+            elif position % 20 == 0 and previous[4] == "sample":
+                rows.append((previous[0] + "F", date, analyst_index, previous[3], "field duplicate", previous[0]))
+            else:
+                site = "GR1" if rng.random() < 0.5 else "TE2"
+                sample_type = "sediment" if rng.random() < 0.1 else "soil"
+                sample_id = f"{site}-{'W' if sample_type == 'sediment' else ''}{next_sample[site]:03d}"
+                next_sample[site] += 1
+                rows.append((sample_id, date, analyst_index, sample_type, "sample", ""))
+
+    data = pd.DataFrame(rows, columns=["sample_id", "date", "analyst", "sample_type", "qaqc_type", "parent_id"])
+    data["group"] = [analysts[i][2] for i in data["analyst"]]
+    data["analyst"] = [analysts[i][0] for i in data["analyst"]]
+    data["analysis_order_index"] = np.arange(1, n_rows + 1)
+
+    # true concentrations: log-normal for samples (duplicates share their parent's), fixed for standards
+    n = data.shape[0]
+    log_values = np.log10(profiles["median"].to_numpy()) + rng.normal(0, 1, (n, len(reported))) * profiles["spread"].to_numpy()
+    true_values = 10 ** log_values
+    parent_positions = pd.Series(np.arange(n), index=data["sample_id"]).groupby(level=0).first()
+    has_parent = (data["parent_id"] != "").to_numpy()
+    true_values[has_parent] = true_values[parent_positions.reindex(data.loc[has_parent, "parent_id"]).to_numpy()]
+    field_duplicates = (data["qaqc_type"] == "field duplicate").to_numpy()
+    true_values[field_duplicates] *= 10 ** rng.normal(0, 0.05, (field_duplicates.sum(), len(reported)))
+    standards = (data["qaqc_type"] == "standard").to_numpy()
+    true_values[standards] = standard_values.loc[data.loc[standards, "sample_id"]].to_numpy()
+
+    # measured concentrations: calibration, drift and counting error
+    days = ((data["date"] - pd.Timestamp(start_date)).dt.days.to_numpy()[:, None])
+    measured = true_values * profiles["slope"].to_numpy() + profiles["intercept"].to_numpy() + \
+               days * profiles["drift"].to_numpy() * profiles["median"].to_numpy()
+    uncertainty = 0.03 * np.abs(measured) + 0.1 * np.sqrt(profiles["median"].to_numpy()) + 0.1
+    measured = measured + rng.normal(0, 1, measured.shape) * uncertainty
+
+    values = {}
+    for i, analyte in enumerate(reported):
+        values[analyte] = np.round(measured[:, i], 1)
+        values[analyte + " +/-"] = np.round(uncertainty[:, i], 1)
+    for analyte in empty_analytes:
+        values[analyte] = np.full(n, np.nan)
+        values[analyte + " +/-"] = np.full(n, np.nan)
+    columns = [column for analyte in analytes for column in (analyte, analyte + " +/-")]
+
+    data = pd.concat([data.drop(columns=["parent_id"]), pd.DataFrame(values, index=data.index)[columns]], axis=1)
+    data["date"] = data["date"].dt.date
+
+    return data
+
+def synthetic_clean_data(n_rows, sessions=None, seed=0):
+    # synthetic analyses in the schema of data/interim/xrf_data_clean.csv (empty analytes dropped)
+    data = synthetic_analyses(n_rows, sessions, seed)
+    data = data.drop(columns=["analyst", "analysis_order_index"]).dropna(axis=1, how="all")
+    data["comments"] = ""
+
+    headers = ["sample_id", "date", "group", "sample_type", "qaqc_type"]
+
+    return data[headers + [column for column in data.columns if column not in headers]]
+
+def write_export(session_data, path, analyst_column="Analyst"):
+    """
+    Write one session in the format of the instrument's exports: UTF-16, tab separated, with an empty row
+    below the header. The analyst's initials are in an "Analyst" or a "Field Label 1" column, as in the
+    real exports.
+    """
+    export = session_data[["analyst", "sample_id"] + [column for analyte in analytes for column in (analyte, analyte + " +/-")]]
+    export = export.rename(columns={"analyst": analyst_column, "sample_id": "Field 1"})
+    empty_row = pd.DataFrame([[np.nan] * export.shape[1]], columns=export.columns)
+
+    pd.concat([empty_row, export]).to_csv(path, sep="\t", encoding="utf-16", index=False, lineterminator="\r\n")
+
+    return Path(path)
+
+def write_exports(data, directory):
+    # write synthetic analyses to one ExportData-MM-DD-YYYY.csv file per session
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    return [write_export(session_data, directory / f"ExportData-{date:%m-%d-%Y}.csv", ["Analyst", "Field Label 1"][i % 2])
+            for i, (date, session_data) in enumerate(data.groupby("date", sort=True))]
+
+def write_sample_log(data, path):
+    """
+    Write the sample processing log (lab_processing, samples and person_dictionary sheets) for synthetic
+    analyses, in the layout read by the XRF cleaning stage.
+    """
+    names = {initials: name for initials, name, _ in analysts}
+    dates = pd.to_datetime(data["date"])
+    time_entered = dates + pd.to_timedelta(8 * 3600 + 300 * (np.arange(data.shape[0]) % 100), unit="s")
+
+    lab_processing = pd.DataFrame({"analysis_order_index": data["analysis_order_index"].to_numpy(),
+                                   "sample_id":     data["sample_id"].to_numpy(),
+                                   "process":       "xrf analysis",
+                                   "person_1":      data["analyst"].map(names).to_numpy(),
+                                   "person_2":      np.nan,
+                                   "person_3":      np.nan,
+                                   "time_entered":  time_entered.to_numpy(),
+                                   "last_modified": time_entered.to_numpy(),
+                                   "comments":      np.nan})
+
+    samples = data[["sample_id", "sample_type", "qaqc_type"]].drop_duplicates("sample_id")
+    samples = samples.rename(columns={"sample_type": "sample_type_1"})
+    samples.insert(2, "sample_type_2", np.nan)
+    samples["comments"] = np.nan
+
+    person_dictionary = pd.DataFrame([(name, group, name) for _, name, group in analysts],
+                                     columns=["person_id", "group", "description"])
+
+    with pd.ExcelWriter(path) as writer:
+        lab_processing.to_excel(writer, sheet_name="lab_processing", index=False)
+        samples.to_excel(writer, sheet_name="samples", index=False)
+        person_dictionary.to_excel(writer, sheet_name="person_dictionary", index=False)
+
+    return Path(path)
+
+def write_srm_values(path, seed=0):
+    # certified values of the standards used to generate the data, in the layout of the certificate table
+    profiles, standard_values = element_profiles(seed)
+    srm_data = standard_values.drop(index="sio2blank").rename_axis("Sample ID").reset_index()
+    srm_data = srm_data.melt(id_vars="Sample ID", var_name="Analyte", value_name="Certified Value")
+    srm_data["Sample ID"] = srm_data["Sample ID"].str.upper()
+    srm_data["Analyte"] = srm_data["Analyte"] + ", Synthetic (ppm)"
+    srm_data["Units"] = "(ppm)"
+    srm_data["Certified Value"] = srm_data["Certified Value"].round(3).astype(str)
+    for column in ["1SD", "95% Confidence Low", "95% Confidence High"]:
+        srm_data[column] = "IND"
+
+    srm_data.to_csv(path, index=False)
+
+    return Path(path)
+
+def choice(rng, options, n):
+    # random choice of n options, which may include NaN
+    return np.array(options, dtype=object)[rng.integers(len(options), size=n)]
+
+def write_field_data(data, path, seed=0):
+    # field sheet (one row per sample) in the layout of data/interim/field_data_coarse_clean.xlsx
+    rng = np.random.default_rng([seed, 1])
+    samples = data.loc[data["qaqc_type"] == "sample", ["sample_id", "group", "sample_type", "date"]]
+    n = samples.shape[0]
+
+    field_data = pd.DataFrame({"wkt_geom":    "Point",
+                               "UTM-EW":      rng.uniform(641500, 645500, n),
+                               "UTM-NS":      rng.uniform(5043000, 5047000, n),
+                               "Group":       samples["group"].str.split(" ").str[-1].astype(int).to_numpy(),
+                               "Date":        pd.to_datetime(samples["date"]).to_numpy() - np.timedelta64(14, "D"),
+                               "Weather":     choice(rng, ["Rain", "Sunny", "Cloudy"], n),
+                               "SampleID":    samples["sample_id"].to_numpy(),
+                               "Type":        samples["sample_type"].str.title().to_numpy(),
+                               "Type Sed":    np.nan,
+                               "Land use":    choice(rng, ["Forest", "FOREST", "Forested", "Trail"], n),
+                               "Disturbance": choice(rng, ["Yes", "No"], n),
+                               "Duplicate":   choice(rng, ["No", "Yes", np.nan], n),
+                               "Comments":    choice(rng, ["Near Trail", "On Slope", np.nan], n),
+                               "lineNS":      choice(rng, ["NS010", "9-10", "NS09", np.nan], n),
+                               "lineEW":      choice(rng, ["EW04", "5-6", "EW05", np.nan], n)})
+
+    field_data.to_excel(path, index=False)
+
+    return Path(path)
@@ -0,0 +1,132 @@
+"""
+Monte Carlo propagation of the instrument's counting errors (the "+/-" column of each element in the XRF
+exports) through drift correction, calibration and detection limits.
+
+Each measurement is drawn n_realizations times from a normal distribution centred on its value, with the
+spread given by its "+/-" column, as one (realizations x rows x elements) array. Every realization goes
+through the same vectorized transforms as the data (`predict_drift`, `calibrate_values`), and percentiles
+over the realizations give an uncertainty band for each value.
+
+Rows are processed in chunks whose realizations fit in chunk_bytes, so memory doesn't grow with the number
+of rows. Each chunk draws from its own random stream spawned from seed, and chunks are computed in a process
+pool, so the bands depend on seed and the chunking but not on the number of processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from source.calibration import calibrate_values
+from source.drift import corrected_elements, predict_drift
+from source.ingest import uncertainty_pairs
+from source.instrumentation import instrumented
+
+def draw_realizations(values, errors, n_realizations, rng, coverage=2):
+    """
+    Normal realizations (n_realizations x rows x elements) of measurements, from their values and "+/-"
+    errors (rows x elements), the errors being `coverage` standard deviations. Measurements without an
+    error are repeated unchanged, and missing values stay missing.
+    """
+    scale = np.nan_to_num(np.abs(errors) / coverage)
+
+    return values + rng.standard_normal((n_realizations,) + values.shape) * scale
+
+def sorted_percentiles(realizations, percentiles):
+    """
+    Percentiles of realizations along their first axis, with linear interpolation as in `np.percentile`.
+
+    The realizations are sorted in place, which is several times faster than `np.percentile`'s partition of
+    the first axis. Values of a measurement are either all missing or all present, and sorting leaves NaN last.
+    """
+    realizations.sort(axis=0)
+    positions = np.asarray(percentiles, dtype=float) / 100 * (realizations.shape[0] - 1)
+    low, high = np.floor(positions).astype(int), np.ceil(positions).astype(int)
+    weights = (positions - low).reshape((-1,) + (1,) * (realizations.ndim - 1))
+
+    return realizations[low] * (1 - weights) + realizations[high] * weights
+
+def propagate_chunk(values, errors, offsets, calibrated_rows, curves, n_realizations, percentiles, coverage,
+                    seed_sequence):
+    # percentiles of the transformed realizations of a chunk of rows, and the proportion below the detection limit
+    rng = np.random.default_rng(seed_sequence)
+    realizations = draw_realizations(values, errors, n_realizations, rng, coverage)
+
+    realizations -= offsets # drift correction (zero offsets for elements that aren't corrected)
+    realizations[:, calibrated_rows] = calibrate_values(realizations[:, calibrated_rows], curves)
+
+    # detection limits apply to calibrated rows only (NaN for standards, and for elements without a limit)
+    limits = curves["detection_limit"].to_numpy()
+    below = (realizations < limits).mean(axis=0)
+    below[~calibrated_rows] = np.nan
+    below[:, np.isnan(limits)] = np.nan
+
+    return sorted_percentiles(realizations, percentiles), below
+
+@instrumented
+def propagate_uncertainty(data, calibration=None, drift=None, n_realizations=1000, percentiles=(2.5, 50, 97.5),
+                          coverage=2, score_threshold=0.5, seed=0, processes=None, chunk_bytes=2**26, date_column="date"):
+    """
+    Uncertainty bands of the elements of XRF data from their "+/-" errors.
+
+    Keyword arguments:
+        data = XRF data with element and "+/-" columns (e.g., xrf_data_clean.csv), and "qaqc_type" and
+               date_column if calibrating or correcting drift.
+        calibration = Calibration curves from `fit_calibration`, applied to non-standards as by `calibrate`
+                      (None for none).
+        drift = Drift models from `fit_drift`, subtracted from elements whose r_squared is above
+                score_threshold as by `apply_drift_correction` (None for none). The calibration should then
+                be fitted on data corrected with the same models, or the bands are offset from the values.
+        n_realizations = Number of realizations of each measurement.
+        percentiles = Percentiles of the bands (e.g., 2.5 and 97.5 for a 95% band, and the median).
+        coverage = Number of standard deviations the "+/-" errors represent.
+        seed = Seed of the random streams of the chunks.
+        processes = Size of the process pool (processes=1 computes the chunks in this process).
+        chunk_bytes = Size of the realizations of a chunk of rows (float64); roughly three times this is used
+                      per process.
+
+    Returns the bands, a DataFrame with a "<element> p<percentile>" column for each element and percentile,
+    and the proportion of realizations below the detection limit of each calibrated element (rows x
+    calibrated elements; NaN for standards, which aren't calibrated, and for elements without a fitted curve,
+    whose bands are NaN as their values are in `calibrate`), both with the index of data. Bands are of values
+    before censoring.
+    """
+    elements, _, errors = uncertainty_pairs(data)
+    values, errors = data[elements].to_numpy(dtype=float), errors.astype(float) # values as read (not float32)
+    n_rows = len(data)
+
+    # drift of each row, for the elements that are corrected
+    offsets = np.zeros(values.shape)
+    drift_elements = [] if drift is None else corrected_elements(drift, elements, score_threshold)
+    if drift_elements:
+        positions = [elements.index(element) for element in drift_elements]
+        offsets[:, positions] = predict_drift(drift, data[date_column], drift_elements).to_numpy()
+
+    # calibration curve and detection limit of every element (identity and no limit if it isn't calibrated)
+    curves = pd.DataFrame({"slope_inv": 1.0, "intercept_inv": 0.0, "detection_limit": np.nan}, index=elements)
+    calibrated = [] if calibration is None else [element for element in calibration.index if element in elements]
+    if calibrated:
+        curves.loc[calibrated] = calibration.loc[calibrated, curves.columns].to_numpy()
+    calibrated_rows = (data["qaqc_type"] != "standard").to_numpy() if calibrated else np.zeros(n_rows, dtype=bool)
+
+    chunk_rows = max(1, chunk_bytes // (8 * n_realizations * max(len(elements), 1)))
+    starts = range(0, max(n_rows, 1), chunk_rows)
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(starts))
+    arguments = [[values[start:start + chunk_rows] for start in starts],
+                 [errors[start:start + chunk_rows] for start in starts],
+                 [offsets[start:start + chunk_rows] for start in starts],
+                 [calibrated_rows[start:start + chunk_rows] for start in starts],
+                 [curves] * len(starts), [n_realizations] * len(starts), [list(percentiles)] * len(starts),
+                 [coverage] * len(starts), seed_sequences]
+    if processes == 1 or len(starts) <= 1:
+        chunks = list(map(propagate_chunk, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks = list(executor.map(propagate_chunk, *arguments))
+
+    # (percentiles x rows x elements) -> rows x (element, percentile)
+    bands = np.concatenate([chunk[0] for chunk in chunks], axis=1).transpose(1, 2, 0).reshape(n_rows, -1)
+    columns = [f"{element} p{percentile:g}" for element in elements for percentile in percentiles]
+    below = np.concatenate([chunk[1] for chunk in chunks], axis=0)
+    below = pd.DataFrame(below[:, [elements.index(element) for element in calibrated]], index=data.index, columns=calibrated)
+
+    return pd.DataFrame(bands, index=data.index, columns=columns), below
@@ -0,0 +1,107 @@
+"""
+fit_calibration against a linregress per element, as fitted in the calibration notebook.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import linregress
+
+from source.calibration import (apply_detection_limits, calibrate, clean_srm_data, fit_calibration,
+                                srm_training_data)
+
+standards = ["oreas45e", "oreas24b", "till-4", "nist2711a", "gbm908-10"]
+
+def random_data(seed, n_measurements=8, n_samples=40):
+    """
+    Repeated measurements of a few standards and some samples, and the certified values of the standards.
+    Fe and Zn are measured on a line through their certified values (Zn with missing measurements); Cd has the
+    same certified value in every standard, so no curve can be fitted.
+    """
+    rng = np.random.default_rng(seed)
+    certified = {"Fe": rng.uniform(1e4, 1e5, len(standards)),
+                 "Zn": rng.uniform(10, 500, len(standards)),
+                 "Cd": np.full(len(standards), 0.5)}
+    srm_data = pd.DataFrame([{"Sample ID": standard, "Analyte": element, "Certified Value": values[i]}
+                             for element, values in certified.items() for i, standard in enumerate(standards)])
+
+    sample_ids = np.repeat(standards, n_measurements)
+    xrf_data = pd.DataFrame({"sample_id": sample_ids, "qaqc_type": "standard"})
+    for element, values in certified.items():
+        true = np.repeat(values, n_measurements)
+        xrf_data[element] = rng.uniform(0.8, 1.2) * true + rng.normal(scale=0.05 * true.mean(), size=true.size)
+    xrf_data.loc[rng.random(xrf_data.shape[0]) < 0.2, "Zn"] = np.nan
+
+    samples = pd.DataFrame({"sample_id": [f"GR1-{i:03d}" for i in range(n_samples)], "qaqc_type": "sample"})
+    for element, values in certified.items():
+        samples[element] = rng.uniform(0, 2) * values.mean() * rng.random(n_samples)
+
+    return pd.concat([xrf_data, samples], ignore_index=True), srm_data
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_linregress(seed):
+    xrf_data, srm_data = random_data(seed)
+    calibration = fit_calibration(xrf_data, srm_data, ["Fe", "Zn", "Cd"])
+    training_data = srm_training_data(xrf_data, srm_data, ["Fe", "Zn"])
+
+    for element in ["Fe", "Zn"]:
+        element_data = training_data[training_data["element"] == element]
+        model = linregress(element_data["certified"], element_data["measured"])
+
+        np.testing.assert_allclose(calibration.loc[element, "slope"], model.slope, rtol=1e-9)
+        np.testing.assert_allclose(calibration.loc[element, "intercept"], model.intercept, rtol=1e-6)
+        np.testing.assert_allclose(calibration.loc[element, "rvalue"], model.rvalue, rtol=1e-9)
+        np.testing.assert_allclose(calibration.loc[element, "intercept_stderr"], model.intercept_stderr, rtol=1e-6)
+        assert calibration.loc[element, "n"] == element_data.shape[0] == xrf_data.loc[:39, element].notna().sum()
+
+        # inverse and detection limit as computed in the notebook
+        slope_inv = model.slope ** -1
+        intercept_inv = -model.intercept / model.slope
+        detection_limit = slope_inv * (model.intercept + 3 * model.intercept_stderr) + intercept_inv
+        np.testing.assert_allclose(calibration.loc[element, "slope_inv"], slope_inv, rtol=1e-9)
+        np.testing.assert_allclose(calibration.loc[element, "intercept_inv"], intercept_inv, rtol=1e-6)
+        np.testing.assert_allclose(calibration.loc[element, "detection_limit"], detection_limit, rtol=1e-6)
+
+def test_constant_certified_values():
+    # Cd keeps its training data but has no curve, so its non-standard values become NaN
+    xrf_data, srm_data = random_data(0)
+    calibration = fit_calibration(xrf_data, srm_data, ["Fe", "Zn", "Cd"])
+
+    assert calibration["fitted"].to_dict() == {"Fe": True, "Zn": True, "Cd": False}
+    assert calibration.loc["Cd", ["slope_inv", "intercept_inv", "detection_limit"]].isna().all()
+    training_data = srm_training_data(xrf_data, srm_data, ["Cd"])
+    with pytest.raises(ValueError):
+        linregress(training_data["certified"], training_data["measured"])
+
+    calibrated = calibrate(xrf_data, calibration)
+    standard = (xrf_data["qaqc_type"] == "standard").to_numpy()
+    assert calibrated.loc[~standard, "Cd"].isna().all()
+    pd.testing.assert_frame_equal(calibrated[standard], xrf_data[standard])
+
+    _, censored = apply_detection_limits(calibrated, calibration)
+    assert not censored["Cd"].any()
+
+def test_calibrate():
+    xrf_data, srm_data = random_data(1)
+    calibration = fit_calibration(xrf_data, srm_data, ["Fe", "Zn"])
+    calibrated = calibrate(xrf_data, calibration)
+
+    samples = (xrf_data["qaqc_type"] != "standard").to_numpy()
+    for element in ["Fe", "Zn"]:
+        expected = calibration.loc[element, "slope_inv"] * xrf_data.loc[samples, element] + calibration.loc[element, "intercept_inv"]
+        np.testing.assert_allclose(calibrated.loc[samples, element], expected)
+
+def test_clean_srm_data():
+    srm_data = pd.DataFrame({"Sample ID":       ["OREAS45e", "OREAS45e", "Till-4"],
+                             "Analyte":         ["Ag, Silver (ppm)", "Fe, Iron (wt.%)", "Cd, Cadmium (ppm)"],
+                             "Certified Value": ["1.5", "22.65", "< 0.10"],
+                             "Units":           ["(ppm)", "(wt.%)", "(ppm)"],
+                             "1SD":             [0.1, 0.5, np.nan]})
+
+    cleaned = clean_srm_data(srm_data)
+
+    assert cleaned["Sample ID"].tolist() == ["oreas45e", "oreas45e", "till-4"]
+    assert cleaned["Analyte"].tolist() == ["Ag", "Fe", "Cd"]
+    np.testing.assert_allclose(cleaned["Certified Value"], [1.5, 226500, 0.05])
+    assert cleaned["Censored"].tolist() == [False, False, True]
+    assert cleaned["Units"].tolist() == ["ppm", "ppm", "ppm"]
+    assert "1SD" not in cleaned.columns
@@ -0,0 +1,97 @@
+"""
+correlation_matrix against pandas' corr and scipy's pearsonr on the pairwise-complete samples.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import pearsonr
+
+from source.correlation import bootstrap_intervals, correlation_matrix, correlation_values, transform_values
+
+elements = ["Fe", "Zn", "Pb", "Cu", "Sr"]
+
+def random_data(seed, n_rows=80, missing=0.15):
+    # correlated lognormal concentrations with missing values
+    rng = np.random.default_rng(seed)
+    values = 10 ** (1 + 0.3 * rng.normal(size=(n_rows, 2)) @ rng.normal(size=(2, len(elements))) +
+                    0.1 * rng.normal(size=(n_rows, len(elements))))
+    values[rng.random(values.shape) < missing] = np.nan
+    data = pd.DataFrame(values, columns=elements)
+    data.insert(0, "sample_id", [f"GR1-{i:03d}" for i in range(n_rows)])
+
+    return data
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("missing", [0, 0.15])
+def test_pearson_matches_pandas(seed, missing):
+    data = random_data(seed, missing=missing)
+
+    coefficients, _ = correlation_matrix(data, elements, triangle=None)
+    pd.testing.assert_frame_equal(coefficients, data[elements].corr(), atol=1e-12)
+
+    coefficients, _ = correlation_matrix(data, elements, transform="log", triangle=None)
+    pd.testing.assert_frame_equal(coefficients, np.log10(data[elements]).corr(), atol=1e-12)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_p_values_match_pearsonr(seed):
+    data = random_data(seed)
+    coefficients, p = correlation_matrix(data, triangle=None)
+
+    for i, x in enumerate(elements):
+        for y in elements[:i]:
+            pair = data[[x, y]].dropna()
+            result = pearsonr(pair[x], pair[y])
+            np.testing.assert_allclose(coefficients.loc[x, y], result.statistic, atol=1e-12)
+            np.testing.assert_allclose(p.loc[x, y], result.pvalue, rtol=1e-8, atol=1e-300)
+
+def test_proportionality():
+    # rho = 1 - var(x - y) / (var(x) + var(y)) of the clr-transformed values, on the samples where both are measured
+    data = random_data(0)
+    coefficients, p = correlation_matrix(data, transform="clr", method="proportionality", triangle=None)
+    clr = pd.DataFrame(transform_values(data[elements], "clr"), columns=elements)
+
+    for x in elements:
+        for y in elements:
+            pair = clr[[x, y]].dropna()
+            expected = 1 - (pair[x] - pair[y]).var(ddof=0) / (pair[x].var(ddof=0) + pair[y].var(ddof=0))
+            np.testing.assert_allclose(coefficients.loc[x, y], expected, atol=1e-12)
+    assert p.isna().all().all()
+
+def test_clr():
+    # natural log minus the mean log of each sample's measured elements
+    data = random_data(1)
+    logs = np.log(data[elements])
+
+    np.testing.assert_allclose(transform_values(data[elements], "clr"), logs.sub(logs.mean(axis=1), axis=0))
+
+def test_triangle():
+    data = random_data(0)
+    full, _ = correlation_matrix(data, triangle=None)
+    lower, _ = correlation_matrix(data)
+    upper, _ = correlation_matrix(data, triangle="upper")
+
+    below = np.tri(len(elements), k=-1, dtype=bool)
+    pd.testing.assert_frame_equal(lower, full.where(below))
+    pd.testing.assert_frame_equal(upper, full.where(below.T))
+
+def test_bootstrap_weights():
+    # weighting samples by their bootstrap counts is the same as repeating them
+    data = random_data(2)
+    rng = np.random.default_rng(0)
+    draws = rng.integers(0, len(data), len(data))
+    weights = np.bincount(draws, minlength=len(data)).astype(float)
+
+    coefficients, counts = correlation_values(data[elements].to_numpy(), weights=weights)
+    resample = data[elements].iloc[draws]
+    np.testing.assert_allclose(coefficients, resample.corr(), atol=1e-12)
+    np.testing.assert_allclose(counts, resample.notna().astype(float).T @ resample.notna().astype(float))
+
+def test_bootstrap_processes():
+    # intervals depend on the seed, not on the number of processes
+    data = random_data(0)
+    serial = bootstrap_intervals(data, n_resamples=120, chunk_size=50, processes=1)
+    parallel = bootstrap_intervals(data, n_resamples=120, chunk_size=50, processes=2)
+
+    for serial_bound, parallel_bound in zip(serial, parallel):
+        pd.testing.assert_frame_equal(serial_bound, parallel_bound)
+    assert (serial[0] <= serial[1]).where(serial[0].notna(), True).all().all()
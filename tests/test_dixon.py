@@ -0,0 +1,83 @@
+"""
+dixon_test_batch against a per-column, per-group loop of the Q test.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from source.outliers import detect_outliers_Dixons_Q, dixon_test, dixon_test_batch, q_tables
+
+def q_test(values, left=True, right=True, confidence_level=95):
+    # Q test of one column of one group, value by value: (position, side) of each outlier
+    positions = np.flatnonzero(~np.isnan(values))
+    q_critical = dict(zip(range(3, len(q_tables[confidence_level]) + 3), q_tables[confidence_level]))
+    if len(positions) not in q_critical:
+        return []
+
+    order = positions[np.argsort(values[positions], kind="stable")]
+    sdata = values[order]
+    spread = sdata[-1] - sdata[0]
+    q_min = (sdata[1] - sdata[0]) / spread if spread != 0 else 0
+    q_max = (sdata[-1] - sdata[-2]) / spread if spread != 0 else 0
+
+    min_diff = q_min - q_critical[len(positions)] if left else 0
+    max_diff = q_max - q_critical[len(positions)] if right else 0
+
+    outliers = []
+    if min_diff > 0 and min_diff >= max_diff:
+        outliers.append((order[0], "min"))
+    if max_diff > 0 and max_diff >= min_diff:
+        outliers.append((order[-1], "max"))
+
+    return outliers
+
+def random_data(seed, n_rows=300, n_columns=6, n_groups=20, nan_fraction=0.1):
+    # normal data in groups of varying size, with missing values and planted extremes
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(n_rows, n_columns))
+    values[rng.random(values.shape) < 0.05] *= 20
+    values[rng.random(values.shape) < nan_fraction] = np.nan
+    data = pd.DataFrame(values, columns=[f"e{i}" for i in range(n_columns)])
+    data["group"] = rng.integers(0, n_groups, n_rows)
+
+    return data
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("left, right", [(True, True), (True, False), (False, True)])
+@pytest.mark.parametrize("confidence_level", [90, 95, 99])
+def test_batch_matches_loop(seed, left, right, confidence_level):
+    data = random_data(seed)
+    columns = [column for column in data.columns if column != "group"]
+
+    records = dixon_test_batch(data, columns=columns, groupby="group", left=left, right=right,
+                               confidence_level=confidence_level)
+
+    expected = set()
+    for group, group_data in data.groupby("group"):
+        group_positions = data.index.get_indexer(group_data.index)
+        for column in columns:
+            for position, side in q_test(group_data[column].to_numpy(), left, right, confidence_level):
+                expected.add((group, column, group_positions[position], side))
+
+    found = set(zip(records["group"], records["column"], records["position"], records["side"]))
+    assert found == expected
+    assert (data.to_numpy()[records["position"], data.columns.get_indexer(records["column"])] == records["value"]).all()
+
+def test_batch_without_groups_matches_loop():
+    data = random_data(0, n_rows=25, n_groups=1).drop(columns="group")
+    records = dixon_test_batch(data)
+
+    expected = {(column, position, side) for column in data.columns
+                for position, side in q_test(data[column].to_numpy())}
+    assert set(zip(records["column"], records["position"], records["side"])) == expected
+
+def test_dixon_test():
+    assert dixon_test([1, 1, 1]) == ([1, 1, 1], [], [])
+    assert dixon_test([5, 1, 1]) == ([1, 1], [5], [0])
+    assert dixon_test([1, 2, 2.1, 2.2, 30]) == ([1, 2, 2.1, 2.2], [30], [4])
+
+def test_detect_outliers_records():
+    data = pd.DataFrame({"sample_id": ["a", "b", "c", "d"], "date": ["2021-10-06"] * 4,
+                         "Fe": [1.0, 1.1, 1.2, 9.0], "Zn": [3.0, 3.0, 3.0, 3.0]})
+
+    assert detect_outliers_Dixons_Q(["Fe", "Zn"], data) == [{"Sample ID": "d", "Session": "2021-10-06", "Element": "Fe"}]
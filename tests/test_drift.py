@@ -0,0 +1,76 @@
+"""
+fit_drift against the per-element LinearRegression of the QAQC notebook.
+"""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from source.drift import apply_drift_correction, fit_drift, predict_drift, to_ordinal
+
+def random_data(seed, n_rows=120, elements=("Fe", "Zn", "Pb", "Cu")):
+    # drift of standards over a few sessions, with missing values
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2021-10-06", "2021-11-30", freq="D").strftime("%Y-%m-%d").to_numpy()
+    data = pd.DataFrame({"date": rng.choice(dates, n_rows)})
+    days = to_ordinal(data["date"]) - to_ordinal(["2021-10-06"])[0]
+    for element in elements:
+        values = rng.normal() * days + rng.normal(scale=rng.uniform(1, 30), size=n_rows)
+        values[rng.random(n_rows) < 0.2] = np.nan
+        data[element] = values
+
+    return data, list(elements)
+
+def linear_regressions(data, elements):
+    # the notebook's loop: a model per element on the ordinal dates of its valid values
+    models = {}
+    for element in elements:
+        valid = data[element].notna()
+        x = np.array([datetime.strptime(date, "%Y-%m-%d").toordinal() for date in data.loc[valid, "date"]])[:, None]
+        y = data.loc[valid, element].to_numpy()
+        model = LinearRegression().fit(x, y)
+        models[element] = (model, model.score(x, y), valid.sum())
+
+    return models
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_linear_regression(seed):
+    data, elements = random_data(seed)
+    coefficients = fit_drift(data, elements)
+
+    for element, (model, score, n) in linear_regressions(data, elements).items():
+        np.testing.assert_allclose(coefficients.loc[element, "slope"], model.coef_[0], rtol=1e-9)
+        np.testing.assert_allclose(coefficients.loc[element, "intercept"], model.intercept_, rtol=1e-9)
+        np.testing.assert_allclose(coefficients.loc[element, "r_squared"], score, rtol=1e-9, atol=1e-12)
+        assert coefficients.loc[element, "n"] == n
+
+def test_prediction_matches_linear_regression():
+    data, elements = random_data(0)
+    coefficients = fit_drift(data, elements)
+    models = linear_regressions(data, elements)
+
+    drift = predict_drift(coefficients, data["date"])
+    x = to_ordinal(data["date"])[:, None]
+    for element in elements:
+        np.testing.assert_allclose(drift[element], models[element][0].predict(x), rtol=1e-9)
+
+def test_correction():
+    # only elements whose model scores above the threshold are corrected
+    data, elements = random_data(1)
+    coefficients = fit_drift(data, elements)
+    corrected = apply_drift_correction(data, coefficients, score_threshold=0.5)
+
+    for element in elements:
+        if coefficients.loc[element, "r_squared"] > 0.5:
+            expected = data[element] - predict_drift(coefficients, data["date"], [element])[element]
+        else:
+            expected = data[element]
+        np.testing.assert_allclose(corrected[element], expected)
+
+def test_datetime_dates():
+    data, elements = random_data(2)
+    dated = data.assign(date=pd.to_datetime(data["date"]).dt.date)
+
+    pd.testing.assert_frame_equal(fit_drift(dated, elements), fit_drift(data, elements))
@@ -0,0 +1,100 @@
+"""
+MultivariateModel against the multivariate notebook's scikit-learn PCA of the scaled data.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import normaltest
+from sklearn import preprocessing
+from sklearn.decomposition import PCA
+
+from source.multivariate import MultivariateModel, fit_model, select_log_transform
+
+repository = Path(__file__).resolve().parents[1]
+interim_directory = repository / "data" / "interim"
+
+elements = ["Fe", "Zn", "Pb", "Cu", "Sr", "Ti"]
+
+def random_data(seed, n_rows=150):
+    # correlated concentrations, some lognormal and some normal
+    rng = np.random.default_rng(seed)
+    latent = rng.normal(size=(n_rows, 3)) @ rng.normal(size=(3, len(elements)))
+    values = latent + rng.normal(scale=0.5, size=latent.shape)
+    values[:, :3] = 10 ** (1 + 0.3 * values[:, :3])
+    values[:, 3:] = 100 + 10 * values[:, 3:]
+    data = pd.DataFrame(values, columns=elements)
+    data.insert(0, "sample_id", [f"GR1-{i:03d}" for i in range(n_rows)])
+    data["comments"] = ""
+
+    return data
+
+def notebook_pca(data, elements):
+    # the notebook: log-transform where closer to normal, scale, PCA, then min-max normalize scores to [-1, 1]
+    values = data[elements].copy()
+    for element in elements:
+        if normaltest(values[element])[1] < normaltest(np.log10(values[element]))[1]:
+            values[element] = np.log10(values[element])
+    pca = PCA().fit(preprocessing.scale(values))
+    scores = pca.transform(preprocessing.scale(values))
+    normalized = 2 * (scores - scores.min(axis=0)) / (scores.max(axis=0) - scores.min(axis=0)) - 1
+
+    return pca, scores, normalized
+
+def assert_equal_up_to_sign(result, expected):
+    # principal components are defined up to sign
+    signs = np.sign((result * expected).sum(axis=0))
+    np.testing.assert_allclose(result * signs, expected, atol=1e-8)
+
+@pytest.mark.parametrize("seed", range(3))
+def test_matches_notebook(seed):
+    data = random_data(seed)
+    pca, scores, normalized = notebook_pca(data, elements)
+    model = MultivariateModel(elements).fit(data)
+
+    np.testing.assert_allclose(model.explained_variance_ratio, pca.explained_variance_ratio_, atol=1e-10)
+    np.testing.assert_allclose(model.explained_variance, pca.explained_variance_, rtol=1e-8)
+    assert_equal_up_to_sign(model.project(data, normalized=False)[model.pc_names].to_numpy(), scores)
+    assert_equal_up_to_sign(model.project(data)[model.pc_names].to_numpy(), normalized)
+    assert_equal_up_to_sign(model.components.T, pca.components_.T)
+
+def test_select_log_transform():
+    data = random_data(0)
+    expected = [normaltest(data[element])[1] < normaltest(np.log10(data[element]))[1] for element in elements]
+
+    assert select_log_transform(data, elements).tolist() == expected
+
+def test_partial_fit_matches_fit():
+    # components, normalization and clusters don't depend on how the samples are split into batches
+    data = random_data(1)
+    model = MultivariateModel(elements, n_clusters=3).fit(data)
+    batches = MultivariateModel(elements, log_elements=list(model.log_elements.index[model.log_elements]), n_clusters=3)
+    for batch in np.array_split(np.arange(len(data)), 3):
+        batches.partial_fit(data.iloc[batch])
+
+    np.testing.assert_allclose(batches.components, model.components, atol=1e-10)
+    pd.testing.assert_frame_equal(batches.project(data), model.project(data), atol=1e-10)
+
+def test_incomplete_rows():
+    # rows with a missing value are left out of fitting and get NaN scores and no cluster
+    data = random_data(2)
+    incomplete = data.copy()
+    incomplete.loc[[3, 7], "Zn"] = np.nan
+    model = MultivariateModel(elements, n_clusters=3).fit(incomplete)
+
+    projected = model.project(incomplete)
+    assert projected.loc[[3, 7], model.pc_names].isna().all().all()
+    assert (projected.loc[[3, 7], "cluster"] == -1).all()
+
+    reference = MultivariateModel(elements, log_elements=list(model.log_elements.index[model.log_elements]))
+    reference.fit(data.drop(index=[3, 7]))
+    np.testing.assert_allclose(reference.components, model.components, atol=1e-10)
+
+@pytest.mark.skipif(not (interim_directory / "data_pca_norm.csv").exists(), reason="no tracked outputs")
+def test_matches_tracked_outputs():
+    data = pd.read_csv(interim_directory / "data_analysis_ready.csv")
+    expected = pd.read_csv(interim_directory / "data_pca_norm.csv", index_col=0)
+
+    projected = fit_model(data, model_path=False).project(data)
+    pd.testing.assert_frame_equal(projected, expected, check_dtype=False, atol=1e-10)
@@ -0,0 +1,93 @@
+"""
+remove_outliers against the loop it replaced, one drop or .loc assignment per outlier.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source.outliers import remove_outliers
+
+def remove_outliers_loop(outliers, data):
+    # previous implementation, which modified `data` in place
+    for outlier in outliers["sample"]:
+        data.drop(data[data["sample_id"] == outlier["Sample ID"]].index, inplace=True)
+
+    for outlier in outliers["sample_session"]:
+        data.drop(data[(data["sample_id"] == outlier["Sample ID"]) &
+                       (data["date"]      == outlier["Session"])].index, inplace=True)
+
+    for outlier in outliers["sample_session_element"]:
+        data.loc[(data["sample_id"] == outlier["Sample ID"]) &
+                 (data["date"]      == outlier["Session"]), outlier["Element"]] = np.nan
+
+    return data
+
+def random_data(seed, n_rows=200):
+    # repeated analyses of a few samples over a few sessions
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({"sample_id": rng.choice([f"GR1-{i:03d}" for i in range(15)], n_rows),
+                         "date":      rng.choice(["2021-10-06", "2021-10-14", "2021-10-21", "2021-10-31"], n_rows)})
+    for element in ["Fe", "Zn", "Pb", "Cu"]:
+        data[element] = rng.lognormal(size=n_rows)
+
+    return data
+
+def random_outliers(seed, data, n=30):
+    # outliers of every scope drawn from the (sample, session) pairs of data, plus some that match nothing
+    rng = np.random.default_rng(seed)
+    pairs = data[["sample_id", "date"]].drop_duplicates().to_numpy()
+    pairs = np.concatenate([pairs, [["GR9-999", "2021-10-06"], ["GR1-000", "2022-01-01"]]])
+    picks = pairs[rng.integers(0, len(pairs), n)]
+    elements = rng.choice(["Fe", "Zn", "Pb", "Cu", "Mo"], n) # Mo isn't a column of data
+
+    return {"sample":                 [{"Sample ID": sample_id} for sample_id, _ in picks[:2]],
+            "sample_session":         [{"Sample ID": sample_id, "Session": session} for sample_id, session in picks[2:6]],
+            "sample_session_element": [{"Sample ID": sample_id, "Session": session, "Element": element}
+                                       for (sample_id, session), element in zip(picks[6:], elements[6:])]}
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_loop(seed):
+    data = random_data(seed)
+    outliers = random_outliers(seed, data)
+
+    expected = remove_outliers_loop(outliers, data.copy())
+    result = remove_outliers(outliers, data)
+
+    pd.testing.assert_frame_equal(result, expected)
+
+def test_datetime_sessions():
+    # sessions match whether the dates are strings or datetimes
+    data = random_data(0)
+    outliers = random_outliers(0, data)
+
+    expected = remove_outliers(outliers, data)
+    dated = data.assign(date=pd.to_datetime(data["date"]).dt.date)
+    result = remove_outliers(outliers, dated)
+
+    pd.testing.assert_frame_equal(result.drop(columns="date"), expected.drop(columns="date"))
+    assert (result["date"] == pd.to_datetime(expected["date"]).dt.date).all()
+
+def test_inplace():
+    data = random_data(0)
+    outliers = {"sample": [], "sample_session": [],
+                "sample_session_element": [{"Sample ID": data["sample_id"][0], "Session": data["date"][0], "Element": "Fe"}]}
+    original = data.copy()
+
+    remove_outliers(outliers, data)
+    pd.testing.assert_frame_equal(data, original)
+
+    result = remove_outliers(outliers, data, inplace=True)
+    assert result is data
+    assert np.isnan(data.loc[0, "Fe"])
+
+def test_unknown_element():
+    data = pd.DataFrame({"sample_id": ["a", "b"], "date": [datetime.date(2021, 10, 6)] * 2, "Fe": [1.0, 2.0]})
+    outliers = {"sample": [], "sample_session": [],
+                "sample_session_element": [{"Sample ID": "a", "Session": "2021-10-06", "Element": "Mo"}]}
+
+    result = remove_outliers(outliers, data)
+
+    assert result["Mo"].isna().all()
+    assert result["Fe"].tolist() == [1.0, 2.0]